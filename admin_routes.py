@@ -1,6 +1,6 @@
 from flask import render_template, request, redirect, url_for, flash, jsonify, send_file, abort, session, make_response
 from app import app, db
-from models import User, Registration, QuestProgress, StickerGeneration, AdminLog, ScheduledMessage, SystemConfig, DanceSlot, AdminMessage, SurveyAnswer, UserFeedback
+from models import User, Registration, QuestProgress, StickerGeneration, AdminLog, ScheduledMessage, SystemConfig, DanceSlot, AdminMessage, SurveyAnswer, UserFeedback, BroadcastJob, DanceWaitlist
 import pandas as pd
 import io
 import time
@@ -10,6 +10,9 @@ import hashlib
 from functools import wraps
 import json as json_lib
 import os
+import logging
+import quest_tracker
+import dance_booking
 
 # Простая авторизация (в production лучше использовать более безопасные методы)
 ADMIN_USERNAME = "admin"
@@ -35,6 +38,14 @@ def from_json_filter(s):
     except:
         return []
 
+def refresh_bot_caches():
+    """Сбросить кеши бота после изменения текстов и настроек в админке"""
+    try:
+        from text_cache import text_cache
+        text_cache.force_update()
+    except Exception as e:
+        logging.error(f"Error refreshing text cache: {e}")
+
 @app.route('/admin/login', methods=['GET', 'POST'])
 def admin_login():
     if request.method == 'POST':
@@ -91,24 +102,24 @@ def index():
         .order_by(StickerGeneration.created_at.desc())\
         .limit(20).all()
 
-    # Слоты танцев из базы данных
+    # Слоты танцев: заполненность из кеша, участники — одним запросом на все слоты
+    slot_users = {}
+    dance_registrations = db.session.query(Registration.day, Registration.time_slot, User)\
+        .join(User, Registration.user_id == User.id)\
+        .filter(Registration.activity_type == 'dance')\
+        .order_by(Registration.created_at).all()
+    for day, time_slot, user in dance_registrations:
+        slot_users.setdefault((day, time_slot), []).append(user)
+
     dance_slots_data = []
-    dance_slots = DanceSlot.query.filter_by(is_active=True).order_by(DanceSlot.day, DanceSlot.time_slot).all()
-
-    for slot in dance_slots:
-        regs = Registration.query.filter_by(
-            activity_type='dance', 
-            day=slot.day, 
-            time_slot=slot.time_slot
-        ).order_by(Registration.created_at).all()
-        users = [User.query.get(reg.user_id) for reg in regs]
+    for slot in dance_booking.availability():
         dance_slots_data.append({
-            'id': slot.id,
             'day': slot.day,
             'time_slot': slot.time_slot,
             'max_participants': slot.max_participants,
-            'current_participants': len(users),
-            'users': users
+            'current_participants': slot.taken,
+            'waiting': slot.waiting,
+            'users': slot_users.get((slot.day, slot.time_slot), [])
         })
 
     return render_template(
@@ -337,7 +348,7 @@ def export_filtered_csv():
         # Данные о квесте
         quest = QuestProgress.query.filter_by(user_id=user.id).first()
         quest_completed = 'Да' if quest and quest.completed else 'Нет'
-        quest_steps = len(json.loads(quest.completed_steps or "[]")) if quest else 0
+        quest_steps = quest.steps_found if quest else 0
 
         # Данные о стикерах
         sticker = StickerGeneration.query.filter_by(
@@ -454,32 +465,23 @@ def broadcast():
         else:
             users = []
 
-        # Импортируем бота
+        # Импортируем бота (вместе с ним запускается движок рассылок)
         try:
             from bot import bot
+            from broadcast_engine import broadcast_engine
         except ImportError:
             flash('Ошибка: не удалось импортировать бота', 'error')
             return redirect(url_for('broadcast'))
 
-        # Отправляем сообщения
-        success_count = 0
-        error_count = 0
-
-        for user in users:
-            try:
-                if photo_url and os.path.exists(photo_url):
-                    with open(photo_url, 'rb') as photo:
-                        bot.send_photo(int(user.telegram_id), photo, caption=message_text, parse_mode='HTML')
-                else:
-                    bot.send_message(int(user.telegram_id), message_text, parse_mode='HTML')
-                success_count += 1
-                time.sleep(0.1)  # Небольшая задержка между сообщениями
-            except Exception as e:
-                print(f"Error sending to user {user.telegram_id}: {e}")
-                error_count += 1
+        # Ставим рассылку в фоновую очередь — отправка идёт вне HTTP-запроса
+        job_id = broadcast_engine.submit(
+            message_text,
+            [user.telegram_id for user in users],
+            photo_url=photo_url
+        )
 
-        flash(f'Сообщение отправлено {success_count} пользователям. Ошибок: {error_count}', 'success')
-        return redirect(url_for('broadcast'))
+        flash(f'Рассылка #{job_id} запущена для {len(users)} пользователей', 'success')
+        return redirect(url_for('broadcast', job=job_id))
 
     scheduled_messages = ScheduledMessage.query.order_by(ScheduledMessage.scheduled_time).all()
 
@@ -490,7 +492,20 @@ def broadcast():
         'avg_recommend': db.session.query(db.func.avg(db.cast(UserFeedback.answer, db.Float))).filter_by(question_id='recommend_work').scalar()
     }
 
-    return render_template('broadcast.html', scheduled_messages=scheduled_messages, feedback_stats=feedback_stats)
+    broadcast_jobs = BroadcastJob.query.order_by(BroadcastJob.id.desc()).limit(10).all()
+
+    return render_template('broadcast.html', scheduled_messages=scheduled_messages, feedback_stats=feedback_stats,
+                           broadcast_jobs=broadcast_jobs)
+
+@app.route('/broadcast/progress/<int:job_id>')
+@admin_required
+def broadcast_progress(job_id):
+    """Прогресс фоновой рассылки (опрашивается со страницы рассылки)"""
+    from broadcast_engine import broadcast_engine
+    progress = broadcast_engine.progress(job_id)
+    if progress is None:
+        abort(404)
+    return jsonify(progress)
 
 @app.route('/send_feedback_survey', methods=['POST'])
 @admin_required
@@ -578,6 +593,7 @@ def add_dance_slot():
     slot = DanceSlot(day=day, time_slot=time_slot, max_participants=max_participants)
     db.session.add(slot)
     db.session.commit()
+    dance_booking.invalidate_availability()
     flash('Слот добавлен', 'success')
     return redirect(url_for('dance_slots'))
 
@@ -597,8 +613,10 @@ def delete_dance_slot(slot_id):
         flash(f'Нельзя удалить слот с {registrations} записями', 'danger')
         return redirect(url_for('dance_slots'))
 
+    DanceWaitlist.query.filter_by(slot_id=slot.id).delete()
     db.session.delete(slot)
     db.session.commit()
+    dance_booking.invalidate_availability()
     flash('Слот удален', 'success')
     return redirect(url_for('dance_slots'))
 
@@ -608,6 +626,7 @@ def toggle_dance_slot(slot_id):
     slot = DanceSlot.query.get_or_404(slot_id)
     slot.is_active = not slot.is_active
     db.session.commit()
+    dance_booking.invalidate_availability()
     status = 'активирован' if slot.is_active else 'деактивирован'
     flash(f'Слот {status}', 'success')
     return redirect(url_for('dance_slots'))
@@ -643,6 +662,7 @@ def edit_config(config_id):
         config.config_value = request.form.get('config_value', '')
         config.description = request.form.get('description', '')
         db.session.commit()
+        refresh_bot_caches()
         flash('Конфигурация обновлена', 'success')
         return redirect(url_for('config'))
 
@@ -693,11 +713,13 @@ def update_bot_config():
             SystemConfig.set_config('REPLICATE_API_TOKEN', replicate_token, 'bot', 'Токен Replicate API')
             os.environ['REPLICATE_API_TOKEN'] = replicate_token
 
-        SystemConfig.set_config('BOT_MODE', bot_mode, 'bot', 'Режим работы бота (polling/webhook)')
+        SystemConfig.set_config('BOT_MODE', bot_mode, 'bot', 'Режим работы бота (polling/webhook/sharded)')
 
         if webhook_domain:
             SystemConfig.set_config('WEBHOOK_DOMAIN', webhook_domain, 'bot', 'Домен для webhook')
 
+        refresh_bot_caches()
+
         if token_changed:
             flash('Настройки бота обновлены. Требуется перезапуск для применения нового токена!', 'warning')
         else:
@@ -727,6 +749,7 @@ def add_config():
         return redirect(url_for('config'))
 
     SystemConfig.set_config(key, value, config_type, description)
+    refresh_bot_caches()
     flash('Настройка добавлена', 'success')
     return redirect(url_for('config'))
 
@@ -851,11 +874,7 @@ def update_text_message():
     SystemConfig.set_config(message_key, message_text, 'text', f'Текстовое сообщение: {message_key}')
 
     # Принудительно обновляем кеш
-    try:
-        from text_cache import text_cache
-        text_cache.force_update()
-    except:
-        pass
+    refresh_bot_caches()
 
     flash('Сообщение обновлено', 'success')
     return redirect(url_for('text_messages'))
@@ -875,11 +894,7 @@ def update_survey_questions():
         SystemConfig.set_config('SURVEY_QUESTIONS', questions, 'json', 'Вопросы опроса')
 
     # Принудительно обновляем кеш
-    try:
-        from text_cache import text_cache
-        text_cache.force_update()
-    except:
-        pass
+    refresh_bot_caches()
 
     flash('Вопросы опроса обновлены', 'success')
     return redirect(url_for('text_messages'))
@@ -901,11 +916,7 @@ def update_quest_steps():
                 SystemConfig.set_config(f'QUEST_STEP_{i}_IMAGE', image_path, 'text', f'Изображение квеста {i}')
 
         # Принудительно обновляем кеш
-        try:
-            from text_cache import text_cache
-            text_cache.force_update()
-        except:
-            pass
+        refresh_bot_caches()
 
         flash('Шаги квеста обновлены', 'success')
     except Exception as e:
@@ -955,9 +966,10 @@ def setup_webhook_from_admin():
         time.sleep(1)
         
         # Устанавливаем новый
+        from update_dispatcher import WEBHOOK_MAX_CONNECTIONS
         success = bot.set_webhook(
             url=webhook_url,
-            max_connections=10,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
             allowed_updates=["message", "callback_query"]
         )
         
@@ -978,6 +990,7 @@ def webhook_status():
     """Проверка статуса webhook"""
     try:
         from bot import bot
+        from update_dispatcher import update_dispatcher
         webhook_info = bot.get_webhook_info()
         
         return jsonify({
@@ -990,7 +1003,8 @@ def webhook_status():
                 'last_error_message': webhook_info.last_error_message,
                 'max_connections': webhook_info.max_connections,
                 'allowed_updates': webhook_info.allowed_updates
-            }
+            },
+            'dispatcher': update_dispatcher.stats()
         })
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
@@ -1211,11 +1225,7 @@ def import_from_text_py():
                 imported_count += 1
 
         # Принудительно обновляем кеш
-        try:
-            from text_cache import text_cache
-            text_cache.force_update()
-        except:
-            pass
+        refresh_bot_caches()
 
         flash(f'Импортировано {imported_count} текстов из text.py', 'success')
     except Exception as e:
@@ -1235,11 +1245,7 @@ def toggle_survey():
     SystemConfig.set_config('SURVEY_ENABLED', new_state, 'text', 'Включение/отключение опроса для новых пользователей')
 
     # Принудительно обновляем кеш
-    try:
-        from text_cache import text_cache
-        text_cache.force_update()
-    except:
-        pass
+    refresh_bot_caches()
 
     status = 'включен' if new_state == 'true' else 'отключен'
     flash(f'Опрос {status}', 'success')
@@ -1274,11 +1280,7 @@ def import_from_quest_py():
             imported_count += 1
 
         # Принудительно обновляем кеш
-        try:
-            from text_cache import text_cache
-            text_cache.force_update()
-        except:
-            pass
+        refresh_bot_caches()
 
         flash(f'Импортировано {imported_count} элементов квеста из quest.py', 'success')
     except Exception as e:
@@ -1324,6 +1326,24 @@ def upload_image():
 
         # Сохраняем файл
         image_file.save(file_path)
+
+        # Сбрасываем кеш отрендеренного изображения и file_id, готовим новую версию
+        try:
+            from media_registry import media_registry
+            media_registry.invalidate(file_path)
+            media_registry.prerender([file_path])
+        except Exception as e:
+            logging.error(f"Error refreshing image cache for {file_path}: {e}")
+
+        # Фон и шильдик стикеров — подготовленные слои тоже пересобираются
+        if image_type in ('background', 'shildik'):
+            try:
+                from sticker_generator import sticker_compositor
+                sticker_compositor.invalidate()
+                sticker_compositor.warm_up()
+            except Exception as e:
+                logging.error(f"Error refreshing sticker layers: {e}")
+
         flash(f'Изображение {filename} успешно загружено', 'success')
     except Exception as e:
         flash(f'Ошибка загрузки: {str(e)}', 'error')
@@ -1337,6 +1357,7 @@ def user_detail(telegram_id):
 
     registrations = Registration.query.filter_by(user_id=user.id).order_by(Registration.created_at.desc()).all()
     quest_progress = QuestProgress.query.filter_by(user_id=user.id).first()
+    quest_steps = quest_progress.step_numbers() if quest_progress else []
     stickers = StickerGeneration.query.filter_by(user_id=user.id).order_by(StickerGeneration.created_at.desc()).all()
     survey_answers = db.session.query(SurveyAnswer).filter_by(user_id=user.id).order_by(SurveyAnswer.step_num).all()
 
@@ -1360,11 +1381,39 @@ def user_detail(telegram_id):
         user=user,
         registrations=registrations,
         quest_progress=quest_progress,
+        quest_steps=quest_steps,
         stickers=stickers,
         survey_answers=survey_answers,
         sticker_info=sticker_info
     )
 
+def notify_dance_promotions(promotions) -> None:
+    """После commit: сбросить кеш свободных мест и уведомить получивших место из листа ожидания"""
+    dance_booking.invalidate_availability()
+    if not promotions:
+        return
+    try:
+        from bot import notify_dance_promotions as notify
+        notify(promotions)
+    except Exception as e:
+        logging.error(f"Error notifying dance waitlist promotions: {e}")
+
+def forget_bot_user(telegram_id) -> None:
+    """Сбросить закешированный в боте users.id, чтобы новые записи не ссылались на удалённого пользователя"""
+    try:
+        from bot import forget_user_id
+        forget_user_id(int(telegram_id))
+    except Exception as e:
+        logging.error(f"Error invalidating bot user cache: {e}")
+
+def forget_sticker_pack(telegram_id) -> None:
+    """Убрать стикерпак пользователя из индекса бота после удаления записей"""
+    try:
+        from sticker_packs import sticker_packs
+        sticker_packs.forget(int(telegram_id))
+    except Exception as e:
+        logging.error(f"Error updating sticker pack index: {e}")
+
 @app.route('/user/delete/<telegram_id>', methods=['POST'])
 def delete_user(telegram_id):
     user = User.query.filter_by(telegram_id=telegram_id).first()
@@ -1372,12 +1421,18 @@ def delete_user(telegram_id):
         return jsonify({'success': False, 'error': 'User not found'})
 
     # Удалить все, что связано с этим пользователем
-    Registration.query.filter_by(user_id=user.id).delete()
-    QuestProgress.query.filter_by(user_id=user.id).delete()
-    StickerGeneration.query.filter_by(user_id=user.id).delete()
-    SurveyAnswer.query.filter_by(user_id=user.id).delete()
+    user_id = user.id
+    promotions = dance_booking.release_user(user_id)
+    Registration.query.filter_by(user_id=user_id).delete()
+    quest_tracker.reset(user_id)
+    StickerGeneration.query.filter_by(user_id=user_id).delete()
+    SurveyAnswer.query.filter_by(user_id=user_id).delete()
     db.session.delete(user)
     db.session.commit()
+    quest_tracker.forget(user_id)
+    forget_bot_user(telegram_id)
+    forget_sticker_pack(telegram_id)
+    notify_dance_promotions(promotions)
     return jsonify({'success': True})
 
 @app.route('/user/reset/<telegram_id>', methods=['POST'])
@@ -1389,8 +1444,9 @@ def reset_user(telegram_id):
 
     try:
         # Удаляем все активности пользователя
+        promotions = dance_booking.release_user(user.id)
         Registration.query.filter_by(user_id=user.id).delete()
-        QuestProgress.query.filter_by(user_id=user.id).delete()
+        quest_tracker.reset(user.id)
         StickerGeneration.query.filter_by(user_id=user.id).delete()
         SurveyAnswer.query.filter_by(user_id=user.id).delete()
 
@@ -1404,6 +1460,8 @@ def reset_user(telegram_id):
         user.grade = None
         user.company = None
 
+        forget_sticker_pack(telegram_id)
+
         # Сбрасываем состояние в боте
         try:
             from bot import user_states
@@ -1413,6 +1471,9 @@ def reset_user(telegram_id):
             pass  # Бот может быть недоступен
 
         db.session.commit()
+        quest_tracker.forget(user.id)
+        forget_bot_user(telegram_id)
+        notify_dance_promotions(promotions)
         return jsonify({'success': True})
     except Exception as e:
         db.session.rollback()
@@ -1446,9 +1507,65 @@ def api_users():
 def api_stats():
     """API для получения статистики"""
     from monitoring import BotMonitoring
+    from ttl_cache import cache_stats
+    from sticker_jobs import sticker_jobs
+    from sticker_packs import sticker_packs
+    from result_cache import replicate_cache
+    from sticker_generator import model_stats
+    from quest_leaderboard import quest_leaderboard
+    from sharded_polling import sharded_polling
     return jsonify({
         'system': BotMonitoring.get_system_stats(),
         'bot': BotMonitoring.get_bot_stats(),
+        'caches': cache_stats(),
+        'sticker_queue': sticker_jobs.queue_stats(),
+        'sticker_packs': sticker_packs.stats(),
+        'replicate_cache': replicate_cache.stats(),
+        'models': model_stats(),
+        'quest_leaderboard': quest_leaderboard.stats(),
+        'sharded_polling': sharded_polling.stats(),
+        'timestamp': datetime.utcnow().isoformat()
+    })
+
+@app.route('/api/quest/leaderboard')
+@admin_required
+def api_quest_leaderboard():
+    """Рейтинг квеста: топ-N и, если передан telegram_id, место пользователя"""
+    from quest_leaderboard import quest_leaderboard
+    limit = max(1, min(request.args.get('limit', 20, type=int), 500))
+    top = quest_leaderboard.top(limit)
+
+    me = None
+    telegram_id = request.args.get('telegram_id')
+    if telegram_id:
+        user = User.query.filter_by(telegram_id=telegram_id).first()
+        me = quest_leaderboard.rank(user.id) if user else None
+        if me:
+            top = top + [me]
+
+    users = {user.id: user for user in User.query.filter(User.id.in_({entry['user_id'] for entry in top}))}
+    for entry in top:
+        user = users.get(entry['user_id'])
+        entry['telegram_id'] = user.telegram_id if user else None
+        entry['name'] = f"{user.first_name or ''} {user.last_name or ''}".strip() if user else None
+        entry['username'] = user.username if user else None
+
+    return jsonify({
+        'top': top[:limit],
+        'me': me,
+        'stats': quest_leaderboard.stats(),
+        'timestamp': datetime.utcnow().isoformat()
+    })
+
+@app.route('/api/handler_stats')
+@admin_required
+def api_handler_stats():
+    """Запросы к БД, вызовы Telegram API и время по обработчикам бота"""
+    from handler_stats import handler_stats
+    if request.args.get('reset'):
+        handler_stats.reset()
+    return jsonify({
+        'handlers': handler_stats.snapshot(),
         'timestamp': datetime.utcnow().isoformat()
     })
 
@@ -1566,11 +1683,7 @@ def update_config():
         db.session.commit()
 
         # Принудительно обновляем кеш
-        try:
-            from text_cache import text_cache
-            text_cache.force_update()
-        except:
-            pass
+        refresh_bot_caches()
 
         flash('Конфигурация обновлена успешно! Изменения токенов вступят в силу после перезапуска.', 'success')
     except Exception as e:
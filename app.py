@@ -1,6 +1,7 @@
 import os
 import logging
-from flask import Flask
+from contextlib import contextmanager
+from flask import Flask, has_app_context
 from werkzeug.middleware.proxy_fix import ProxyFix
 import telebot
 
@@ -29,7 +30,8 @@ db_dir = os.path.join(BASE_DIR, "instance")
 os.makedirs(db_dir, exist_ok=True)
 
 db_path = os.path.join(db_dir, "festival_bot.db")
-app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{db_path}"
+# DATABASE_URL — отдельная база (например, для нагрузочных тестов)
+app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("DATABASE_URL", f"sqlite:///{db_path}")
 app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
     "pool_recycle": 300,
     "pool_pre_ping": True,
@@ -38,6 +40,37 @@ app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False  # Убирает warning
 
 db.init_app(app)
 
+
+@contextmanager
+def unit_of_work():
+    """Контекст приложения и сессия БД для одного обновления Telegram.
+
+    Если контекст уже открыт (middleware бота на время обработчика),
+    используется он и та же сессия; иначе открывается новый, как раньше
+    делал `with app.app_context()`.
+    """
+    if has_app_context():
+        try:
+            yield db.session
+        except Exception:
+            db.session.rollback()
+            raise
+        return
+
+    with app.app_context():
+        yield db.session
+
+
+def insert_ignore(model, index_elements: list, **values) -> int:
+    """INSERT ... ON CONFLICT DO NOTHING; 1 — строка вставлена, 0 — уже была"""
+    from sqlalchemy.dialects import postgresql, sqlite
+
+    dialect = db.session.get_bind().dialect.name
+    insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+    stmt = insert(model).values(**values).on_conflict_do_nothing(index_elements=index_elements)
+    return db.session.execute(stmt).rowcount
+
+
 # ───── DASHBOARD ROUTES ─────
 from admin_routes import *
 
@@ -45,4 +78,4 @@ from admin_routes import *
 with app.app_context():
     import models
     db.create_all()
-    logging.info(f"✅ База данных инициализирована: {db_path}")
+    logging.info(f"✅ База данных инициализирована: {db.engine.url.render_as_string(hide_password=True)}")
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""Бенчмарк сканирования QR-кодов квеста на локальном SQLite.
+
+Сравнивает быстрый путь (quest_tracker.scan_qr: пользователь, шаг и прогресс —
+одна транзакция) с прежней цепочкой запросов из /start → handle_quest_qr:
+поиск пользователя, список найденных шагов, регистрация шага, прогресс.
+Telegram не участвует — меряется только работа с базой.
+База — во временной папке, рабочая БД не трогается.
+
+Использование:
+  python bench_qr_scan.py [--users 500] [--scans 5000] [--threads 8] [--steps 9]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--users", type=int, default=500, help="участников квеста")
+parser.add_argument("--scans", type=int, default=5000, help="сканирований на каждый режим")
+parser.add_argument("--threads", type=int, default=8, help="одновременных обработчиков")
+parser.add_argument("--steps", type=int, default=9, help="шагов в квесте")
+args = parser.parse_args()
+
+# База задаётся до импорта модулей бота: app читает DATABASE_URL при импорте
+workdir = tempfile.mkdtemp(prefix="qr_bench_")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+
+import logging
+
+from app import app, db, unit_of_work
+from models import User, QuestProgress, QuestStep
+import quest_tracker
+
+logging.getLogger().setLevel(logging.ERROR)
+
+TELEGRAM_ID_BASE = 800000000
+
+
+def scan_fast(telegram_id: int, step: int) -> None:
+    quest_tracker.scan_qr(telegram_id, step, args.steps)
+
+
+def scan_split(telegram_id: int, step: int) -> None:
+    with unit_of_work():
+        user_id = User.query.filter_by(telegram_id=str(telegram_id)).first().id
+    quest_tracker.completed_steps(user_id, args.steps)
+    quest_tracker.register_step(user_id, step, args.steps)
+    quest_tracker.steps_found(user_id)
+    quest_tracker.completed_steps(user_id, args.steps)
+
+
+def reset_progress() -> None:
+    with app.app_context():
+        QuestStep.query.delete()
+        QuestProgress.query.delete()
+        db.session.commit()
+
+
+def run(scan, scans: list) -> tuple[float, int]:
+    """Прогнать сканирования в args.threads потоков; (секунды, ошибок)"""
+    position = iter(scans)
+    lock = threading.Lock()
+    errors = [0]
+
+    def worker():
+        while True:
+            with lock:
+                item = next(position, None)
+            if item is None:
+                return
+            try:
+                scan(*item)
+            except Exception:
+                with lock:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started, errors[0]
+
+
+def main():
+    with app.app_context():
+        db.session.add_all([User(telegram_id=str(TELEGRAM_ID_BASE + i), consent_given=True) for i in range(args.users)])
+        db.session.commit()
+
+    rng = random.Random(42)
+    scans = [(TELEGRAM_ID_BASE + rng.randrange(args.users), rng.randint(1, args.steps)) for _ in range(args.scans)]
+
+    print(f"Пользователей: {args.users}, сканирований: {args.scans}, потоков: {args.threads}, шагов: {args.steps}")
+    print(f"{'режим':<12} {'секунд':>8} {'скан/с':>9} {'ошибок':>7} {'завершили':>10}")
+    for name, scan in (("split", scan_split), ("scan_qr", scan_fast)):
+        reset_progress()
+        elapsed, errors = run(scan, scans)
+        with app.app_context():
+            completed = QuestProgress.query.filter_by(completed=True).count()
+        print(f"{name:<12} {elapsed:>8.2f} {args.scans / elapsed:>9.0f} {errors:>7} {completed:>10}")
+    print(f"Временные файлы: {workdir}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Микробенчмарк сборки стикера: старая сборка с диска против подготовленных слоёв.
+
+Старый путь включает и повторное декодирование/кодирование PNG перед сохранением
+на диск, как это делал generate_sticker_from_user_photo; новый кодирует файл один раз.
+
+Использование:
+  python bench_sticker_compose.py [количество стикеров]
+"""
+import io
+import os
+import sys
+import time
+
+from PIL import Image
+
+from sticker_compositor import StickerCompositor
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKGROUND_PATH = os.path.join(BASE_DIR, "img", "background.png")
+SHILDIK_PATH = os.path.join(BASE_DIR, "img", "shildik.png")
+PERSON_PATH = os.path.join(BASE_DIR, "img", "persona_example.png")
+
+
+def legacy_assemble(person_img: Image.Image) -> io.BytesIO:
+    """Прежняя assemble_sticker: слои открываются и масштабируются на каждый стикер"""
+    background = Image.open(BACKGROUND_PATH).convert("RGBA").resize((512, 512), Image.Resampling.LANCZOS)
+    shildik = Image.open(SHILDIK_PATH).convert("RGBA").resize((512, 512), Image.Resampling.LANCZOS)
+    if person_img.size != (320, 320):
+        person_img = person_img.resize((320, 320), Image.Resampling.LANCZOS)
+
+    x = (512 - person_img.width) // 2
+    y = (512 - person_img.height) // 2 - 30
+
+    result = background.copy()
+    result.paste(person_img, (x, y), person_img)
+    result.paste(shildik, (0, 0), shildik)
+
+    buf = io.BytesIO()
+    result.save(buf, format="PNG")
+    buf.seek(0)
+    return buf
+
+
+def legacy_output(person_img: Image.Image) -> io.BytesIO:
+    """Прежний выход: PNG в буфер, затем декодирование и повторное сохранение на диск"""
+    buf = legacy_assemble(person_img)
+    disk = io.BytesIO()
+    Image.open(buf).convert("RGBA").save(disk, format="PNG")
+    disk.seek(0)
+    return disk
+
+
+def load_person() -> Image.Image:
+    if os.path.exists(PERSON_PATH):
+        return Image.open(PERSON_PATH).convert("RGBA").resize((320, 320), Image.Resampling.LANCZOS)
+    return Image.new("RGBA", (320, 320), (200, 120, 60, 255))
+
+
+def measure(label: str, func, count: int) -> float:
+    started = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - started
+    print(f"{label:<40} {elapsed / count * 1000:8.2f} мс/стикер   ({count} шт. за {elapsed:.2f} с)")
+    return elapsed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    person = load_person()
+    compositor = StickerCompositor(BACKGROUND_PATH, SHILDIK_PATH)
+    compositor.warm_up()
+
+    legacy = measure("старая сборка (слои с диска, PNG x2)", lambda: [legacy_output(person) for _ in range(count)], count)
+    single = measure("подготовленные слои, compose_sticker", lambda: [compositor.compose_sticker(person) for _ in range(count)], count)
+    batch = measure("подготовленные слои, compose_many", lambda: compositor.compose_many([person] * count), count)
+    compose_only = measure("только наложение слоёв (без кодирования)", lambda: [compositor.compose(person) for _ in range(count)], count)
+
+    legacy_size = len(legacy_output(person).getvalue())
+    sticker_size = len(compositor.compose_sticker(person))
+
+    print()
+    print(f"Ускорение compose_sticker: x{legacy / single:.1f}")
+    print(f"Ускорение compose_many:    x{legacy / batch:.1f}")
+    print(f"Доля кодирования в compose_sticker: {(1 - compose_only / single) * 100:.0f}%")
+    print(f"Размер файла: PNG {legacy_size // 1024} КБ → WebP {sticker_size // 1024} КБ")
+
+
+if __name__ == "__main__":
+    main()
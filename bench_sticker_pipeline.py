@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""Сквозной бенчмарк генерации стикеров на одной машине.
+
+Очередь → fetch → stylize → bg_remove → compose → publish (создание стикерпака),
+модели заменены заглушкой (IMAGE_BACKEND=stub), Telegram — фейковым ботом.
+База и кеш результатов — во временной папке, рабочая БД не трогается.
+
+Использование:
+  python bench_sticker_pipeline.py [--jobs 100] [--workers 8] [--latency 2.0]
+                                   [--failure-rate 0] [--telegram-latency 0.05]
+
+Лимиты этапов задаются как в проде: STICKER_STYLIZE_CONCURRENCY и т.д.
+"""
+import argparse
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+import types as pytypes
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--jobs", type=int, default=100, help="сколько пользователей отправляют фото")
+parser.add_argument("--workers", type=int, default=8, help="воркеров очереди (STICKER_WORKERS)")
+parser.add_argument("--latency", type=float, default=2.0, help="задержка одного вызова модели, с")
+parser.add_argument("--failure-rate", type=float, default=0.0, help="доля вызовов модели с ошибкой")
+parser.add_argument("--telegram-latency", type=float, default=0.05, help="задержка одного запроса к Telegram, с")
+args = parser.parse_args()
+
+# Окружение задаётся до импорта модулей бота: они читают настройки при импорте
+workdir = tempfile.mkdtemp(prefix="sticker_bench_")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+os.environ["REPLICATE_CACHE_DIR"] = os.path.join(workdir, "replicate_cache")
+os.environ["IMAGE_BACKEND"] = "stub"
+os.environ["STUB_LATENCY"] = str(args.latency)
+os.environ["STUB_FAILURE_RATE"] = str(args.failure_rate)
+
+import logging
+
+from PIL import Image
+
+from app import app, db
+from models import User, StickerGeneration
+import sticker_generator
+from sticker_jobs import StickerJobQueue
+from sticker_packs import sticker_packs
+
+logging.getLogger().setLevel(logging.ERROR)
+sticker_generator.UPLOAD_DIR = os.path.join(workdir, "uploads")
+
+USER_ID_BASE = 900000000
+
+
+class FakeTelegram:
+    """Минимальный TeleBot: отвечает как Bot API, с задержкой на каждый запрос"""
+
+    token = "bench:token"
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self._lock = threading.Lock()
+        self.requests: dict[str, int] = {}
+        self.sticker_sets = set()
+
+    def _request(self, method: str) -> None:
+        with self._lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_me(self):
+        self._request("getMe")
+        return pytypes.SimpleNamespace(username="bench_bot", id=1)
+
+    def get_file(self, file_id):
+        self._request("getFile")
+        return pytypes.SimpleNamespace(file_path=f"photos/{file_id}.jpg")
+
+    def download_file(self, file_path):
+        self._request("downloadFile")
+        seed = sum(file_path.encode())
+        buf = io.BytesIO()
+        Image.new("RGB", (640, 640), (seed % 256, (seed * 7) % 256, (seed * 13) % 256)).save(buf, format="JPEG")
+        return buf.getvalue() + file_path.encode()
+
+    def send_message(self, chat_id, text, **kwargs):
+        self._request("sendMessage")
+
+    def send_photo(self, chat_id, photo, **kwargs):
+        self._request("sendPhoto")
+        return pytypes.SimpleNamespace(photo=[pytypes.SimpleNamespace(file_id=f"photo_{chat_id}")])
+
+    def send_sticker(self, chat_id, sticker, **kwargs):
+        self._request("sendSticker")
+        return pytypes.SimpleNamespace(sticker=pytypes.SimpleNamespace(file_id=f"sticker_{chat_id}"))
+
+    def upload_sticker_file(self, user_id, sticker=None, sticker_format=None):
+        self._request("uploadStickerFile")
+        return pytypes.SimpleNamespace(file_id=f"shared_{getattr(sticker, 'name', 'x')}")
+
+    def create_new_sticker_set(self, user_id, name, title, stickers, sticker_format=None):
+        self._request("createNewStickerSet")
+        self.sticker_sets.add(name)
+
+    def get_sticker_set(self, name):
+        self._request("getStickerSet")
+        if name in self.sticker_sets:
+            return pytypes.SimpleNamespace(stickers=[1])
+        raise Exception("Bad Request: STICKERSET_INVALID")
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    bot = FakeTelegram(args.telegram_latency)
+
+    with app.app_context():
+        db.session.add_all([User(telegram_id=str(USER_ID_BASE + i), first_name=f"Bench {i}") for i in range(args.jobs)])
+        db.session.commit()
+        user_ids = [u.id for u in User.query.order_by(User.id).all()]
+
+    sticker_packs.start(bot)
+    queue = StickerJobQueue(workers=args.workers)
+
+    started = time.perf_counter()
+    for i, user_id in enumerate(user_ids):
+        queue.submit(user_id, f"photo_{i}")
+    queue.start(bot)
+
+    while True:
+        with app.app_context():
+            done = StickerGeneration.query.filter(StickerGeneration.status.in_(('ok', 'failed'))).count()
+        if done >= args.jobs:
+            break
+        time.sleep(0.2)
+    elapsed = time.perf_counter() - started
+
+    with app.app_context():
+        jobs = StickerGeneration.query.all()
+        durations = [(j.finished_at - j.started_at).total_seconds() for j in jobs
+                     if j.status == 'ok' and j.started_at and j.finished_at]
+        ok = sum(1 for j in jobs if j.status == 'ok')
+        failed = sum(1 for j in jobs if j.status == 'failed')
+
+    print(f"Заданий: {args.jobs}, воркеров: {args.workers}, задержка модели {args.latency} с, "
+          f"ошибок модели {args.failure_rate:.0%}, задержка Telegram {args.telegram_latency} с")
+    print(f"Готово: {ok}, ошибок: {failed}, за {elapsed:.1f} с → {args.jobs / elapsed * 60:.1f} стикерпаков/мин")
+    print(f"Длительность задания: p50 {percentile(durations, 0.5):.2f} с, p95 {percentile(durations, 0.95):.2f} с")
+    print()
+    print(f"{'этап':<10} {'лимит':>6} {'готово':>7} {'ошибок':>7} {'повторов':>9} {'сред., с':>9}")
+    for name, stats in sticker_generator.pipeline_stats().items():
+        print(f"{name:<10} {stats['limit']:>6} {stats['completed']:>7} {stats['failed']:>7} "
+              f"{stats['retries']:>9} {stats['avg_seconds'] or 0:>9.2f}")
+    print()
+    print("Запросы к Telegram: " + ", ".join(f"{k}={v}" for k, v in sorted(bot.requests.items())))
+    print(f"Временные файлы: {workdir}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,30 +1,36 @@
 import os
-import io
+import html
 import time
-import json
 import threading
-import queue
 import logging
 
 from datetime import datetime
 from uuid import uuid4
 from typing import Optional
 
-from PIL import Image
 import telebot
 from telebot import types
+from telebot.handler_backends import BaseMiddleware
 
-from app import app, db
-from models import User, Registration, QuestProgress, StickerGeneration, DanceSlot, SurveyAnswer, SystemConfig, UserFeedback, ScheduledMessage
+from app import app, db, unit_of_work
+from models import User, StickerGeneration, SurveyAnswer, SystemConfig, UserFeedback, ScheduledMessage
 from text import (
     CONSENT_TEXT, SURVEY_QUESTIONS, MAIN_MENU_TEXT, MAIN_MENU_TEXT_NO_THANKS,
     DANCE_INTRO, DANCE_CHOOSE_SLOT, DANCE_CONFIRMATION, DANCE_FULL_MESSAGE, DANCE_ALL_FULL,
     WORKSHOP_TEXT, FOREST_TEXT_1, FOREST_TEXT_2, STICKER_START_MESSAGE, CAREER_MESSAGE,
     SCHEDULE_MESSAGE, MAP_TEXT, IMG_DIR, MAP_PATH, MAP_SENT_PATH, MAP_FOREST_PATH,
-    MASTER_PATH, QUEST_PATH, DANCE_PATH, FOREST_PATH
+    MASTER_PATH, QUEST_PATH, DANCE_PATH, FOREST_PATH, WELCOME_VIDEO_PATH
 )
 from text_cache import text_cache
-from sticker_generator import generate_sticker_from_user_photo
+from ttl_cache import TTLCache
+from sticker_jobs import sticker_jobs
+from sticker_packs import sticker_packs
+import quest_tracker
+import dance_booking
+from quest_leaderboard import quest_leaderboard
+from broadcast_engine import broadcast_engine
+from media_registry import media_registry
+from handler_stats import handler_stats
 
 # ═══════════════════════════════════════════════════════════════════════════════
 #                                ИНИЦИАЛИЗАЦИЯ
@@ -34,8 +40,7 @@ def get_bot_token():
     """Получить токен бота из конфигурации или переменных окружения"""
     try:
         from models import SystemConfig
-        from app import app
-        with app.app_context():
+        with unit_of_work():
             # Сначала проверяем токен из базы данных
             db_token = SystemConfig.get_config('BOT_TOKEN')
             if db_token:
@@ -49,12 +54,38 @@ def get_bot_token():
         raise ValueError("BOT_TOKEN is not defined in environment variables or database")
     return env_token
 
+class UnitOfWorkMiddleware(BaseMiddleware):
+    """Один контекст приложения и одна сессия БД на всё время обработчика.
+
+    Хелперы внутри обработчика вызывают unit_of_work() и переиспользуют
+    этот контекст вместо того, чтобы открывать свой.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.update_types = ['message', 'callback_query']
+
+    def pre_process(self, message, data):
+        ctx = app.app_context()
+        ctx.push()
+        data['app_context'] = ctx
+
+    def post_process(self, message, data, exception):
+        ctx = data.pop('app_context', None)
+        if ctx is None:
+            return
+        try:
+            if exception is not None:
+                db.session.rollback()
+        finally:
+            ctx.pop()
+
 BOT_TOKEN = get_bot_token()
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML")
+bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML", use_class_middlewares=True)
+bot.setup_middleware(UnitOfWorkMiddleware())
 
 # Глобальные переменные для состояний
 user_states: dict[int, str] = {}
-sticker_queue = queue.Queue(maxsize=50)
 
 # Защита от дублирования callback_query
 last_callback_query: dict[int, float] = {}
@@ -73,79 +104,45 @@ def is_duplicate_callback(user_id: int) -> bool:
 #                                КЕШИРОВАНИЕ
 # ═══════════════════════════════════════════════════════════════════════════════
 
-cache = {}
 CACHE_TTL = 300  # 5 минут
+CACHE_MAXSIZE = 20000  # ключи вида user_id_{chat_id}
+
+cache = TTLCache(maxsize=CACHE_MAXSIZE, ttl=CACHE_TTL, name="bot")
 
 def get_cached_or_compute(key, compute_func, ttl=CACHE_TTL):
-    """Получить данные из кеша или вычислить"""
-    now = time.time()
-    if key in cache:
-        value, timestamp = cache[key]
-        if now - timestamp < ttl:
-            return value
-
-    # Вычисляем и кешируем
-    value = compute_func()
-    cache[key] = (value, now)
-    return value
-
-def clear_old_cache():
-    """Очистка устаревших записей кеша"""
-    now = time.time()
-    to_remove = []
-    for key, (value, timestamp) in cache.items():
-        if now - timestamp > CACHE_TTL:
-            to_remove.append(key)
-    for key in to_remove:
-        del cache[key]
+    """Получить данные из кеша или вычислить (одно вычисление на ключ при параллельных запросах)"""
+    return cache.get_or_compute(key, compute_func, ttl=ttl)
 
 def get_cached_text(key: str, default: str = "") -> str:
-    """Получает текст из кеша, если нет - из базы, если нет - возвращает default."""
-    cache_key = f"text_{key}"
-    def compute_text():
-        config_text = get_text_from_config(key, default)
-        return config_text if config_text else default
-    return get_cached_or_compute(cache_key, compute_text)
-
-# Очистка кеша каждые 10 минут
-def cache_cleaner():
-    while True:
-        time.sleep(600)  # 10 минут
-        clear_old_cache()
-
-threading.Thread(target=cache_cleaner, daemon=True).start()
+    """Получает текст из общего кеша настроек, если нет - возвращает default."""
+    return get_text_from_config(key, default) or default
 
 # ═══════════════════════════════════════════════════════════════════════════════
 #                                УТИЛИТЫ
 # ═══════════════════════════════════════════════════════════════════════════════
 
 def get_text_from_config(key, default_fallback=None):
-    """Получить текст из конфигурации с fallback на text.py"""
-    with app.app_context():
-        config_text = SystemConfig.get_config(key)
-        if config_text:
-            return config_text
-
-        # Fallback на text.py
-        if default_fallback:
-            return default_fallback
+    """Получить текст из конфигурации (text_cache) с fallback на text.py"""
+    config_text = text_cache.get_text(key)
+    if config_text:
+        return config_text
 
-        try:
-            import text
-            return getattr(text, key, '')
-        except:
-            return ''
+    # Fallback на text.py
+    if default_fallback:
+        return default_fallback
 
-def get_dance_slots_from_cache():
-    """Получить слоты танцев из кеша"""
-    return text_cache.get_dance_slots()
+    try:
+        import text
+        return getattr(text, key, '')
+    except:
+        return ''
 
 def get_user_id(chat_id: int) -> Optional[int]:
     """Получить ID пользователя с кешированием"""
     cache_key = f"user_id_{chat_id}"
 
     def compute_user_id():
-        with app.app_context():
+        with unit_of_work():
             user = User.query.filter_by(telegram_id=str(chat_id)).first()
             if not user:
                 user = User(telegram_id=str(chat_id), consent_given=False)
@@ -163,25 +160,34 @@ def get_user_id(chat_id: int) -> Optional[int]:
 
     return get_cached_or_compute(cache_key, compute_user_id, ttl=1800)  # Увеличиваем TTL до 30 минут
 
+def forget_user_id(chat_id: int) -> None:
+    """Убрать закешированный users.id (после удаления или сброса пользователя в админке)"""
+    cache.invalidate(f"user_id_{int(chat_id)}")
+
 def send_img_scaled(chat_id: int, path: str, caption: str = "", kb=None, max_px: int = 700) -> None:
-    """Отправка изображения с масштабированием"""
+    """Отправка изображения с масштабированием (рендер и загрузка — один раз, дальше по file_id)"""
     if not os.path.exists(path):
         bot.send_message(chat_id, "⚠️ Изображение недоступно.")
         return
     try:
-        with Image.open(path) as img:
-            w, h = img.size
-            scale = max(w, h) / max_px
-            if scale > 1:
-                img = img.resize((int(w / scale), int(h / scale)), Image.Resampling.LANCZOS)
-            buf = io.BytesIO()
-            img.save(buf, format="PNG")
-            buf.seek(0)
-            bot.send_photo(chat_id, buf, caption=caption, reply_markup=kb)
+        media_registry.send_scaled_photo(bot, chat_id, path, max_px=max_px, caption=caption, reply_markup=kb)
     except Exception as e:
         print(f"Error in send_img_scaled: {e}")
         bot.send_message(chat_id, "⚠️ Не удалось загрузить изображение.")
 
+def prerender_menu_images() -> None:
+    """Подготовить изображения меню и квеста при старте"""
+    paths = [MAP_PATH, FOREST_PATH, MASTER_PATH, DANCE_PATH, QUEST_PATH]
+    for step in range(get_quest_total_steps() + 1):
+        _, image = get_quest_hint(step)
+        if image:
+            paths.append(image)
+    media_registry.prerender(paths)
+
+    # Хеш приветственного видео считаем заранее, чтобы первый /start не читал файл целиком
+    if os.path.exists(WELCOME_VIDEO_PATH):
+        media_registry.content_hash(WELCOME_VIDEO_PATH)
+
 # ═══════════════════════════════════════════════════════════════════════════════
 #                                КЛАВИАТУРЫ
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -231,75 +237,31 @@ def get_quest_total_steps() -> int:
     """Получить общее количество шагов квеста"""
     return text_cache.get_quest_total_steps()
 
-def get_quest_progress(user_id: int) -> str:
-    """Получить прогресс квеста пользователя"""
+def format_quest_progress(found: int) -> str:
+    """Текст прогресса квеста по числу найденных шагов"""
     quest_total = get_quest_total_steps()
+    return f"Стикеров найдено: {min(found, quest_total)} из {quest_total}"
 
-    with app.app_context():
-        progress = db.session.query(QuestProgress).filter_by(user_id=user_id).first()
-        if not progress:
-            progress = QuestProgress(user_id=user_id, completed_steps="[]")
-            db.session.add(progress)
-            db.session.commit()
-
-        try:
-            steps_data = json.loads(progress.completed_steps or "[]")
-            if isinstance(steps_data, list):
-                valid_steps = [step for step in steps_data if isinstance(step, int) and 1 <= step <= quest_total]
-                count = len(valid_steps)
-            else:
-                count = 0
-        except (json.JSONDecodeError, TypeError):
-            count = 0
-
-        return f"Стикеров найдено: {count} из {quest_total}"
+def get_quest_progress(user_id: int, found: Optional[int] = None) -> str:
+    """Получить прогресс квеста пользователя"""
+    if found is None:
+        found = quest_tracker.steps_found(user_id)
+    return format_quest_progress(found)
 
-def register_quest_step(user_id: int, step: int) -> None:
-    """Регистрация шага квеста"""
+def register_quest_step(user_id: int, step: int) -> tuple[bool, int, bool]:
+    """Регистрация шага квеста: (шаг новый, найдено шагов, квест завершён этим шагом)"""
     quest_total = get_quest_total_steps()
+    if not 1 <= step <= quest_total:
+        return False, quest_tracker.steps_found(user_id), False
 
-    with app.app_context():
-        progress = QuestProgress.query.filter_by(user_id=user_id).first()
-        if not progress:
-            progress = QuestProgress(user_id=user_id, completed_steps="[]")
-            db.session.add(progress)
-
-        try:
-            steps = json.loads(progress.completed_steps or "[]")
-            if not isinstance(steps, list):
-                steps = []
-
-            valid_steps = [s for s in steps if isinstance(s, int) and 1 <= s <= quest_total]
-
-            if step not in valid_steps and 1 <= step <= quest_total:
-                valid_steps.append(step)
-                valid_steps.sort()
-                progress.completed_steps = json.dumps(valid_steps)
-
-                if len(valid_steps) == quest_total:
-                    progress.completed = True
-                    progress.completed_at = datetime.utcnow()
-
-                db.session.commit()
-                print(f"Quest step {step} registered for user {user_id}. Total steps: {len(valid_steps)}")
-        except (json.JSONDecodeError, TypeError) as e:
-            print(f"Error processing quest steps for user {user_id}: {e}")
-            progress.completed_steps = json.dumps([step])
-            db.session.commit()
+    is_new, found, just_completed = quest_tracker.register_step(user_id, step, quest_total)
+    if is_new:
+        print(f"Quest step {step} registered for user {user_id}. Total steps: {found}")
+    return is_new, found, just_completed
 
 def user_quest_completed_steps(user_id: int) -> list:
     """Получить завершенные шаги квеста"""
-    quest_total = get_quest_total_steps()
-
-    with app.app_context():
-        progress = QuestProgress.query.filter_by(user_id=user_id).first()
-        if not progress:
-            return []
-        try:
-            steps = json.loads(progress.completed_steps or "[]")
-            return [s for s in steps if isinstance(s, int) and 1 <= s <= quest_total]
-        except (json.JSONDecodeError, TypeError):
-            return []
+    return quest_tracker.completed_steps(user_id, get_quest_total_steps())
 
 def next_quest_step_for_user(user_id: int) -> Optional[int]:
     """Получить следующий шаг квеста для пользователя"""
@@ -325,6 +287,35 @@ def format_quest_text(text: str) -> str:
 
     return formatted_text
 
+def send_quest_scan_result(chat_id: int, step: int, is_new: bool, found: int, just_completed: bool) -> None:
+    """Ответ на сканирование QR-кода квеста (картинка шага уходит по file_id)"""
+    if not is_new:
+        bot.send_message(chat_id, f"✅ Этот стикер уже найден! {format_quest_progress(found)}")
+        return
+
+    progress_text = format_quest_progress(found)
+    kb = types.InlineKeyboardMarkup(row_width=2)
+    kb.add(
+        types.InlineKeyboardButton("🔍 К подсказкам", callback_data="quest_hints"),
+        types.InlineKeyboardButton("⬅️ Главное меню", callback_data="main")
+    )
+
+    # Отправляем изображение найденного стикера
+    _, sticker_path = get_quest_hint(step)
+    if sticker_path and os.path.exists(sticker_path):
+        send_img_scaled(chat_id, sticker_path, caption=f"✅ Стикер найден!\n\n{progress_text}", kb=kb)
+    else:
+        bot.send_message(chat_id, f"✅ Стикер найден!\n\n{progress_text}", reply_markup=kb)
+
+    # Квест завершён именно этим сканированием
+    if just_completed:
+        bot.send_message(
+            chat_id, 
+            f"🎉 Поздравляем! Ты нашел все стикеры квеста!\n\n"
+            f"Приходи в лаунж Avito Team за призом! 🏆",
+            reply_markup=inline_back_to_menu()
+        )
+
 def handle_quest_qr(chat_id: int, user_id: int, step: int) -> None:
     """Обработка QR-кода квеста"""
     try:
@@ -334,48 +325,34 @@ def handle_quest_qr(chat_id: int, user_id: int, step: int) -> None:
             bot.send_message(chat_id, "⚠️ Неверный шаг квеста.")
             return
 
-        # Проверяем, не найден ли уже этот шаг
-        completed_steps = user_quest_completed_steps(user_id)
-        if step in completed_steps:
-            bot.send_message(chat_id, f"✅ Этот стикер уже найден! {get_quest_progress(user_id)}")
-            return
-
-        # Регистрируем шаг
-        register_quest_step(user_id, step)
+        # Регистрируем шаг (повторное сканирование ничего не меняет)
+        is_new, found, just_completed = register_quest_step(user_id, step)
+        send_quest_scan_result(chat_id, step, is_new, found, just_completed)
 
-        # Получаем изображение для найденного шага
-        _, sticker_path = get_quest_hint(step)
-        progress_text = get_quest_progress(user_id)
+    except Exception as e:
+        print(f"Error in handle_quest_qr: {e}")
+        bot.send_message(chat_id, "⚠️ Ошибка при обработке QR-кода.")
 
-        # Отправляем изображение найденного стикера
-        if sticker_path and os.path.exists(sticker_path):
-            kb = types.InlineKeyboardMarkup(row_width=2)
-            kb.add(
-                types.InlineKeyboardButton("🔍 К подсказкам", callback_data="quest_hints"),
-                types.InlineKeyboardButton("⬅️ Главное меню", callback_data="main")
-            )
-            send_img_scaled(chat_id, sticker_path, caption=f"✅ Стикер найден!\n\n{progress_text}", kb=kb)
-        else:
-            kb = types.InlineKeyboardMarkup(row_width=2)
-            kb.add(
-                types.InlineKeyboardButton("🔍 К подсказкам", callback_data="quest_hints"),
-                types.InlineKeyboardButton("⬅️ Главное меню", callback_data="main")
-            )
-            bot.send_message(chat_id, f"✅ Стикер найден!\n\n{progress_text}", reply_markup=kb)
+def handle_quest_scan(chat_id: int, step: int) -> bool:
+    """Быстрый путь QR-кода из /start: пользователь, шаг и прогресс — одной транзакцией.
 
-        # Проверяем, завершен ли квест
-        new_completed_steps = user_quest_completed_steps(user_id)
-        if len(new_completed_steps) == quest_total:
-            bot.send_message(
-                chat_id, 
-                f"🎉 Поздравляем! Ты нашел все стикеры квеста!\n\n"
-                f"Приходи в лаунж Avito Team за призом! 🏆",
-                reply_markup=inline_back_to_menu()
-            )
+    False — пользователь ещё не дал согласие: скан обрабатывается обычным /start.
+    """
+    try:
+        result = quest_tracker.scan_qr(chat_id, step, get_quest_total_steps())
+        if result is None:
+            return False
+        if not result.valid_step:
+            bot.send_message(chat_id, "⚠️ Неверный шаг квеста.")
+            return True
 
+        if result.is_new:
+            print(f"Quest step {step} registered for user {result.user_id}. Total steps: {result.found}")
+        send_quest_scan_result(chat_id, step, result.is_new, result.found, result.just_completed)
     except Exception as e:
-        print(f"Error in handle_quest_qr: {e}")
+        print(f"Error in handle_quest_scan: {e}")
         bot.send_message(chat_id, "⚠️ Ошибка при обработке QR-кода.")
+    return True
 
 # ═══════════════════════════════════════════════════════════════════════════════
 #                                ОТЛОЖЕННЫЕ СООБЩЕНИЯ
@@ -385,7 +362,7 @@ def scheduled_sender() -> None:
     """Отправка отложенных сообщений"""
     while True:
         try:
-            with app.app_context():
+            with unit_of_work():
                 now = datetime.utcnow()
                 pending = ScheduledMessage.query.filter(
                     ScheduledMessage.scheduled_time <= now,
@@ -400,9 +377,13 @@ def scheduled_sender() -> None:
 
                         if msg.photo_url:
                             photo_path = msg.photo_url.lstrip('/')
-                            if os.path.exists(photo_path):
-                                with open(photo_path, 'rb') as photo:
-                                    bot.send_photo(msg.chat_id, photo, caption=message_text)
+                            if msg.photo_file_id:
+                                bot.send_photo(msg.chat_id, msg.photo_file_id, caption=message_text)
+                            elif os.path.exists(photo_path):
+                                # Фото загружается один раз, остальные получатели получают его по file_id
+                                sent = media_registry.send_photo(bot, msg.chat_id, photo_path, caption=message_text)
+                                if sent and sent.photo:
+                                    msg.photo_file_id = sent.photo[-1].file_id
                             else:
                                 bot.send_message(msg.chat_id, message_text)
                         else:
@@ -422,6 +403,18 @@ def scheduled_sender() -> None:
 
 threading.Thread(target=scheduled_sender, daemon=True).start()
 
+# Фоновые рассылки из админки (продолжает незавершённые после перезапуска)
+broadcast_engine.start(bot)
+
+# Индекс готовых стикерпаков и фоновая сверка с Telegram
+sticker_packs.start(bot)
+
+# Очередь генерации стикеров (возвращает прерванные задания после перезапуска)
+sticker_jobs.start(bot)
+
+# Изображения меню масштабируются заранее, а не на каждый показ
+threading.Thread(target=prerender_menu_images, daemon=True).start()
+
 # ═══════════════════════════════════════════════════════════════════════════════
 #                                КОМАНДА START
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -439,7 +432,7 @@ def handle_webhook_status(message: types.Message) -> None:
         return
     
     try:
-        with app.app_context():
+        with unit_of_work():
             from models import SystemConfig
             bot_mode = SystemConfig.get_config('BOT_MODE', 'polling')
             webhook_domain = SystemConfig.get_config('WEBHOOK_DOMAIN', '')
@@ -469,27 +462,21 @@ def handle_start(message: types.Message) -> None:
     payload = message.text.split(maxsplit=1)[1].strip().lower() if len(message.text.split()) > 1 else None
     print(f"[start] chat_id={chat_id}, payload={payload}")
 
-    with app.app_context():
+    # QR-код квеста от пользователя, уже прошедшего согласие, — без общего сценария /start
+    if payload and payload.startswith("q") and payload[1:].isdigit():
+        if handle_quest_scan(chat_id, int(payload[1:])):
+            return
+
+    with unit_of_work():
         user = User.query.filter_by(telegram_id=str(chat_id)).first()
         
         # Для существующих пользователей с согласием и завершенным опросом
         if user and user.consent_given and user.survey_completed:
             print(f"[start] Существующий пользователь с завершенными этапами: {chat_id}")
             
-            # Обработка QR-кода квеста для авторизованных пользователей
-            if payload and payload.startswith("q") and payload[1:].isdigit():
-                try:
-                    step = int(payload[1:])
-                    handle_quest_qr(chat_id, user.id, step)
-                    return
-                except ValueError:
-                    bot.send_message(chat_id, "⚠️ Ошибка обработки QR-кода.")
-                    return
-            
             # Отправка только видео и главного меню
             try:
-                with open("circle.mp4", "rb") as f:
-                    bot.send_video_note(chat_id, f)
+                media_registry.send_video_note(bot, chat_id, WELCOME_VIDEO_PATH)
             except Exception as e:
                 print(f"[start] Ошибка отправки видео: {e}")
             
@@ -510,16 +497,7 @@ def handle_start(message: types.Message) -> None:
             db.session.commit()
             print(f"[start] Новый пользователь: {chat_id}")
 
-        # Обработка QR-кода квеста для неавторизованных пользователей
-        if user.consent_given and payload and payload.startswith("q") and payload[1:].isdigit():
-            try:
-                step = int(payload[1:])
-                handle_quest_qr(chat_id, user.id, step)
-                return
-            except ValueError:
-                bot.send_message(chat_id, "⚠️ Ошибка обработки QR-кода.")
-                return
-
+        # QR-код до согласия: шаг запоминается в состоянии пользователя
         if payload and payload.startswith("q") and payload[1:].isdigit():
             user_states[chat_id] = f"qr_step|{payload[1:]}"
         else:
@@ -527,8 +505,7 @@ def handle_start(message: types.Message) -> None:
 
     # Отправка приветственного видео для новых пользователей
     try:
-        with open("circle.mp4", "rb") as f:
-            bot.send_video_note(chat_id, f)
+        media_registry.send_video_note(bot, chat_id, WELCOME_VIDEO_PATH)
     except Exception as e:
         print(f"[start] Ошибка отправки видео: {e}")
         bot.send_message(chat_id, "⚠️ Видео не найдено, продолжаем...")
@@ -555,7 +532,7 @@ def handle_start_continue(call: types.CallbackQuery) -> None:
 def handle_consent_and_start_survey(call: types.CallbackQuery) -> None:
     """Обработка согласия и запуск опроса"""
     chat_id = call.message.chat.id
-    with app.app_context():
+    with unit_of_work():
         user = User.query.filter_by(telegram_id=str(chat_id)).first()
         if not user:
             bot.send_message(chat_id, "⚠️ Ошибка: пользователь не найден.")
@@ -588,7 +565,7 @@ def handle_consent_and_start_survey(call: types.CallbackQuery) -> None:
 def start_survey(chat_id: int, user_id: int) -> None:
     """Запуск опроса"""
     try:
-        with app.app_context():
+        with unit_of_work():
             user = User.query.filter_by(telegram_id=str(chat_id)).first()
             if user and user.survey_completed:
                 print(f"[start_survey] Опрос уже завершен для chat_id: {chat_id}")
@@ -616,7 +593,7 @@ def handle_feedback_answer(message: types.Message, user: User, state: str) -> No
     question_id = state.split("|")[1]
 
     try:
-        with app.app_context():
+        with unit_of_work():
             if question_id == "activity_rating":
                 # Проверяем что ответ - число от 1 до 10
                 try:
@@ -692,7 +669,7 @@ def handle_feedback_team_knowledge(call: types.CallbackQuery) -> None:
     """Обработка ответа на вопрос о знании команды"""
     chat_id = call.message.chat.id
 
-    with app.app_context():
+    with unit_of_work():
         user = User.query.filter_by(telegram_id=str(chat_id)).first()
         if not user:
             bot.answer_callback_query(call.id, "Ошибка: пользователь не найден.")
@@ -765,7 +742,7 @@ def handle_survey_response(message: types.Message) -> None:
             bot.send_message(chat_id, "Ответ слишком длинный. Пожалуйста, сократи до 200 символов.")
             return
 
-        with app.app_context():
+        with unit_of_work():
             user = User.query.filter_by(telegram_id=str(chat_id)).first()
             if not user:
                 bot.send_message(chat_id, "⚠️ Ошибка: пользователь не найден.")
@@ -813,7 +790,7 @@ def handle_survey_response(message: types.Message) -> None:
     except Exception as e:
         print(f"[handle_survey_response] Ошибка: {e}")
         try:
-            with app.app_context():
+            with unit_of_work():
                 db.session.rollback()
         except:
             pass
@@ -824,7 +801,7 @@ def handle_special_states(message: types.Message) -> None:
     chat_id = message.chat.id
     state = user_states.get(chat_id)
 
-    with app.app_context():
+    with unit_of_work():
         user = User.query.filter_by(telegram_id=str(chat_id)).first()
 
         if not user:
@@ -854,7 +831,7 @@ def handle_vacancy_response(call: types.CallbackQuery) -> None:
         return
     
     try:
-        with app.app_context():
+        with unit_of_work():
             user = User.query.filter_by(telegram_id=str(chat_id)).first()
             if not user:
                 bot.send_message(chat_id, "⚠️ Ошибка: пользователь не найден.")
@@ -1060,7 +1037,7 @@ def handle_dance_show_slots(call: types.CallbackQuery) -> None:
     """Показать слоты для записи на танцы"""
     chat_id = call.message.chat.id
     try:
-        dance_slots = get_dance_slots_from_cache()
+        dance_slots = dance_booking.availability()
 
         if not dance_slots:
             bot.send_message(chat_id, "❌ Слоты для танцев пока не настроены.", reply_markup=inline_back_to_menu())
@@ -1069,27 +1046,25 @@ def handle_dance_show_slots(call: types.CallbackQuery) -> None:
 
         dance_choose_slot = get_cached_text('DANCE_CHOOSE_SLOT', DANCE_CHOOSE_SLOT)
 
-        # Получаем все регистрации одним запросом
-        with app.app_context():
-            registrations_count = {}
-            all_registrations = Registration.query.filter_by(activity_type='dance').all()
-            for reg in all_registrations:
-                key = f"{reg.day}|{reg.time_slot}"
-                registrations_count[key] = registrations_count.get(key, 0) + 1
+        booked, waiting = dance_booking.user_bookings(get_user_id(chat_id))
 
         kb = types.InlineKeyboardMarkup(row_width=1)
         for slot in dance_slots:
-            key = f"{slot['day']}|{slot['time_slot']}"
-            current_registrations = registrations_count.get(key, 0)
-            max_participants = slot.get('max_participants', 10)
-            available_spots = max_participants - current_registrations
-
-            if available_spots > 0:
-                button_text = f"{slot['day']} {slot['time_slot']} (свободно: {available_spots})"
-                callback_data = f"dance_register|{slot['day']}|{slot['time_slot']}"
+            key = (slot.day, slot.time_slot)
+            label = f"{slot.day} {slot.time_slot}"
+
+            if key in booked:
+                button_text = f"✅ {label} — отменить запись"
+                callback_data = f"dance_cancel|{slot.day}|{slot.time_slot}"
+            elif key in waiting:
+                button_text = f"⏳ {label} — ты {waiting[key]}-й в очереди, выйти"
+                callback_data = f"dance_unwait|{slot.day}|{slot.time_slot}"
+            elif slot.free > 0:
+                button_text = f"{label} (свободно: {slot.free})"
+                callback_data = f"dance_register|{slot.day}|{slot.time_slot}"
             else:
-                button_text = f"{slot['day']} {slot['time_slot']} (мест нет)"
-                callback_data = f"dance_full|{slot['day']}|{slot['time_slot']}"
+                button_text = f"{label} (мест нет — в лист ожидания)"
+                callback_data = f"dance_wait|{slot.day}|{slot.time_slot}"
 
             kb.add(types.InlineKeyboardButton(button_text, callback_data=callback_data))
 
@@ -1106,57 +1081,97 @@ def handle_dance_show_slots(call: types.CallbackQuery) -> None:
         bot.answer_callback_query(call.id)
         print(f"Error in handle_dance_show_slots: {e}")
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("dance_register|"))
+def inline_dance_booked(day: str, time_slot: str) -> types.InlineKeyboardMarkup:
+    """Отмена записи и главное меню"""
+    kb = types.InlineKeyboardMarkup(row_width=1)
+    kb.add(
+        types.InlineKeyboardButton("❌ Отменить запись", callback_data=f"dance_cancel|{day}|{time_slot}"),
+        types.InlineKeyboardButton("⬅️ Главное меню", callback_data="main")
+    )
+    return kb
+
+def notify_dance_promotions(promotions: list) -> None:
+    """Сообщить участникам из листа ожидания, что они записаны на освободившееся место"""
+    for promotion in promotions:
+        try:
+            confirmation_text = get_cached_text('DANCE_CONFIRMATION', DANCE_CONFIRMATION).format(
+                slot=f"{promotion.day} {promotion.time_slot}")
+            bot.send_message(
+                int(promotion.telegram_id),
+                f"🎉 Освободилось место — ты в списке!\n\n{confirmation_text}",
+                reply_markup=inline_dance_booked(promotion.day, promotion.time_slot)
+            )
+        except Exception as e:
+            print(f"Error notifying waitlisted user {promotion.telegram_id}: {e}")
+
+@bot.callback_query_handler(func=lambda c: c.data.startswith(("dance_register|", "dance_wait|", "dance_full|")))
 def handle_dance_registration(call: types.CallbackQuery) -> None:
-    """Регистрация на танцы"""
+    """Регистрация на танцы (если мест нет — лист ожидания)"""
     chat_id = call.message.chat.id
     try:
-        _, day, time_slot = call.data.split("|")
-        user_id = get_user_id(chat_id)
-
-        with app.app_context():
-            existing = Registration.query.filter_by(
-                user_id=user_id,
-                activity_type='dance',
-                day=day,
-                time_slot=time_slot
-            ).first()
-
-            if existing:
-                bot.answer_callback_query(call.id, "Вы уже записаны на этот слот!")
-                return
-
-            current_count = Registration.query.filter_by(
-                activity_type='dance',
-                day=day,
-                time_slot=time_slot
-            ).count()
-
-            from models import DanceSlot
-            slot = DanceSlot.query.filter_by(day=day, time_slot=time_slot).first()
-            max_participants = slot.max_participants if slot else 10
-
-            if current_count >= max_participants:
-                bot.answer_callback_query(call.id, "Места закончились!")
-                return
-
-            registration = Registration(
-                user_id=user_id,
-                activity_type='dance',
-                day=day,
-                time_slot=time_slot
-            )
-            db.session.add(registration)
-            db.session.commit()
+        action, day, time_slot = call.data.split("|")
+        result = dance_booking.book(get_user_id(chat_id), day, time_slot, waitlist=action != "dance_register")
 
+        if result.status == 'booked':
             confirmation_text = get_cached_text('DANCE_CONFIRMATION', DANCE_CONFIRMATION).format(slot=f"{day} {time_slot}")
             bot.answer_callback_query(call.id, "Успешно записаны!")
-            bot.send_message(chat_id, confirmation_text, reply_markup=inline_back_to_menu())
+            bot.send_message(chat_id, confirmation_text, reply_markup=inline_dance_booked(day, time_slot))
+        elif result.status == 'already':
+            bot.answer_callback_query(call.id, "Вы уже записаны на этот слот!")
+        elif result.status == 'waitlisted':
+            bot.answer_callback_query(call.id, "Вы в листе ожидания")
+            kb = types.InlineKeyboardMarkup(row_width=1)
+            kb.add(
+                types.InlineKeyboardButton("🚪 Выйти из очереди", callback_data=f"dance_unwait|{day}|{time_slot}"),
+                types.InlineKeyboardButton("⬅️ Главное меню", callback_data="main")
+            )
+            bot.send_message(
+                chat_id,
+                f"⏳ Мест на {day} {time_slot} нет, ты {result.position}-й в листе ожидания.\n"
+                f"Если кто-то отменит запись, мы запишем тебя автоматически и пришлём сообщение.",
+                reply_markup=kb
+            )
+        elif result.status == 'full':
+            bot.answer_callback_query(call.id, "Места закончились!")
+        else:
+            bot.answer_callback_query(call.id, "Слот недоступен")
 
     except Exception as e:
         print(f"Error in dance registration: {e}")
         bot.answer_callback_query(call.id, "Ошибка регистрации")
 
+@bot.callback_query_handler(func=lambda c: c.data.startswith("dance_cancel|"))
+def handle_dance_cancel(call: types.CallbackQuery) -> None:
+    """Отмена записи на танцы; место получает первый из листа ожидания"""
+    chat_id = call.message.chat.id
+    try:
+        _, day, time_slot = call.data.split("|")
+        cancelled, promotions = dance_booking.cancel(get_user_id(chat_id), day, time_slot)
+        if not cancelled:
+            bot.answer_callback_query(call.id, "Записи на этот слот нет")
+            return
+
+        bot.answer_callback_query(call.id, "Запись отменена")
+        bot.send_message(chat_id, f"❌ Запись на {day} {time_slot} отменена.", reply_markup=inline_back_to_menu())
+        notify_dance_promotions(promotions)
+    except Exception as e:
+        print(f"Error in dance cancel: {e}")
+        bot.answer_callback_query(call.id, "Ошибка отмены")
+
+@bot.callback_query_handler(func=lambda c: c.data.startswith("dance_unwait|"))
+def handle_dance_leave_waitlist(call: types.CallbackQuery) -> None:
+    """Выход из листа ожидания"""
+    chat_id = call.message.chat.id
+    try:
+        _, day, time_slot = call.data.split("|")
+        if dance_booking.leave_waitlist(get_user_id(chat_id), day, time_slot):
+            bot.answer_callback_query(call.id, "Ты вышел из листа ожидания")
+        else:
+            bot.answer_callback_query(call.id, "Тебя нет в листе ожидания")
+    except Exception as e:
+        print(f"Error leaving dance waitlist: {e}")
+        bot.answer_callback_query(call.id, "Ошибка")
+
 # ═══════════════════════════════════════════════════════════════════════════════
 #                                СТИКЕРЫ
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -1167,72 +1182,39 @@ def handle_sticker(call: types.CallbackQuery) -> None:
     chat_id = call.message.chat.id
     user_id = get_user_id(chat_id)
 
-    with app.app_context():
-        # Ищем любой успешный стикерпак пользователя
-        sticker_gen = StickerGeneration.query.filter_by(user_id=user_id, status='ok').first()
+    # Готовый стикерпак — из индекса, без запросов к БД и Telegram
+    pack_url = sticker_packs.get(chat_id)
+    if pack_url:
+        logging.info(f"[{chat_id}] Found existing sticker pack: {pack_url}")
 
-        if sticker_gen:
-            # Если есть URL стикерпака - показываем его
-            if sticker_gen.pack_url:
-                logging.info(f"[{chat_id}] Found existing sticker pack: {sticker_gen.pack_url}")
-                
-                kb = types.InlineKeyboardMarkup(row_width=1)
-                kb.add(
-                    types.InlineKeyboardButton("📦 Открыть стикерпак", url=sticker_gen.pack_url),
-                    types.InlineKeyboardButton("⬅️ Главное меню", callback_data="main")
-                )
-                
-                bot.send_message(
-                    chat_id,
-                    f"✅ Твой стикерпак уже готов!\n\n"
-                    f"Ссылка: {sticker_gen.pack_url}\n\n"
-                    f"Добавь его в Telegram и пользуйся! 🎉",
-                    reply_markup=kb
-                )
-                bot.answer_callback_query(call.id)
-                return
-            
-            # Если нет URL, но статус 'ok' - пытаемся восстановить ссылку
-            elif sticker_gen.sticker_set_name:
-                pack_url = f"https://t.me/addstickers/{sticker_gen.sticker_set_name}"
-                
-                # Проверяем, существует ли стикерпак
-                try:
-                    bot.get_sticker_set(sticker_gen.sticker_set_name)
-                    # Стикерпак существует - обновляем URL и показываем
-                    sticker_gen.pack_url = pack_url
-                    sticker_gen.sticker_set_link = pack_url
-                    db.session.commit()
-                    
-                    logging.info(f"[{chat_id}] Restored sticker pack URL: {pack_url}")
-                    
-                    kb = types.InlineKeyboardMarkup(row_width=1)
-                    kb.add(
-                        types.InlineKeyboardButton("📦 Открыть стикерпак", url=pack_url),
-                        types.InlineKeyboardButton("⬅️ Главное меню", callback_data="main")
-                    )
-                    
-                    bot.send_message(
-                        chat_id,
-                        f"✅ Твой стикерпак уже готов!\n\n"
-                        f"Ссылка: {pack_url}\n\n"
-                        f"Добавь его в Telegram и пользуйся! 🎉",
-                        reply_markup=kb
-                    )
-                    bot.answer_callback_query(call.id)
-                    return
-                except Exception as e:
-                    # Стикерпак не существует - удаляем запись
-                    logging.info(f"[{chat_id}] Sticker pack in DB but doesn't exist: {e}")
-                    db.session.delete(sticker_gen)
-                    db.session.commit()
+        kb = types.InlineKeyboardMarkup(row_width=1)
+        kb.add(
+            types.InlineKeyboardButton("📦 Открыть стикерпак", url=pack_url),
+            types.InlineKeyboardButton("⬅️ Главное меню", callback_data="main")
+        )
 
-        # Проверяем статус pending
-        pending_gen = StickerGeneration.query.filter_by(user_id=user_id, status='pending').first()
+        bot.send_message(
+            chat_id,
+            f"✅ Твой стикерпак уже готов!\n\n"
+            f"Ссылка: {pack_url}\n\n"
+            f"Добавь его в Telegram и пользуйся! 🎉",
+            reply_markup=kb
+        )
+        bot.answer_callback_query(call.id)
+        return
+
+    with unit_of_work():
+        # Проверяем, не стоит ли стикерпак в очереди
+        pending_gen = StickerGeneration.query.filter(
+            StickerGeneration.user_id == user_id,
+            StickerGeneration.status.in_(('pending', 'processing')),
+        ).first()
         if pending_gen:
+            position, eta_minutes = sticker_jobs.position(pending_gen.id)
+            queue_text = f"Ты #{position} в очереди, примерно ~{eta_minutes} мин." if position else "Это может занять несколько минут."
             bot.send_message(
                 chat_id,
-                "⏳ Твой стикерпак уже в процессе генерации. Это может занять несколько минут.",
+                f"⏳ Твой стикерпак уже в процессе генерации. {queue_text}",
                 reply_markup=inline_back_to_menu()
             )
         else:
@@ -1251,58 +1233,29 @@ def handle_sticker_photo(message: types.Message) -> None:
     try:
         user_states.pop(chat_id, None)
 
-        with app.app_context():
+        pack_url = sticker_packs.get(chat_id)
+        if pack_url:
+            bot.send_message(chat_id, f"✅ У тебя уже есть готовый стикерпак: {pack_url}")
+            return
+
+        with unit_of_work():
             existing_gen = StickerGeneration.query.filter_by(user_id=user_id).first()
-            if existing_gen and existing_gen.status == 'pending':
+            if existing_gen and existing_gen.is_queued:
                 bot.send_message(chat_id, "⏳ У тебя уже есть стикерпак в процессе генерации.")
                 return
-            elif existing_gen and existing_gen.pack_url:
-                bot.send_message(chat_id, f"✅ У тебя уже есть готовый стикерпак: {existing_gen.pack_url}")
-                return
-
-        file_info = bot.get_file(message.photo[-1].file_id)
-        file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_info.file_path}"
 
-        bot.send_message(chat_id, "⏳ Отлично! Начинаю генерацию твоего стикерпака. Это займет около 2-3 минут...")
-
-        with app.app_context():
-            sticker_gen = StickerGeneration(
-                user_id=user_id,
-                status='pending'
+        job_id = sticker_jobs.submit(user_id, message.photo[-1].file_id)
+        # Пока задание ждёт очереди, в фоне проверяем, нет ли набора в Telegram, о котором не знает БД
+        sticker_packs.check(chat_id)
+        position, eta_minutes = sticker_jobs.position(job_id)
+        if position <= 1:
+            bot.send_message(chat_id, "⏳ Отлично! Начинаю генерацию твоего стикерпака. Это займет около 2-3 минут...")
+        else:
+            bot.send_message(
+                chat_id,
+                f"⏳ Отлично! Фото принято, ты #{position} в очереди на генерацию.\n"
+                f"Примерное ожидание: ~{eta_minutes} мин. Пришлю стикерпак, как только он будет готов."
             )
-            db.session.add(sticker_gen)
-            db.session.commit()
-
-        def generate_async():
-            try:
-                sticker_buf, file_id, pack_url, error_msg = generate_sticker_from_user_photo(file_url, chat_id, bot)
-
-                if error_msg:
-                    kb = types.InlineKeyboardMarkup()
-                    if pack_url:
-                        kb.add(types.InlineKeyboardButton("📦 Открыть стикерпак", url=pack_url))
-                    kb.add(types.InlineKeyboardButton("⬅️ Главное меню", callback_data="main"))
-                    bot.send_message(chat_id, error_msg, reply_markup=kb)
-                elif pack_url:
-                    kb = types.InlineKeyboardMarkup(row_width=1)
-                    kb.add(
-                        types.InlineKeyboardButton("📦 Открыть стикерпак", url=pack_url),
-                        types.InlineKeyboardButton("⬅️ Главное меню", callback_data="main")
-                    )
-                    bot.send_message(
-                        chat_id,
-                        f"🎉 Твой стикерпак готов!\n\n"
-                        f"Ссылка: {pack_url}\n\n"
-                        f"Добавь его в Telegram и пользуйся!",
-                        reply_markup=kb
-                    )
-                else:
-                    bot.send_message(chat_id, "⚠️ Не удалось создать стикерпак. Попробуй еще раз с другим фото.")
-            except Exception as e:
-                print(f"Error in sticker generation: {e}")
-                bot.send_message(chat_id, "⚠️ Произошла ошибка при генерации стикера.")
-
-        threading.Thread(target=generate_async, daemon=True).start()
 
     except Exception as e:
         print(f"Error processing sticker photo: {e}")
@@ -1326,10 +1279,10 @@ def handle_quest(call: types.CallbackQuery) -> None:
 
     try:
         quest_total = get_quest_total_steps()
-        completed_steps = user_quest_completed_steps(user_id)
-        progress_text = get_quest_progress(user_id)
+        found = quest_tracker.steps_found(user_id)
+        progress_text = get_quest_progress(user_id, found)
 
-        if len(completed_steps) == quest_total:
+        if found >= quest_total:
             bot.send_message(
                 chat_id,
                 f"🎉 Поздравляем! Ты уже завершил квест!\n\n"
@@ -1376,9 +1329,9 @@ def handle_quest_hints(call: types.CallbackQuery) -> None:
 
     try:
         quest_total = get_quest_total_steps()
-        completed_steps = user_quest_completed_steps(user_id)
+        found = quest_tracker.steps_found(user_id)
 
-        if len(completed_steps) == quest_total:
+        if found >= quest_total:
             bot.send_message(
                 chat_id,
                 f"🎉 Поздравляем! Ты уже завершил квест!\n\n"
@@ -1393,7 +1346,7 @@ def handle_quest_hints(call: types.CallbackQuery) -> None:
             next_step = 1
 
         hint, _ = get_quest_hint(next_step)
-        progress_text = get_quest_progress(user_id)
+        progress_text = get_quest_progress(user_id, found)
 
         if hint:
             formatted_hint = format_quest_text(hint)
@@ -1466,10 +1419,57 @@ def handle_quest_next_hint(call: types.CallbackQuery) -> None:
         bot.answer_callback_query(call.id, "Ошибка при загрузке подсказки")
         print(f"Error in handle_quest_next_hint: {e}")
 
+def format_quest_duration(seconds: int) -> str:
+    """Время прохождения квеста: «1 ч 05 мин» или «12 мин 30 с»"""
+    hours, rest = divmod(int(seconds), 3600)
+    minutes, secs = divmod(rest, 60)
+    if hours:
+        return f"{hours} ч {minutes:02d} мин"
+    return f"{minutes} мин {secs:02d} с"
+
+def format_leaderboard_entry(entry: dict, name: str) -> str:
+    """Строка рейтинга: место, имя и время прохождения или число шагов"""
+    if entry['completed'] and entry['duration_seconds'] is not None:
+        result = f"⏱ {format_quest_duration(entry['duration_seconds'])}"
+    else:
+        result = f"{entry['steps_found']} из {get_quest_total_steps()}"
+    return f"{entry['rank']}. {html.escape(name)} — {result}"
+
+@bot.message_handler(commands=["top"])
+def handle_quest_top(message: types.Message) -> None:
+    """Рейтинг квеста: самые быстрые участники и место пользователя"""
+    chat_id = message.chat.id
+    try:
+        top = quest_leaderboard.top(10)
+        if not top:
+            bot.send_message(chat_id, "🏆 Рейтинг пока пуст — найди первый стикер квеста!",
+                             reply_markup=inline_back_to_menu())
+            return
+
+        with unit_of_work():
+            names = dict(
+                db.session.query(User.id, User.first_name)
+                .filter(User.id.in_([entry['user_id'] for entry in top]))
+                .all()
+            )
+        lines = ["🏆 <b>Рейтинг квеста</b>\n"]
+        lines += [format_leaderboard_entry(entry, names.get(entry['user_id']) or "Участник") for entry in top]
+
+        me = quest_leaderboard.rank(get_user_id(chat_id))
+        if me:
+            lines.append(f"\nТвоё место: <b>{me['rank']}</b> ({format_quest_progress(me['steps_found'])})")
+        else:
+            lines.append("\nТы ещё не нашёл ни одного стикера квеста.")
+
+        bot.send_message(chat_id, "\n".join(lines), reply_markup=inline_back_to_menu())
+    except Exception as e:
+        print(f"Error in handle_quest_top: {e}")
+        bot.send_message(chat_id, "⚠️ Ошибка при загрузке рейтинга.")
+
 def complete_survey(chat_id: int) -> None:
     """Завершение опроса"""
     try:
-        with app.app_context():
+        with unit_of_work():
             user = User.query.filter_by(telegram_id=str(chat_id)).first()
             if user:
                 user.survey_completed = True
@@ -1480,11 +1480,15 @@ def complete_survey(chat_id: int) -> None:
         show_main_menu(chat_id, first_time=True)
     except Exception as e:
         print(f"[complete_survey] Ошибка: {e}")
-        with app.app_context():
+        with unit_of_work():
             db.session.rollback()
         user_states.pop(chat_id, None)
         bot.send_message(chat_id, "⚠️ Ошибка при завершении опроса. Попробуйте снова: /start")
 
+# Число запросов к БД, вызовов Telegram API и время по каждому обработчику (/api/handler_stats)
+handler_stats.instrument_bot(bot)
+handler_stats.start_reporter()
+
 # ═══════════════════════════════════════════════════════════════════════════════
 #                                ЗАПУСК БОТА
 # ═══════════════════════════════════════════════════════════════════════════════
@@ -1547,6 +1551,18 @@ def start_bot_polling_only() -> None:
                     logging.info("Bot stopped by user")
                 break
 
+def start_bot_sharded_only() -> None:
+    """Запуск бота в режиме sharded (polling и пул потоков с порядком внутри чата)"""
+    print("⚡ Starting bot in sharded polling mode...")
+    try:
+        bot.remove_webhook()
+        print("✅ Webhook removed successfully")
+    except Exception as e:
+        print(f"Warning: Could not remove webhook: {e}")
+
+    from sharded_polling import sharded_polling
+    sharded_polling.run(bot)
+
 def start_bot() -> None:
     """Обратная совместимость - использует polling"""
     start_bot_polling_only()
@@ -0,0 +1,382 @@
+import os
+import time
+import socket
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Iterable, Optional
+from uuid import uuid4
+
+from sqlalchemy import or_, update
+from telebot.apihelper import ApiTelegramException
+
+from app import db, unit_of_work
+from models import BroadcastJob, BroadcastRecipient
+from media_registry import media_registry
+
+# ═══════════════════════════════════════════════════════════════════════════════
+#                                НАСТРОЙКИ
+# ═══════════════════════════════════════════════════════════════════════════════
+
+GLOBAL_RATE = 30           # Telegram: ~30 сообщений в секунду на бота
+PER_CHAT_INTERVAL = 1.0    # Telegram: не чаще 1 сообщения в секунду в один чат
+SENDER_POOL_SIZE = int(os.getenv("BROADCAST_WORKERS", "8"))
+BATCH_SIZE = 200
+MAX_ATTEMPTS = 3
+IDLE_POLL_INTERVAL = 5     # секунд между проверками новых рассылок
+# Аренда задания и пачки получателей: пока она не истекла, другой процесс
+# (воркер gunicorn) их не возьмёт; продлевается перед каждой пачкой
+LEASE_SECONDS = int(os.getenv("BROADCAST_LEASE_SECONDS", "120"))
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+#                                ОГРАНИЧИТЕЛИ
+# ═══════════════════════════════════════════════════════════════════════════════
+
+class TokenBucket:
+    """Потокобезопасный token bucket: не больше rate операций в секунду"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self) -> None:
+        """Дождаться и забрать один токен"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    wait = self._blocked_until - now
+                else:
+                    self._refill(now)
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """Приостановить выдачу токенов (после 429 от Telegram)"""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+
+class ChatRateLimiter:
+    """Минимальный интервал между сообщениями в один и тот же чат"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._next_allowed: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, chat_id: str) -> None:
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_allowed.get(chat_id, 0.0))
+            self._next_allowed[chat_id] = slot + self.interval
+            if len(self._next_allowed) > 10000:
+                self._next_allowed = {k: v for k, v in self._next_allowed.items() if v > now}
+        if slot > now:
+            time.sleep(slot - now)
+
+
+# ═══════════════════════════════════════════════════════════════════════════════
+#                                ДВИЖОК РАССЫЛОК
+# ═══════════════════════════════════════════════════════════════════════════════
+
+class BroadcastEngine:
+    """Фоновая отправка рассылок с сохранением прогресса в БД.
+
+    Задание и получатели хранятся в broadcast_jobs / broadcast_recipients,
+    поэтому после перезапуска незавершённые рассылки продолжаются с курсора.
+    Движок может работать в нескольких процессах сразу: задание и каждая пачка
+    получателей сначала захватываются условным UPDATE с арендой (owner,
+    lease_until), и отправляет их только захвативший процесс. Если процесс
+    упал, после истечения аренды задание и недоотправленная пачка достаются
+    другому — такие получатели могут получить сообщение повторно.
+    """
+
+    def __init__(self, rate: float = GLOBAL_RATE, workers: int = SENDER_POOL_SIZE,
+                 batch_size: int = BATCH_SIZE):
+        self.bucket = TokenBucket(rate)
+        self.chat_limiter = ChatRateLimiter(PER_CHAT_INTERVAL)
+        self.workers = workers
+        self.batch_size = batch_size
+        self.bot = None
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        self._wakeup = threading.Event()
+        self._started = False
+        self._start_lock = threading.Lock()
+
+    def start(self, bot) -> None:
+        """Запустить диспетчер (повторный вызов ничего не делает)"""
+        with self._start_lock:
+            if self._started:
+                return
+            self.bot = bot
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="broadcast")
+            threading.Thread(target=self._run, daemon=True, name="broadcast-dispatcher").start()
+            self._started = True
+            logging.info(f"📣 Broadcast engine started: {self.workers} workers, {self.bucket.rate} msg/s")
+
+    def submit(self, message_text: str, chat_ids: Iterable, photo_url: Optional[str] = None) -> int:
+        """Создать задание рассылки и вернуть его id"""
+        unique_ids = list(dict.fromkeys(str(chat_id) for chat_id in chat_ids))
+
+        with unit_of_work():
+            job = BroadcastJob(
+                message_text=message_text,
+                photo_url=photo_url,
+                status='pending',
+                total_count=len(unique_ids),
+            )
+            db.session.add(job)
+            db.session.flush()
+            db.session.bulk_insert_mappings(BroadcastRecipient, [
+                {"job_id": job.id, "chat_id": chat_id, "status": 'pending'}
+                for chat_id in unique_ids
+            ])
+            db.session.commit()
+            job_id = job.id
+
+        logging.info(f"📣 Broadcast job {job_id} queued for {len(unique_ids)} recipients")
+        self._wakeup.set()
+        return job_id
+
+    @staticmethod
+    def progress(job_id: int) -> Optional[dict]:
+        """Прогресс рассылки для страницы админки"""
+        with unit_of_work():
+            job = db.session.get(BroadcastJob, job_id)
+            return job.to_dict() if job else None
+
+    # ─────────────── Диспетчер ───────────────
+
+    def _lease(self) -> datetime:
+        return datetime.utcnow() + timedelta(seconds=LEASE_SECONDS)
+
+    def _claim_job(self, job_id: int) -> bool:
+        """Захватить задание (или продлить свою аренду); False — его отправляет другой процесс"""
+        now = datetime.utcnow()
+        with unit_of_work():
+            claimed = db.session.execute(
+                update(BroadcastJob)
+                .where(
+                    BroadcastJob.id == job_id,
+                    or_(
+                        BroadcastJob.status == 'pending',
+                        (BroadcastJob.status == 'running') & or_(
+                            BroadcastJob.owner == self.owner,
+                            BroadcastJob.lease_until.is_(None),
+                            BroadcastJob.lease_until < now,
+                        ),
+                    ),
+                )
+                .values(status='running', owner=self.owner, lease_until=self._lease())
+            ).rowcount == 1
+            if claimed:
+                job = db.session.get(BroadcastJob, job_id)
+                if not job.started_at:
+                    job.started_at = now
+            db.session.commit()
+            return claimed
+
+    def _next_job_id(self) -> Optional[int]:
+        """Первое задание, которое удалось захватить этому процессу"""
+        now = datetime.utcnow()
+        with unit_of_work():
+            candidates = [job_id for job_id, in db.session.query(BroadcastJob.id).filter(
+                or_(
+                    BroadcastJob.status == 'pending',
+                    (BroadcastJob.status == 'running') & or_(
+                        BroadcastJob.owner == self.owner,
+                        BroadcastJob.lease_until.is_(None),
+                        BroadcastJob.lease_until < now,
+                    ),
+                )
+            ).order_by(BroadcastJob.id)]
+        for job_id in candidates:
+            if self._claim_job(job_id):
+                return job_id
+        return None
+
+    def _run(self) -> None:
+        while True:
+            try:
+                job_id = self._next_job_id()
+                if job_id is None:
+                    self._wakeup.wait(IDLE_POLL_INTERVAL)
+                    self._wakeup.clear()
+                    continue
+                self._process_job(job_id)
+            except Exception as e:
+                logging.error(f"Error in broadcast dispatcher: {e}")
+                time.sleep(IDLE_POLL_INTERVAL)
+
+    def _claim_batch(self, job_id: int, cursor: int) -> list:
+        """Захватить пачку получателей: pending или с истёкшей арендой чужой отправки"""
+        now = datetime.utcnow()
+        claimable = or_(
+            BroadcastRecipient.status == 'pending',
+            (BroadcastRecipient.status == 'sending') & (BroadcastRecipient.lease_until < now),
+        )
+        with unit_of_work():
+            ids = [recipient_id for recipient_id, in db.session.query(BroadcastRecipient.id).filter(
+                BroadcastRecipient.job_id == job_id,
+                BroadcastRecipient.id > cursor,
+                claimable,
+            ).order_by(BroadcastRecipient.id).limit(self.batch_size)]
+            if not ids:
+                return []
+            db.session.execute(
+                update(BroadcastRecipient)
+                .where(BroadcastRecipient.id.in_(ids), claimable)
+                .values(status='sending', owner=self.owner, lease_until=self._lease())
+            )
+            db.session.commit()
+            return [(r.id, r.chat_id) for r in BroadcastRecipient.query.filter(
+                BroadcastRecipient.id.in_(ids),
+                BroadcastRecipient.status == 'sending',
+                BroadcastRecipient.owner == self.owner,
+            ).order_by(BroadcastRecipient.id)]
+
+    def _finish_job(self, job_id: int) -> bool:
+        """Завершить задание, если ни одна пачка больше не отправляется"""
+        now = datetime.utcnow()
+        with unit_of_work():
+            in_flight = BroadcastRecipient.query.filter(
+                BroadcastRecipient.job_id == job_id,
+                BroadcastRecipient.status.in_(('pending', 'sending')),
+            ).count()
+            if in_flight:
+                return False
+            db.session.execute(
+                update(BroadcastJob)
+                .where(BroadcastJob.id == job_id, BroadcastJob.owner == self.owner)
+                .values(status='done', finished_at=now, lease_until=None)
+            )
+            db.session.commit()
+            job = db.session.get(BroadcastJob, job_id)
+            logging.info(f"✅ Broadcast job {job_id} finished: sent={job.sent_count}, errors={job.error_count}")
+            return True
+
+    def _process_job(self, job_id: int) -> None:
+        with unit_of_work():
+            job = db.session.get(BroadcastJob, job_id)
+            if job.cursor:
+                logging.info(f"📣 Resuming broadcast job {job_id} after recipient #{job.cursor}")
+            message_text = job.message_text
+            photo_url = job.photo_url
+            photo_file_id = job.photo_file_id
+
+        while True:
+            # Продлеваем аренду; если задание забрал другой процесс — отдаём его
+            if not self._claim_job(job_id):
+                logging.warning(f"📣 Broadcast job {job_id} was taken over by another process")
+                return
+
+            with unit_of_work():
+                cursor = db.session.get(BroadcastJob, job_id).cursor or 0
+            targets = self._claim_batch(job_id, cursor)
+            if not targets:
+                # Чужая пачка с неистёкшей арендой ещё может отправляться — ждём её
+                targets = self._claim_batch(job_id, 0)
+            if not targets:
+                if self._finish_job(job_id):
+                    return
+                time.sleep(IDLE_POLL_INTERVAL)
+                continue
+
+            futures = [
+                (recipient_id, self._executor.submit(self._send, chat_id, message_text, photo_url, photo_file_id))
+                for recipient_id, chat_id in targets
+            ]
+            results = [(recipient_id, future.result()) for recipient_id, future in futures]
+
+            # После первой загрузки фото рассылаем его по file_id
+            if photo_url and not photo_file_id and os.path.exists(photo_url):
+                photo_file_id = media_registry.get_file_id(photo_url, 'photo')
+            self._save_batch(job_id, results, photo_file_id)
+
+    def _save_batch(self, job_id: int, results: list, photo_file_id: Optional[str] = None) -> None:
+        """Записать результаты пачки и сдвинуть курсор одной транзакцией"""
+        now = datetime.utcnow()
+        sent = 0
+        failed = 0
+        with unit_of_work():
+            for recipient_id, (ok, attempts, error) in results:
+                # Только свои строки: если аренду пачки перехватили, результат запишет новый владелец
+                saved = db.session.execute(
+                    update(BroadcastRecipient)
+                    .where(BroadcastRecipient.id == recipient_id, BroadcastRecipient.owner == self.owner,
+                           BroadcastRecipient.status == 'sending')
+                    .values(status='sent' if ok else 'failed', attempts=attempts, error=error,
+                            sent_at=now if ok else None, lease_until=None)
+                ).rowcount
+                if ok:
+                    sent += saved
+                else:
+                    failed += saved
+
+            last_id = max(recipient_id for recipient_id, _ in results)
+            values = {
+                'sent_count': db.func.coalesce(BroadcastJob.sent_count, 0) + sent,
+                'error_count': db.func.coalesce(BroadcastJob.error_count, 0) + failed,
+            }
+            db.session.execute(update(BroadcastJob).where(BroadcastJob.id == job_id).values(**values))
+            db.session.execute(
+                update(BroadcastJob)
+                .where(BroadcastJob.id == job_id, or_(BroadcastJob.cursor.is_(None), BroadcastJob.cursor < last_id))
+                .values(cursor=last_id)
+            )
+            if photo_file_id:
+                db.session.execute(
+                    update(BroadcastJob)
+                    .where(BroadcastJob.id == job_id, BroadcastJob.photo_file_id.is_(None))
+                    .values(photo_file_id=photo_file_id)
+                )
+            db.session.commit()
+
+    # ─────────────── Отправка ───────────────
+
+    def _send(self, chat_id: str, message_text: str, photo_url: Optional[str],
+              photo_file_id: Optional[str] = None) -> tuple:
+        """Отправить одно сообщение. Возвращает (успех, попыток, ошибка)"""
+        error = None
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            self.bucket.acquire()
+            self.chat_limiter.acquire(chat_id)
+            try:
+                if photo_file_id:
+                    self.bot.send_photo(int(chat_id), photo_file_id, caption=message_text, parse_mode='HTML')
+                elif photo_url and os.path.exists(photo_url):
+                    media_registry.send_photo(self.bot, int(chat_id), photo_url, caption=message_text, parse_mode='HTML')
+                else:
+                    self.bot.send_message(int(chat_id), message_text, parse_mode='HTML')
+                return True, attempt, None
+            except ApiTelegramException as e:
+                error = str(e)
+                if e.error_code == 429:
+                    retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 1)
+                    self.bucket.pause(retry_after)
+                    continue
+                # 400/403: чат не найден или бот заблокирован — повтор не поможет
+                return False, attempt, error
+            except Exception as e:
+                error = str(e)
+                time.sleep(attempt)
+        return False, MAX_ATTEMPTS, error
+
+
+broadcast_engine = BroadcastEngine()
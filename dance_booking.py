@@ -0,0 +1,261 @@
+import os
+import itertools
+
+from typing import NamedTuple, Optional
+
+from sqlalchemy import func, update
+
+from app import db, insert_ignore, unit_of_work
+from models import DanceSlot, DanceWaitlist, Registration, User
+from ttl_cache import TTLCache
+
+# ═══════════════════════════════════════════════════════════════════════════════
+#                                НАСТРОЙКИ
+# ═══════════════════════════════════════════════════════════════════════════════
+
+# Свободные места сбрасываются при каждой записи/отмене; TTL — страховка от
+# изменений в обход dance_booking (например, правки слота в базе вручную)
+DANCE_AVAILABILITY_TTL = float(os.getenv("DANCE_AVAILABILITY_TTL", "60"))
+
+_availability_cache = TTLCache(maxsize=1, ttl=DANCE_AVAILABILITY_TTL, name="dance_availability")
+# Поколение кеша: расчёт, начатый до записи, сохранится под старым ключом и не будет прочитан
+_generations = itertools.count()
+_generation = next(_generations)
+
+
+class BookingResult(NamedTuple):
+    """Итог записи: booked, already, full, waitlisted или missing (слота нет)"""
+    status: str
+    position: Optional[int] = None  # место в листе ожидания
+
+
+class SlotAvailability(NamedTuple):
+    """Заполненность активного слота"""
+    day: str
+    time_slot: str
+    max_participants: int
+    taken: int
+    waiting: int
+
+    @property
+    def free(self) -> int:
+        return max(0, self.max_participants - self.taken)
+
+
+class Promotion(NamedTuple):
+    """Участник, переведённый из листа ожидания в запись"""
+    user_id: int
+    telegram_id: str
+    day: str
+    time_slot: str
+
+
+def _slot(day: str, time_slot: str, active_only: bool = True) -> Optional[DanceSlot]:
+    """Слот с блокировкой строки до конца транзакции (в SQLite запись и так сериализована)"""
+    query = DanceSlot.query.filter_by(day=day, time_slot=time_slot)
+    if active_only:
+        query = query.filter_by(is_active=True)
+    return query.with_for_update().first()
+
+
+def _claim_seat(slot_id: int) -> bool:
+    """Занять место условным UPDATE: при гонке лишний запрос просто не изменит строку"""
+    return db.session.execute(
+        update(DanceSlot)
+        .where(DanceSlot.id == slot_id, DanceSlot.taken < DanceSlot.max_participants)
+        .values(taken=DanceSlot.taken + 1)
+    ).rowcount == 1
+
+
+def _release_seat(slot_id: int) -> None:
+    db.session.execute(
+        update(DanceSlot)
+        .where(DanceSlot.id == slot_id, DanceSlot.taken > 0)
+        .values(taken=DanceSlot.taken - 1)
+    )
+
+
+def _add_registration(user_id: int, slot: DanceSlot) -> bool:
+    return insert_ignore(
+        Registration, ["user_id", "activity_type", "day", "time_slot"],
+        user_id=user_id, activity_type='dance', day=slot.day, time_slot=slot.time_slot,
+    ) == 1
+
+
+def _is_registered(user_id: int, slot: DanceSlot) -> bool:
+    return db.session.query(
+        Registration.query.filter_by(
+            user_id=user_id, activity_type='dance', day=slot.day, time_slot=slot.time_slot
+        ).exists()
+    ).scalar()
+
+
+def _waitlist_position(user_id: int, slot_id: int) -> Optional[int]:
+    entry_id = db.session.query(DanceWaitlist.id).filter_by(slot_id=slot_id, user_id=user_id).scalar()
+    if entry_id is None:
+        return None
+    return DanceWaitlist.query.filter(DanceWaitlist.slot_id == slot_id, DanceWaitlist.id <= entry_id).count()
+
+
+def _promote(slot: DanceSlot) -> list[Promotion]:
+    """Раздать свободные места слота листу ожидания по порядку записи"""
+    promotions = []
+    while True:
+        entry = DanceWaitlist.query.filter_by(slot_id=slot.id).order_by(DanceWaitlist.id).first()
+        if not entry or not _claim_seat(slot.id):
+            return promotions
+        user_id = entry.user_id
+        DanceWaitlist.query.filter_by(id=entry.id).delete()
+        if not _add_registration(user_id, slot):
+            # Уже записан (например, админом) — место возвращается следующему
+            _release_seat(slot.id)
+            continue
+        telegram_id = db.session.query(User.telegram_id).filter_by(id=user_id).scalar()
+        promotions.append(Promotion(user_id, telegram_id, slot.day, slot.time_slot))
+
+
+def availability() -> list[SlotAvailability]:
+    """Активные слоты с занятыми местами и длиной очереди (один запрос, результат кешируется)"""
+    def compute():
+        with unit_of_work():
+            waiting = (
+                db.session.query(DanceWaitlist.slot_id, func.count().label("waiting"))
+                .group_by(DanceWaitlist.slot_id)
+                .subquery()
+            )
+            rows = (
+                db.session.query(
+                    DanceSlot.day, DanceSlot.time_slot, DanceSlot.max_participants,
+                    DanceSlot.taken, func.coalesce(waiting.c.waiting, 0),
+                )
+                .outerjoin(waiting, waiting.c.slot_id == DanceSlot.id)
+                .filter(DanceSlot.is_active.is_(True))
+                .order_by(DanceSlot.day, DanceSlot.time_slot)
+                .all()
+            )
+            return [
+                SlotAvailability(day, time_slot, max_participants or 0, taken or 0, waiting_count)
+                for day, time_slot, max_participants, taken, waiting_count in rows
+            ]
+
+    return _availability_cache.get_or_compute(("slots", _generation), compute)
+
+
+def invalidate_availability() -> None:
+    """Сбросить кеш свободных мест (после записи, отмены и правки слотов в админке)"""
+    global _generation
+    _generation = next(_generations)
+    _availability_cache.clear()
+
+
+def book(user_id: int, day: str, time_slot: str, waitlist: bool = False) -> BookingResult:
+    """Записать на слот; если мест нет и waitlist=True — поставить в лист ожидания.
+
+    Место занимается условным UPDATE taken = taken + 1 WHERE taken < max_participants,
+    поэтому одновременные нажатия не переполнят слот.
+    """
+    with unit_of_work():
+        try:
+            slot = _slot(day, time_slot)
+            if not slot:
+                db.session.rollback()
+                return BookingResult('missing')
+
+            if _claim_seat(slot.id):
+                if not _add_registration(user_id, slot):
+                    db.session.rollback()
+                    return BookingResult('already')
+                DanceWaitlist.query.filter_by(slot_id=slot.id, user_id=user_id).delete()
+                db.session.commit()
+                invalidate_availability()
+                return BookingResult('booked')
+
+            if _is_registered(user_id, slot):
+                db.session.rollback()
+                return BookingResult('already')
+            if not waitlist:
+                db.session.rollback()
+                return BookingResult('full')
+
+            insert_ignore(DanceWaitlist, ["slot_id", "user_id"], slot_id=slot.id, user_id=user_id)
+            position = _waitlist_position(user_id, slot.id)
+            db.session.commit()
+            invalidate_availability()
+            return BookingResult('waitlisted', position)
+        except Exception:
+            db.session.rollback()
+            raise
+
+
+def cancel(user_id: int, day: str, time_slot: str) -> tuple[bool, list[Promotion]]:
+    """Отменить запись; освободившееся место сразу получает первый из листа ожидания.
+
+    Возвращает (запись была, переведённые из листа ожидания) — их нужно уведомить.
+    """
+    with unit_of_work():
+        try:
+            slot = _slot(day, time_slot, active_only=False)
+            deleted = Registration.query.filter_by(
+                user_id=user_id, activity_type='dance', day=day, time_slot=time_slot
+            ).delete()
+            if not deleted:
+                db.session.rollback()
+                return False, []
+
+            promotions = []
+            if slot:
+                _release_seat(slot.id)
+                promotions = _promote(slot)
+            db.session.commit()
+            invalidate_availability()
+            return True, promotions
+        except Exception:
+            db.session.rollback()
+            raise
+
+
+def leave_waitlist(user_id: int, day: str, time_slot: str) -> bool:
+    with unit_of_work():
+        slot = DanceSlot.query.filter_by(day=day, time_slot=time_slot).first()
+        if not slot:
+            return False
+        deleted = DanceWaitlist.query.filter_by(slot_id=slot.id, user_id=user_id).delete()
+        db.session.commit()
+        invalidate_availability()
+        return bool(deleted)
+
+
+def user_bookings(user_id: int) -> tuple[set, dict]:
+    """Записи пользователя и его места в листах ожидания: ({(day, time_slot)}, {(day, time_slot): позиция})"""
+    with unit_of_work():
+        booked = {
+            (day, time_slot) for day, time_slot in
+            db.session.query(Registration.day, Registration.time_slot).filter_by(user_id=user_id, activity_type='dance')
+        }
+        waiting = {}
+        for slot_id, day, time_slot in (
+            db.session.query(DanceWaitlist.slot_id, DanceSlot.day, DanceSlot.time_slot)
+            .join(DanceSlot, DanceSlot.id == DanceWaitlist.slot_id)
+            .filter(DanceWaitlist.user_id == user_id)
+        ):
+            waiting[(day, time_slot)] = _waitlist_position(user_id, slot_id)
+        return booked, waiting
+
+
+def release_user(user_id: int) -> list[Promotion]:
+    """Снять все записи и места в очереди пользователя (без commit — вызывающий код коммитит сам).
+
+    Освободившиеся места раздаются листам ожидания; переведённых нужно уведомить,
+    а кеш свободных мест сбросить (invalidate_availability) после commit.
+    """
+    DanceWaitlist.query.filter_by(user_id=user_id).delete()
+    promotions = []
+    registrations = Registration.query.filter_by(user_id=user_id, activity_type='dance').all()
+    for registration in registrations:
+        slot = _slot(registration.day, registration.time_slot, active_only=False)
+        db.session.delete(registration)
+        db.session.flush()
+        if slot:
+            _release_seat(slot.id)
+            promotions += _promote(slot)
+    return promotions
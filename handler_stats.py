@@ -0,0 +1,235 @@
+import time
+import logging
+import threading
+
+from collections import deque
+from functools import wraps
+from typing import Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from telebot import apihelper
+
+SAMPLES_PER_HANDLER = 500   # последние замеры для p50/p95
+REPORT_INTERVAL = 300       # секунд между сводками в лог
+REPORT_TOP = 10
+
+# Типы обработчиков telebot, которые оборачиваем
+HANDLER_LISTS = (
+    'message_handlers', 'edited_message_handlers', 'callback_query_handlers',
+    'inline_handlers', 'chosen_inline_handlers', 'my_chat_member_handlers',
+)
+
+
+class _UpdateRecord:
+    """Счётчики одного вызова обработчика"""
+
+    __slots__ = ('queries', 'db_time', 'api_calls', 'api_time', 'query_started')
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.api_calls = 0
+        self.api_time = 0.0
+        self.query_started: list[float] = []
+
+
+class _HandlerAggregate:
+    """Накопленная статистика одного обработчика"""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.queries = 0
+        self.max_queries = 0
+        self.db_time = 0.0
+        self.api_calls = 0
+        self.api_time = 0.0
+        self.wall_time = 0.0
+        self.max_wall = 0.0
+        self.samples: deque = deque(maxlen=SAMPLES_PER_HANDLER)
+
+    def add(self, record: _UpdateRecord, wall: float, failed: bool) -> None:
+        self.calls += 1
+        self.errors += int(failed)
+        self.queries += record.queries
+        self.max_queries = max(self.max_queries, record.queries)
+        self.db_time += record.db_time
+        self.api_calls += record.api_calls
+        self.api_time += record.api_time
+        self.wall_time += wall
+        self.max_wall = max(self.max_wall, wall)
+        self.samples.append(wall)
+
+    @staticmethod
+    def _percentile(values: list, p: float) -> float:
+        if not values:
+            return 0.0
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * p))]
+
+    def to_dict(self) -> dict:
+        calls = self.calls or 1
+        samples = list(self.samples)
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'queries_total': self.queries,
+            'queries_avg': round(self.queries / calls, 2),
+            'queries_max': self.max_queries,
+            'db_ms_avg': round(self.db_time / calls * 1000, 2),
+            'api_calls_avg': round(self.api_calls / calls, 2),
+            'api_ms_avg': round(self.api_time / calls * 1000, 2),
+            'api_ms_per_call': round(self.api_time / self.api_calls * 1000, 2) if self.api_calls else None,
+            'wall_ms_avg': round(self.wall_time / calls * 1000, 2),
+            'wall_ms_p50': round(self._percentile(samples, 0.5) * 1000, 2),
+            'wall_ms_p95': round(self._percentile(samples, 0.95) * 1000, 2),
+            'wall_ms_max': round(self.max_wall * 1000, 2),
+            'wall_ms_total': round(self.wall_time * 1000, 2),
+        }
+
+
+class HandlerStats:
+    """Запросы к БД, вызовы Telegram API и время выполнения по каждому обработчику бота.
+
+    Замер привязан к потоку: всё, что поток выполняет внутри обёрнутого
+    обработчика, засчитывается этому обработчику.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._handlers: dict[str, _HandlerAggregate] = {}
+        self._lock = threading.Lock()
+        self._installed = False
+        self._reporter_started = False
+
+    # ─────────────── Текущий замер ───────────────
+
+    def _current(self) -> Optional[_UpdateRecord]:
+        return getattr(self._local, 'record', None)
+
+    def _on_before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        record = self._current()
+        if record is not None:
+            record.query_started.append(time.perf_counter())
+
+    def _on_after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        record = self._current()
+        if record is not None and record.query_started:
+            record.queries += 1
+            record.db_time += time.perf_counter() - record.query_started.pop()
+
+    def install(self) -> None:
+        """Подключить события SQLAlchemy и обёртку запросов к Telegram (один раз)"""
+        with self._lock:
+            if self._installed:
+                return
+            event.listen(Engine, 'before_cursor_execute', self._on_before_execute)
+            event.listen(Engine, 'after_cursor_execute', self._on_after_execute)
+
+            make_request = apihelper._make_request
+
+            @wraps(make_request)
+            def timed_make_request(*args, **kwargs):
+                record = self._current()
+                if record is None:
+                    return make_request(*args, **kwargs)
+                started = time.perf_counter()
+                try:
+                    return make_request(*args, **kwargs)
+                finally:
+                    record.api_calls += 1
+                    record.api_time += time.perf_counter() - started
+
+            apihelper._make_request = timed_make_request
+            self._installed = True
+
+    # ─────────────── Обработчики ───────────────
+
+    def wrap(self, func, name: Optional[str] = None):
+        """Обернуть обработчик так, чтобы его вызовы попадали в статистику"""
+        if getattr(func, '_handler_stats_wrapped', False):
+            return func
+        name = name or func.__name__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if self._current() is not None:
+                # Вложенный вызов обработчика из обработчика — считаем во внешний
+                return func(*args, **kwargs)
+            record = self._local.record = _UpdateRecord()
+            started = time.perf_counter()
+            failed = False
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                failed = True
+                raise
+            finally:
+                self._local.record = None
+                self._record(name, record, time.perf_counter() - started, failed)
+
+        wrapper._handler_stats_wrapped = True
+        return wrapper
+
+    def instrument_bot(self, bot) -> int:
+        """Обернуть все зарегистрированные обработчики бота. Возвращает их число"""
+        self.install()
+        count = 0
+        for attr in HANDLER_LISTS:
+            for handler in getattr(bot, attr, []):
+                if not getattr(handler['function'], '_handler_stats_wrapped', False):
+                    handler['function'] = self.wrap(handler['function'])
+                    count += 1
+        return count
+
+    def _record(self, name: str, record: _UpdateRecord, wall: float, failed: bool) -> None:
+        with self._lock:
+            aggregate = self._handlers.get(name)
+            if aggregate is None:
+                aggregate = self._handlers[name] = _HandlerAggregate()
+            aggregate.add(record, wall, failed)
+
+    # ─────────────── Отчёты ───────────────
+
+    def snapshot(self) -> dict:
+        """Статистика по обработчикам, самые затратные по суммарному времени первыми"""
+        with self._lock:
+            stats = {name: aggregate.to_dict() for name, aggregate in self._handlers.items()}
+        return dict(sorted(stats.items(), key=lambda item: item[1]['wall_ms_total'], reverse=True))
+
+    def reset(self) -> None:
+        with self._lock:
+            self._handlers.clear()
+
+    def log_summary(self, top: int = REPORT_TOP) -> None:
+        stats = self.snapshot()
+        if not stats:
+            return
+        lines = [
+            f"  {name}: {s['calls']} calls, {s['queries_avg']} q/avg (max {s['queries_max']}), "
+            f"db {s['db_ms_avg']}ms, api {s['api_calls_avg']}x/{s['api_ms_avg']}ms, "
+            f"wall p50 {s['wall_ms_p50']}ms p95 {s['wall_ms_p95']}ms"
+            for name, s in list(stats.items())[:top]
+        ]
+        logging.info("📊 Handler stats (top by total time):\n" + "\n".join(lines))
+
+    def start_reporter(self, interval: int = REPORT_INTERVAL) -> None:
+        """Периодически писать сводку в лог"""
+        with self._lock:
+            if self._reporter_started:
+                return
+            self._reporter_started = True
+
+        def report_loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.log_summary()
+                except Exception as e:
+                    logging.error(f"Error logging handler stats: {e}")
+
+        threading.Thread(target=report_loop, daemon=True, name="handler-stats").start()
+
+
+handler_stats = HandlerStats()
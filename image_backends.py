@@ -0,0 +1,187 @@
+import abc
+import io
+import os
+import time
+import random
+import hashlib
+import logging
+import threading
+
+from typing import Optional
+
+import requests
+from PIL import Image, ImageDraw
+
+# ═══════════════════════════════════════════════════════════════════════════════
+#                                НАСТРОЙКИ
+# ═══════════════════════════════════════════════════════════════════════════════
+
+# replicate — настоящие модели, stub — локальная заглушка для нагрузочных тестов и работы без сети
+IMAGE_BACKEND = os.getenv("IMAGE_BACKEND", "replicate")
+STUB_LATENCY = float(os.getenv("STUB_LATENCY", "2.0"))          # секунд на вызов модели
+STUB_FAILURE_RATE = float(os.getenv("STUB_FAILURE_RATE", "0"))  # доля вызовов, завершающихся ошибкой
+
+FLUX_MODEL = "black-forest-labs/flux-kontext-pro"
+FLUX_PROMPT = (
+    "Make a cute cartoon avatar in simple flat vector style with bold outlines, "
+    "clean shapes, and no shading. Remove all text, logos, or watermarks. "
+    "Solid or transparent background."
+)
+FLUX_SEED = 1224737784
+BG_REMOVER_MODEL = "851-labs/background-remover:a029dff38972b5fda4ec5d75d7d1cd25aeff621d2cf4946a41055d7db66b80bc"
+
+
+class BackendError(Exception):
+    """Модель не вернула результат"""
+
+
+def _grab_url(raw) -> Optional[str]:
+    if not raw:
+        return None
+    if isinstance(raw, str) and raw.startswith("http"):
+        return raw
+    if isinstance(raw, (list, tuple)):
+        for item in raw:
+            url = _grab_url(item)
+            if url:
+                return url
+    if isinstance(raw, dict):
+        for key in ("image", "images", "url", "output"):
+            if key in raw:
+                url = _grab_url(raw[key])
+                if url:
+                    return url
+    return None
+
+
+def _download(url: str) -> bytes:
+    resp = requests.get(url, timeout=20)
+    resp.raise_for_status()
+    return resp.content
+
+
+class ImageModelBackend(abc.ABC):
+    """Модели генерации стикера: мультяшный аватар и удаление фона.
+
+    Оба метода возвращают PNG-байты. cache_tag(stage) попадает в ключ кеша
+    результатов, чтобы ответы разных бэкендов и версий моделей не смешивались.
+    """
+
+    name = "base"
+
+    def available(self) -> bool:
+        return True
+
+    def cache_tag(self, stage: str) -> tuple:
+        return (self.name, stage)
+
+    @abc.abstractmethod
+    def stylize(self, file_url: str, photo_bytes: Optional[bytes] = None) -> bytes:
+        ...
+
+    @abc.abstractmethod
+    def remove_background(self, cartoon_png: bytes) -> bytes:
+        ...
+
+
+class ReplicateBackend(ImageModelBackend):
+    """Flux Kontext Pro и background-remover на Replicate"""
+
+    name = "replicate"
+
+    def __init__(self, client=None):
+        self.client = client
+
+    def available(self) -> bool:
+        return self.client is not None
+
+    def cache_tag(self, stage: str) -> tuple:
+        if stage == "stylize":
+            return (FLUX_MODEL, FLUX_PROMPT, FLUX_SEED)
+        return (BG_REMOVER_MODEL,)
+
+    def stylize(self, file_url: str, photo_bytes: Optional[bytes] = None) -> bytes:
+        flux_raw = self.client.run(
+            FLUX_MODEL,
+            input={
+                "seed": FLUX_SEED,
+                "prompt": FLUX_PROMPT,
+                "input_image": file_url,
+                "aspect_ratio": "1:1",
+                "output_format": "png",
+                "safety_tolerance": 2,
+            },
+        )
+        cartoon_url = _grab_url(flux_raw)
+        if not cartoon_url:
+            raise BackendError("Flux did not return a valid URL")
+        return _download(cartoon_url)
+
+    def remove_background(self, cartoon_png: bytes) -> bytes:
+        bg_raw = self.client.run(
+            BG_REMOVER_MODEL,
+            input={"image": io.BytesIO(cartoon_png), "format": "png", "background_type": "rgba"},
+        )
+        clean_url = _grab_url(bg_raw)
+        if not clean_url:
+            raise BackendError("Background Remover did not return a valid URL")
+        return _download(clean_url)
+
+
+class StubBackend(ImageModelBackend):
+    """Локальная заглушка: детерминированная картинка из хеша входа, задержка и доля ошибок настраиваются"""
+
+    name = "stub"
+
+    def __init__(self, latency: float = STUB_LATENCY, failure_rate: float = STUB_FAILURE_RATE, seed: Optional[int] = None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+
+    def _call(self, stage: str) -> None:
+        with self._lock:
+            self.calls += 1
+            fail = self._random.random() < self.failure_rate
+            if fail:
+                self.failures += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            raise BackendError(f"stub {stage} failure")
+
+    @staticmethod
+    def _png(image: Image.Image) -> bytes:
+        buf = io.BytesIO()
+        image.save(buf, format="PNG", compress_level=1)
+        return buf.getvalue()
+
+    def stylize(self, file_url: str, photo_bytes: Optional[bytes] = None) -> bytes:
+        self._call("stylize")
+        digest = hashlib.sha256(photo_bytes or file_url.encode("utf-8")).digest()
+        image = Image.new("RGB", (512, 512), (240, 240, 240))
+        draw = ImageDraw.Draw(image)
+        draw.ellipse((96, 64, 416, 448), fill=(digest[0], digest[1], digest[2]), outline=(0, 0, 0), width=8)
+        draw.ellipse((176, 176, 224, 224), fill=(0, 0, 0))
+        draw.ellipse((288, 176, 336, 224), fill=(0, 0, 0))
+        return self._png(image)
+
+    def remove_background(self, cartoon_png: bytes) -> bytes:
+        self._call("bg_remove")
+        with Image.open(io.BytesIO(cartoon_png)) as cartoon:
+            image = cartoon.convert("RGBA")
+        mask = Image.new("L", image.size, 0)
+        ImageDraw.Draw(mask).ellipse((88, 56, 424, 456), fill=255)
+        image.putalpha(mask)
+        return self._png(image)
+
+
+def create_backend(kind: str = IMAGE_BACKEND, replicate_client=None) -> ImageModelBackend:
+    if kind == "stub":
+        logging.info(f"🧪 Image backend: stub (latency {STUB_LATENCY}s, failure rate {STUB_FAILURE_RATE})")
+        return StubBackend()
+    if kind != "replicate":
+        logging.warning(f"Unknown IMAGE_BACKEND={kind}, using replicate")
+    return ReplicateBackend(replicate_client)
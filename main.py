@@ -108,6 +108,10 @@ def run_bot_polling():
                 
                 from bot import start_bot_polling_only
                 start_bot_polling_only()
+        elif bot_mode == 'sharded':
+            logging.info("⚡ Запуск Telegram бота в sharded polling режиме...")
+            from bot import start_bot_sharded_only
+            start_bot_sharded_only()
         else:
             logging.info("🤖 Запуск Telegram бота через polling...")
             # Принудительно удаляем webhook при запуске в polling режиме
@@ -0,0 +1,241 @@
+import io
+import os
+import hashlib
+import logging
+import threading
+
+from typing import Callable, Iterable, Optional
+
+from PIL import Image
+from telebot.apihelper import ApiTelegramException
+
+from app import db, unit_of_work
+from models import MediaAsset
+
+# ═══════════════════════════════════════════════════════════════════════════════
+#                                НАСТРОЙКИ
+# ═══════════════════════════════════════════════════════════════════════════════
+
+# Блокировки первой загрузки: фиксированный набор, ключ выбирает блокировку по хешу.
+# Ключей (с хешем содержимого) становится больше при каждой замене файла, блокировок — нет
+KEY_LOCK_STRIPES = 64
+
+
+def is_stale_file_id_error(error: Exception) -> bool:
+    """Telegram не принял сохранённый file_id (другой бот/токен, файл удалён) — нужно загрузить заново"""
+    return (isinstance(error, ApiTelegramException) and error.error_code == 400
+            and 'file' in (error.description or '').lower())
+
+
+class MediaRegistry:
+    """Реестр файлов, уже загруженных в Telegram.
+
+    Каждый локальный файл загружается один раз, дальше он отправляется по
+    file_id. Ключ — путь, тип медиа и хеш содержимого, поэтому замена файла
+    на диске автоматически приводит к новой загрузке.
+    """
+
+    def __init__(self):
+        self._file_ids: dict[tuple, str] = {}
+        self._hashes: dict[str, tuple] = {}  # path -> (mtime, size, sha256)
+        self._renders: dict[tuple, tuple] = {}  # (path, max_px) -> ((mtime, size), png bytes)
+        self._key_locks = [threading.Lock() for _ in range(KEY_LOCK_STRIPES)]
+
+    @staticmethod
+    def _normalize(path: str) -> str:
+        return os.path.normpath(path)
+
+    def content_hash(self, path: str) -> str:
+        """Хеш содержимого файла (пересчитывается только при изменении mtime/размера)"""
+        path = self._normalize(path)
+        stat = os.stat(path)
+        cached = self._hashes.get(path)
+        if cached and cached[0] == stat.st_mtime and cached[1] == stat.st_size:
+            return cached[2]
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        content_hash = digest.hexdigest()
+        self._hashes[path] = (stat.st_mtime, stat.st_size, content_hash)
+        return content_hash
+
+    def _key(self, path: str, kind: str) -> tuple:
+        path = self._normalize(path)
+        return path, kind, self.content_hash(path)
+
+    def _key_lock(self, key: tuple) -> threading.Lock:
+        return self._key_locks[hash(key) % KEY_LOCK_STRIPES]
+
+    def get_file_id(self, path: str, kind: str = 'photo') -> Optional[str]:
+        """Получить file_id для локального файла, если он уже загружался"""
+        key = self._key(path, kind)
+        file_id = self._file_ids.get(key)
+        if file_id:
+            return file_id
+
+        with unit_of_work():
+            asset = MediaAsset.query.filter_by(path=key[0], kind=kind, content_hash=key[2]).first()
+            if asset:
+                self._file_ids[key] = asset.file_id
+                return asset.file_id
+        return None
+
+    def remember(self, path: str, kind: str, file_id: str) -> None:
+        """Сохранить file_id для локального файла"""
+        key = self._key(path, kind)
+        self._file_ids[key] = file_id
+
+        try:
+            with unit_of_work():
+                asset = MediaAsset.query.filter_by(path=key[0], kind=kind, content_hash=key[2]).first()
+                if asset:
+                    asset.file_id = file_id
+                else:
+                    db.session.add(MediaAsset(path=key[0], kind=kind, content_hash=key[2], file_id=file_id))
+                db.session.commit()
+        except Exception as e:
+            logging.error(f"Error saving media file_id for {path}: {e}")
+
+    def forget(self, path: str, kind: str) -> None:
+        """Удалить file_id, который Telegram больше не принимает"""
+        key = self._key(path, kind)
+        self._file_ids.pop(key, None)
+        try:
+            with unit_of_work():
+                MediaAsset.query.filter_by(path=key[0], kind=kind, content_hash=key[2]).delete()
+                db.session.commit()
+        except Exception as e:
+            logging.error(f"Error removing media file_id for {path}: {e}")
+
+    def invalidate(self, path: str) -> None:
+        """Забыть всё, что закешировано для файла (после замены через админку)"""
+        path = self._normalize(path)
+        self._hashes.pop(path, None)
+        for key in [k for k in self._renders if k[0] == path]:
+            self._renders.pop(key, None)
+        for key in [k for k in self._file_ids if k[0] == path]:
+            self._file_ids.pop(key, None)
+
+    def _send_cached(self, path: str, kind: str, send: Callable, payload: Callable,
+                     extract_file_id: Callable):
+        """Отправить по file_id, а если его ещё нет — загрузить один раз и запомнить"""
+        file_id = self.get_file_id(path, kind)
+        if file_id:
+            try:
+                return send(file_id)
+            except Exception as e:
+                if not is_stale_file_id_error(e):
+                    raise
+                # file_id устарел (другой бот/токен, файл удалён на стороне Telegram) — загружаем заново
+                logging.warning(f"Stale file_id for {path} ({kind}): {e}")
+                if self._file_ids.get(self._key(path, kind)) == file_id:
+                    self.forget(path, kind)
+
+        # Остальные отправители ждут, пока первая загрузка вернёт file_id
+        with self._key_lock(self._key(path, kind)):
+            file_id = self.get_file_id(path, kind)
+            if file_id:
+                return send(file_id)
+
+            message = send(payload())
+            file_id = extract_file_id(message)
+            if file_id:
+                self.remember(path, kind, file_id)
+            return message
+
+    @staticmethod
+    def _photo_file_id(message) -> Optional[str]:
+        return message.photo[-1].file_id if message and message.photo else None
+
+    def send_photo(self, bot, chat_id: int, path: str, **kwargs):
+        """Отправить фото: загрузка только при первой отправке, дальше по file_id"""
+        def read_file():
+            with open(path, 'rb') as photo:
+                return io.BytesIO(photo.read())
+
+        return self._send_cached(
+            path, 'photo',
+            lambda media: bot.send_photo(chat_id, media, **kwargs),
+            read_file,
+            self._photo_file_id,
+        )
+
+    def send_video_note(self, bot, chat_id: int, path: str, **kwargs):
+        """Отправить видеосообщение: загрузка только при первой отправке, дальше по file_id"""
+        def read_file():
+            with open(path, 'rb') as video:
+                return io.BytesIO(video.read())
+
+        return self._send_cached(
+            path, 'video_note',
+            lambda media: bot.send_video_note(chat_id, media, **kwargs),
+            read_file,
+            lambda message: message.video_note.file_id if message and message.video_note else None,
+        )
+
+    def sticker_file_id(self, bot, owner_id: int, path: str) -> str:
+        """file_id статичного стикера для наборов: upload_sticker_file только при первом обращении"""
+        file_id = self.get_file_id(path, 'sticker')
+        if file_id:
+            return file_id
+
+        with self._key_lock(self._key(path, 'sticker')):
+            file_id = self.get_file_id(path, 'sticker')
+            if file_id:
+                return file_id
+
+            with open(path, 'rb') as f:
+                sticker = io.BytesIO(f.read())
+            sticker.name = os.path.basename(path)
+            uploaded = bot.upload_sticker_file(owner_id, sticker=sticker, sticker_format='static')
+            self.remember(path, 'sticker', uploaded.file_id)
+            logging.info(f"Uploaded shared sticker {path}")
+            return uploaded.file_id
+
+    # ─────────────── Масштабированные изображения меню ───────────────
+
+    def render_scaled(self, path: str, max_px: int = 700) -> bytes:
+        """PNG, уменьшенный до max_px по большей стороне (рендерится один раз на версию файла)"""
+        path = self._normalize(path)
+        stat = os.stat(path)
+        version = (stat.st_mtime, stat.st_size)
+        cached = self._renders.get((path, max_px))
+        if cached and cached[0] == version:
+            return cached[1]
+
+        with Image.open(path) as img:
+            w, h = img.size
+            scale = max(w, h) / max_px
+            if scale > 1:
+                img = img.resize((int(w / scale), int(h / scale)), Image.Resampling.LANCZOS)
+            buf = io.BytesIO()
+            img.save(buf, format="PNG")
+
+        data = buf.getvalue()
+        self._renders[(path, max_px)] = (version, data)
+        return data
+
+    def prerender(self, paths: Iterable[str], max_px: int = 700) -> None:
+        """Заранее подготовить изображения, чтобы первый показ не тратил CPU"""
+        for path in paths:
+            if not path or not os.path.exists(path):
+                continue
+            try:
+                self.render_scaled(path, max_px)
+                self.content_hash(path)
+            except Exception as e:
+                logging.error(f"Error prerendering image {path}: {e}")
+
+    def send_scaled_photo(self, bot, chat_id: int, path: str, max_px: int = 700, **kwargs):
+        """Отправить масштабированное изображение; повторные показы идут по file_id"""
+        return self._send_cached(
+            path, f'photo:{max_px}',
+            lambda media: bot.send_photo(chat_id, media, **kwargs),
+            lambda: io.BytesIO(self.render_scaled(path, max_px)),
+            self._photo_file_id,
+        )
+
+
+media_registry = MediaRegistry()
@@ -1,8 +1,134 @@
 
 import sqlite3
 import os
+import json
+from datetime import datetime
 from app import app
 
+def migrate_quest_steps(cursor):
+    """Перенести шаги квеста из JSON-колонки completed_steps в таблицу quest_steps"""
+    cursor.execute("PRAGMA table_info(quest_progress)")
+    columns = [column[1] for column in cursor.fetchall()]
+    if not columns:
+        return
+    if 'steps_found' not in columns:
+        print("Добавляем колонку steps_found в quest_progress...")
+        cursor.execute("ALTER TABLE quest_progress ADD COLUMN steps_found INTEGER NOT NULL DEFAULT 0")
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS quest_steps (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL REFERENCES users (id),
+            step INTEGER NOT NULL,
+            found_at DATETIME,
+            CONSTRAINT uq_quest_step UNIQUE (user_id, step)
+        )
+    """)
+
+    # Повторный запуск безопасен: дубли шагов игнорируются
+    cursor.execute("SELECT user_id, completed_steps, COALESCE(completed_at, created_at) FROM quest_progress")
+    moved = 0
+    for user_id, completed_steps, found_at in cursor.fetchall():
+        try:
+            steps = json.loads(completed_steps or "[]")
+        except (json.JSONDecodeError, TypeError):
+            continue
+        if not isinstance(steps, list):
+            continue
+        for step in {s for s in steps if isinstance(s, int) and s >= 1}:
+            cursor.execute(
+                "INSERT OR IGNORE INTO quest_steps (user_id, step, found_at) VALUES (?, ?, ?)",
+                (user_id, step, found_at or datetime.utcnow().isoformat(sep=' ')),
+            )
+            moved += cursor.rowcount
+    if moved:
+        print(f"Перенесено шагов квеста: {moved}")
+
+    # Одна строка прогресса на пользователя: дубли сливаются в самую раннюю
+    cursor.execute("""
+        UPDATE quest_progress SET
+            completed = (SELECT MAX(COALESCE(p.completed, 0)) FROM quest_progress p WHERE p.user_id = quest_progress.user_id),
+            completed_at = (SELECT MIN(p.completed_at) FROM quest_progress p WHERE p.user_id = quest_progress.user_id)
+        WHERE user_id IN (SELECT user_id FROM quest_progress GROUP BY user_id HAVING COUNT(*) > 1)
+    """)
+    cursor.execute("DELETE FROM quest_progress WHERE id NOT IN (SELECT MIN(id) FROM quest_progress GROUP BY user_id)")
+    if cursor.rowcount:
+        print(f"Удалено дублей прогресса квеста: {cursor.rowcount}")
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS uq_quest_progress_user ON quest_progress (user_id)")
+
+    cursor.execute("""
+        UPDATE quest_progress
+        SET steps_found = (SELECT COUNT(*) FROM quest_steps WHERE quest_steps.user_id = quest_progress.user_id)
+    """)
+
+def migrate_quest_leaderboard(cursor):
+    """Колонки рейтинга квеста: начало, последний шаг и длительность прохождения"""
+    cursor.execute("PRAGMA table_info(quest_progress)")
+    columns = [column[1] for column in cursor.fetchall()]
+    if not columns:
+        return
+
+    for name, ddl in (
+        ("started_at", "DATETIME"),
+        ("last_step_at", "DATETIME"),
+        ("duration_seconds", "INTEGER"),
+    ):
+        if name not in columns:
+            print(f"Добавляем колонку {name} в quest_progress...")
+            cursor.execute(f"ALTER TABLE quest_progress ADD COLUMN {name} {ddl}")
+
+    cursor.execute("""
+        UPDATE quest_progress SET
+            started_at = COALESCE(started_at,
+                (SELECT MIN(found_at) FROM quest_steps WHERE quest_steps.user_id = quest_progress.user_id),
+                created_at),
+            last_step_at = COALESCE(last_step_at,
+                (SELECT MAX(found_at) FROM quest_steps WHERE quest_steps.user_id = quest_progress.user_id),
+                completed_at, created_at)
+        WHERE started_at IS NULL OR last_step_at IS NULL
+    """)
+    cursor.execute("""
+        UPDATE quest_progress
+        SET duration_seconds = MAX(0, CAST(ROUND((julianday(completed_at) - julianday(started_at)) * 86400) AS INTEGER))
+        WHERE completed = 1 AND completed_at IS NOT NULL AND duration_seconds IS NULL
+    """)
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS ix_quest_progress_leaderboard ON quest_progress (completed, duration_seconds)"
+    )
+
+def migrate_dance_booking(cursor):
+    """Счётчик занятых мест в dance_slots и лист ожидания"""
+    cursor.execute("PRAGMA table_info(dance_slots)")
+    columns = [column[1] for column in cursor.fetchall()]
+    if not columns:
+        return
+
+    if 'taken' not in columns:
+        print("Добавляем колонку taken в dance_slots...")
+        cursor.execute("ALTER TABLE dance_slots ADD COLUMN taken INTEGER NOT NULL DEFAULT 0")
+
+    # Счётчик всегда пересчитывается по фактическим записям
+    cursor.execute("""
+        UPDATE dance_slots SET taken = (
+            SELECT COUNT(*) FROM registrations r
+            WHERE r.activity_type = 'dance' AND r.day = dance_slots.day AND r.time_slot = dance_slots.time_slot
+        )
+    """)
+    cursor.execute("SELECT day, time_slot, taken, max_participants FROM dance_slots WHERE taken > max_participants")
+    for day, time_slot, taken, max_participants in cursor.fetchall():
+        print(f"⚠️ Слот {day} {time_slot} переполнен: {taken} из {max_participants}")
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS dance_waitlist (
+            id INTEGER PRIMARY KEY,
+            slot_id INTEGER NOT NULL REFERENCES dance_slots (id),
+            user_id INTEGER NOT NULL REFERENCES users (id),
+            created_at DATETIME,
+            CONSTRAINT uq_dance_waitlist UNIQUE (slot_id, user_id)
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_dance_waitlist_user ON dance_waitlist (user_id)")
+
 def migrate_database():
     """Миграция базы данных для добавления недостающих колонок"""
     db_path = os.path.join(app.instance_path, 'festival_bot.db')
@@ -40,6 +166,47 @@ def migrate_database():
                     print("Добавляем колонку chat_id...")
                     cursor.execute("ALTER TABLE scheduled_messages ADD COLUMN chat_id INTEGER")
         
+        # file_id загруженных фото для рассылок
+        for table in ('scheduled_messages', 'broadcast_jobs'):
+            cursor.execute(f"PRAGMA table_info({table})")
+            columns = [column[1] for column in cursor.fetchall()]
+            if columns and 'photo_file_id' not in columns:
+                print(f"Добавляем колонку photo_file_id в {table}...")
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN photo_file_id VARCHAR(255)")
+
+        # Аренда рассылок: задание и пачку получателей отправляет только один процесс
+        for table in ('broadcast_jobs', 'broadcast_recipients'):
+            cursor.execute(f"PRAGMA table_info({table})")
+            columns = [column[1] for column in cursor.fetchall()]
+            for col, col_type in (('owner', "VARCHAR(64)"), ('lease_until', "DATETIME")):
+                if columns and col not in columns:
+                    print(f"Добавляем колонку {col} в {table}...")
+                    cursor.execute(f"ALTER TABLE {table} ADD COLUMN {col} {col_type}")
+
+        # Очередь генерации стикеров
+        cursor.execute("PRAGMA table_info(sticker_generations)")
+        columns = [column[1] for column in cursor.fetchall()]
+        sticker_columns = {
+            'source_file_id': "VARCHAR(255)",
+            'attempts': "INTEGER DEFAULT 0",
+            'started_at': "DATETIME",
+            'finished_at': "DATETIME",
+            'error': "TEXT",
+        }
+        for col, col_type in sticker_columns.items():
+            if columns and col not in columns:
+                print(f"Добавляем колонку {col} в sticker_generations...")
+                cursor.execute(f"ALTER TABLE sticker_generations ADD COLUMN {col} {col_type}")
+        if columns:
+            cursor.execute("CREATE INDEX IF NOT EXISTS ix_sticker_generations_status ON sticker_generations (status)")
+
+        # Прогресс квеста: одна строка на (пользователь, шаг) + счётчик steps_found
+        migrate_quest_steps(cursor)
+        migrate_quest_leaderboard(cursor)
+
+        # Танцы: атомарный счётчик мест и лист ожидания
+        migrate_dance_booking(cursor)
+
         conn.commit()
         print("✅ Миграция завершена успешно")
         
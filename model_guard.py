@@ -0,0 +1,197 @@
+import os
+import time
+import logging
+import threading
+
+from collections import deque
+from typing import Callable, Optional
+
+# ═══════════════════════════════════════════════════════════════════════════════
+#                                НАСТРОЙКИ
+# ═══════════════════════════════════════════════════════════════════════════════
+
+MODEL_BREAKER_FAILURES = int(os.getenv("MODEL_BREAKER_FAILURES", "5"))   # ошибок подряд до размыкания
+MODEL_BREAKER_RESET = float(os.getenv("MODEL_BREAKER_RESET", "60"))      # секунд до пробного вызова
+LATENCY_SAMPLES = 200
+
+
+class CircuitOpenError(Exception):
+    """Модель недоступна: предохранитель разомкнут, вызов не выполнялся"""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"{name}: circuit open, retry in {retry_after:.0f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class AIMDLimiter:
+    """Адаптивный лимит одновременных вызовов (additive increase / multiplicative decrease).
+
+    Успешный быстрый вызов добавляет к лимиту 1/limit (≈ +1 за «круг» вызовов),
+    ошибка или задержка выше latency_target уменьшает лимит в decrease раз,
+    но не чаще раза за latency_target, чтобы один медленный круг не обрушил лимит до минимума.
+    """
+
+    def __init__(self, max_limit: int, latency_target: float, min_limit: int = 1, decrease: float = 0.5):
+        self.max_limit = max(min_limit, max_limit)
+        self.min_limit = min_limit
+        self.latency_target = latency_target
+        self.decrease = decrease
+        self._limit = float(self.max_limit)
+        self._in_flight = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    @property
+    def limit(self) -> int:
+        return max(self.min_limit, int(self._limit))
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def acquire(self) -> None:
+        with self._cond:
+            while self._in_flight >= self.limit:
+                self._cond.wait()
+            self._in_flight += 1
+
+    def release(self, latency: float, ok: bool) -> None:
+        with self._cond:
+            self._in_flight -= 1
+            now = time.monotonic()
+            if not ok or latency > self.latency_target:
+                if now - self._last_decrease >= self.latency_target:
+                    self._limit = max(self.min_limit, self._limit * self.decrease)
+                    self._last_decrease = now
+            else:
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            self._cond.notify_all()
+
+
+class CircuitBreaker:
+    """closed → (N ошибок подряд) → open → (reset_timeout) → half_open → один пробный вызов.
+
+    Пробный вызов успешен — цепь замыкается, неуспешен — снова open.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = MODEL_BREAKER_FAILURES, reset_timeout: float = MODEL_BREAKER_RESET):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def retry_after(self) -> float:
+        """Через сколько секунд можно вызывать модель (0 — можно сейчас)"""
+        with self._lock:
+            if self.state == "closed":
+                return 0.0
+            if self.state == "open":
+                return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+            return 1.0 if self._probe_in_flight else 0.0
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open":
+                if time.monotonic() < self.opened_at + self.reset_timeout:
+                    return False
+                self.state = "half_open"
+                logging.info(f"Model {self.name} circuit half-open, sending a probe call")
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state != "closed":
+                logging.info(f"Model {self.name} circuit closed")
+            self.state = "closed"
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    self.trips += 1
+                self.state = "open"
+                self.opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+
+class ModelCallGuard:
+    """Вызовы одной модели: адаптивный лимит, предохранитель и метрики задержек"""
+
+    def __init__(self, name: str, max_limit: int, latency_target: float,
+                 failure_threshold: int = MODEL_BREAKER_FAILURES, reset_timeout: float = MODEL_BREAKER_RESET):
+        self.name = name
+        self.limiter = AIMDLimiter(max_limit, latency_target)
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+        self._latencies: deque = deque(maxlen=LATENCY_SAMPLES)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.rejected = 0
+
+    def call(self, func: Callable, *args):
+        """Выполнить вызов модели; при разомкнутом предохранителе — сразу CircuitOpenError"""
+        if not self.breaker.allow():
+            with self._lock:
+                self.rejected += 1
+            raise CircuitOpenError(self.name, self.breaker.retry_after())
+
+        self.limiter.acquire()
+        started = time.monotonic()
+        ok = False
+        try:
+            result = func(*args)
+            ok = True
+            return result
+        finally:
+            latency = time.monotonic() - started
+            self.limiter.release(latency, ok)
+            if ok:
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
+            with self._lock:
+                self.calls += 1
+                self.errors += 0 if ok else 1
+                self._latencies.append(latency)
+            if not ok and self.breaker.state == "open":
+                logging.warning(f"Model {self.name} circuit open for {self.breaker.reset_timeout:.0f}s")
+
+    def retry_after(self) -> float:
+        return self.breaker.retry_after()
+
+    @staticmethod
+    def _percentile(values: list, p: float) -> Optional[float]:
+        if not values:
+            return None
+        return round(values[min(len(values) - 1, int(len(values) * p))], 2)
+
+    def stats(self) -> dict:
+        with self._lock:
+            latencies = sorted(self._latencies)
+            calls, errors, rejected = self.calls, self.errors, self.rejected
+        return {
+            'state': self.breaker.state,
+            'limit': self.limiter.limit,
+            'max_limit': self.limiter.max_limit,
+            'in_flight': self.limiter.in_flight,
+            'calls': calls,
+            'errors': errors,
+            'rejected': rejected,
+            'trips': self.breaker.trips,
+            'p50_seconds': self._percentile(latencies, 0.5),
+            'p95_seconds': self._percentile(latencies, 0.95),
+        }
@@ -18,6 +18,7 @@ class ScheduledMessage(db.Model):
     scheduled_time = db.Column(db.DateTime, nullable=False)
     sent = db.Column(db.Boolean, default=False)
     photo_url = db.Column(db.String(255), nullable=True)
+    photo_file_id = db.Column(db.String(255), nullable=True)  # file_id фото после первой загрузки в Telegram
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     @property
@@ -29,6 +30,84 @@ class ScheduledMessage(db.Model):
         return not self.sent and self.scheduled_time > datetime.utcnow()
 
 
+# ─────────────── Фоновые рассылки ───────────────
+class BroadcastJob(db.Model):
+    __tablename__ = "broadcast_jobs"
+
+    id = db.Column(Integer, primary_key=True)
+    message_text = db.Column(Text, nullable=False)
+    photo_url = db.Column(String(255), nullable=True)
+    photo_file_id = db.Column(String(255), nullable=True)  # file_id фото после первой загрузки в Telegram
+    status = db.Column(String(20), default='pending', index=True)  # pending, running, done, failed
+    total_count = db.Column(Integer, default=0)
+    sent_count = db.Column(Integer, default=0)
+    error_count = db.Column(Integer, default=0)
+    cursor = db.Column(Integer, default=0)  # id последнего обработанного получателя
+    owner = db.Column(String(64), nullable=True)  # процесс, который отправляет рассылку
+    lease_until = db.Column(DateTime, nullable=True)  # после этого момента задание может забрать другой процесс
+    created_at = db.Column(DateTime, default=datetime.utcnow)
+    started_at = db.Column(DateTime, nullable=True)
+    finished_at = db.Column(DateTime, nullable=True)
+
+    recipients = db.relationship("BroadcastRecipient", backref="job", lazy="dynamic")
+
+    @property
+    def is_active(self):
+        return self.status in ('pending', 'running')
+
+    def to_dict(self):
+        processed = (self.sent_count or 0) + (self.error_count or 0)
+        total = self.total_count or 0
+        return {
+            "id": self.id,
+            "status": self.status,
+            "total": total,
+            "sent": self.sent_count or 0,
+            "errors": self.error_count or 0,
+            "processed": processed,
+            "percent": round(processed * 100 / total, 1) if total else 100.0,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+
+class BroadcastRecipient(db.Model):
+    __tablename__ = "broadcast_recipients"
+
+    id = db.Column(Integer, primary_key=True)
+    job_id = db.Column(Integer, db.ForeignKey("broadcast_jobs.id"), nullable=False)
+    chat_id = db.Column(String(20), nullable=False)
+    status = db.Column(String(20), default='pending')  # pending, sending, sent, failed
+    owner = db.Column(String(64), nullable=True)
+    lease_until = db.Column(DateTime, nullable=True)
+    attempts = db.Column(Integer, default=0)
+    error = db.Column(Text, nullable=True)
+    sent_at = db.Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index("ix_broadcast_recipient_job_status", "job_id", "status"),
+        UniqueConstraint("job_id", "chat_id", name="uq_broadcast_recipient"),
+    )
+
+
+# ─────────────── Загруженные в Telegram файлы ───────────────
+class MediaAsset(db.Model):
+    __tablename__ = "media_assets"
+
+    id = db.Column(Integer, primary_key=True)
+    path = db.Column(String(255), nullable=False)
+    kind = db.Column(String(20), nullable=False, default='photo')  # photo, video_note, sticker
+    content_hash = db.Column(String(64), nullable=False)
+    file_id = db.Column(String(255), nullable=False)
+    created_at = db.Column(DateTime, default=datetime.utcnow)
+    updated_at = db.Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        UniqueConstraint("path", "kind", "content_hash", name="uq_media_asset"),
+    )
+
+
 # ─────────────── Пользователи ───────────────
 class User(db.Model):
     __tablename__ = "users"
@@ -147,20 +226,49 @@ class QuestProgress(db.Model):
 
     id = db.Column(Integer, primary_key=True)
     user_id = db.Column(Integer, db.ForeignKey("users.id"), nullable=False)
-    completed_steps = db.Column(Text)
+    completed_steps = db.Column(Text)  # устарело: шаги хранятся в quest_steps
+    steps_found = db.Column(Integer, nullable=False, default=0, server_default="0")
     completed = db.Column(Boolean, default=False)
     completed_at = db.Column(DateTime)
+    started_at = db.Column(DateTime)        # первый найденный шаг
+    last_step_at = db.Column(DateTime)      # последний найденный шаг
+    duration_seconds = db.Column(Integer)   # от первого шага до завершения
     created_at = db.Column(DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        UniqueConstraint("user_id", name="uq_quest_progress_user"),
+        Index("ix_quest_progress_leaderboard", "completed", "duration_seconds"),
+    )
+
+    def step_numbers(self):
+        return [row.step for row in QuestStep.query.filter_by(user_id=self.user_id).order_by(QuestStep.step)]
+
     def to_dict(self):
         return {
             "user_id": self.user_id,
             "completed": self.completed,
-            "completed_steps": self.completed_steps,
+            "completed_steps": self.step_numbers(),
+            "steps_found": self.steps_found,
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "duration_seconds": self.duration_seconds,
             "completed_at": self.completed_at.isoformat() if self.completed_at else None
         }
 
 
+# Найденный шаг квеста: одна строка на (пользователь, шаг)
+class QuestStep(db.Model):
+    __tablename__ = "quest_steps"
+
+    id = db.Column(Integer, primary_key=True)
+    user_id = db.Column(Integer, db.ForeignKey("users.id"), nullable=False)
+    step = db.Column(Integer, nullable=False)
+    found_at = db.Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        UniqueConstraint("user_id", "step", name="uq_quest_step"),
+    )
+
+
 # ─────────────── Генерация стикеров ───────────────
 class StickerGeneration(db.Model):
     __tablename__ = "sticker_generations"
@@ -173,12 +281,22 @@ class StickerGeneration(db.Model):
     generated_file_id = db.Column(String(255), nullable=True)
     sticker_set_name = db.Column(String(255), nullable=True)
     sticker_set_link = db.Column(String(255), nullable=True)
-    status = db.Column(String(50), default='pending')
+    # pending (в очереди) → processing → ok / failed
+    status = db.Column(String(50), default='pending', index=True)
+    source_file_id = db.Column(String(255), nullable=True)  # file_id исходного фото в Telegram
+    attempts = db.Column(Integer, default=0)
+    started_at = db.Column(DateTime, nullable=True)
+    finished_at = db.Column(DateTime, nullable=True)
+    error = db.Column(Text, nullable=True)
 
     @property
     def is_generated(self):
         return self.status == "ok"
 
+    @property
+    def is_queued(self):
+        return self.status in ("pending", "processing")
+
     def to_dict(self):
         return {
             "id": self.id,
@@ -190,6 +308,10 @@ class StickerGeneration(db.Model):
             "pack_url": self.pack_url,
             "created_at": self.created_at.isoformat() if self.created_at else None,
             "status": self.status,
+            "attempts": self.attempts,
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "error": self.error,
         }
 
 
@@ -267,6 +389,9 @@ class SystemConfig(db.Model):
             config.description = description
 
         db.session.commit()
+
+        from text_cache import text_cache
+        text_cache.invalidate()
         return config
 
 # ─────────────── Слоты для танцев ───────────────
@@ -277,16 +402,13 @@ class DanceSlot(db.Model):
     day = db.Column(String(50), nullable=False)
     time_slot = db.Column(String(10), nullable=False)
     max_participants = db.Column(Integer, default=10)
+    taken = db.Column(Integer, nullable=False, default=0, server_default="0")  # занятые места, меняется только в dance_booking
     is_active = db.Column(Boolean, default=True)
     created_at = db.Column(DateTime, default=datetime.utcnow)
 
     @property
     def current_participants(self):
-        return Registration.query.filter_by(
-            activity_type='dance',
-            day=self.day,
-            time_slot=self.time_slot
-        ).count()
+        return self.taken or 0
 
     @property
     def is_full(self):
@@ -303,6 +425,20 @@ class DanceSlot(db.Model):
             "is_active": self.is_active
         }
 
+# Лист ожидания слота танцев: первым освободившееся место получает самая ранняя запись
+class DanceWaitlist(db.Model):
+    __tablename__ = "dance_waitlist"
+
+    id = db.Column(Integer, primary_key=True)
+    slot_id = db.Column(Integer, db.ForeignKey("dance_slots.id"), nullable=False)
+    user_id = db.Column(Integer, db.ForeignKey("users.id"), nullable=False)
+    created_at = db.Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        UniqueConstraint("slot_id", "user_id", name="uq_dance_waitlist"),
+        Index("ix_dance_waitlist_user", "user_id"),
+    )
+
 # ─────────────── Сообщения админов пользователям ───────────────
 class AdminMessage(db.Model):
     __tablename__ = "admin_messages"
@@ -0,0 +1,126 @@
+import bisect
+import logging
+import threading
+
+from datetime import datetime
+from typing import Optional
+
+from app import unit_of_work
+from models import QuestProgress
+
+
+def _timestamp(value: Optional[datetime]) -> float:
+    return value.timestamp() if value else float("inf")
+
+
+class QuestLeaderboard:
+    """Рейтинг квеста в памяти, обновляется при каждом новом найденном шаге.
+
+    Финишировавшие идут первыми по времени от первого шага до завершения,
+    остальные — по числу найденных шагов, при равенстве выше тот, кто
+    дошёл до этого числа раньше. Ключи лежат в двух отсортированных списках,
+    поэтому место пользователя — bisect за O(log n), топ-N — срез.
+    Из базы рейтинг читается один раз, при первом обращении.
+    """
+
+    def __init__(self):
+        self._finished: list[tuple] = []  # (duration_seconds, completed_at, user_id)
+        self._playing: list[tuple] = []   # (-steps_found, last_step_at, user_id)
+        self._entries: dict[int, tuple] = {}  # user_id -> (finished, key, steps_found, last_step_at)
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def _load(self) -> None:
+        if self._loaded:
+            return
+        with unit_of_work():
+            rows = (
+                QuestProgress.query
+                .with_entities(
+                    QuestProgress.user_id, QuestProgress.steps_found, QuestProgress.completed,
+                    QuestProgress.completed_at, QuestProgress.last_step_at, QuestProgress.duration_seconds,
+                )
+                .filter(QuestProgress.steps_found > 0)
+                .all()
+            )
+        for row in rows:
+            self._put(row.user_id, row.steps_found, bool(row.completed),
+                      row.duration_seconds, row.completed_at, row.last_step_at)
+        self._loaded = True
+        logging.info(f"Quest leaderboard loaded: {len(self._finished)} finished, {len(self._playing)} playing")
+
+    def _remove(self, user_id: int) -> None:
+        entry = self._entries.pop(user_id, None)
+        if not entry:
+            return
+        keys = self._finished if entry[0] else self._playing
+        index = bisect.bisect_left(keys, entry[1])
+        if index < len(keys) and keys[index] == entry[1]:
+            del keys[index]
+
+    def _put(self, user_id: int, steps_found: int, completed: bool, duration_seconds: Optional[int],
+             completed_at: Optional[datetime], last_step_at: Optional[datetime]) -> None:
+        last_step_ts = _timestamp(last_step_at)
+        current = self._entries.get(user_id)
+        if current and (steps_found < current[2] or last_step_ts < current[3]):
+            # Обновления из разных потоков приходят после commit в любом порядке — устаревшее не откатывает место
+            return
+        self._remove(user_id)
+        if completed:
+            key = (duration_seconds if duration_seconds is not None else float("inf"), _timestamp(completed_at), user_id)
+            bisect.insort(self._finished, key)
+        else:
+            key = (-steps_found, last_step_ts, user_id)
+            bisect.insort(self._playing, key)
+        self._entries[user_id] = (completed, key, steps_found, last_step_ts)
+
+    def _entry(self, user_id: int, rank: int) -> dict:
+        finished, key, steps_found, _ = self._entries[user_id]
+        return {
+            'rank': rank,
+            'user_id': user_id,
+            'steps_found': steps_found,
+            'completed': finished,
+            'duration_seconds': key[0] if finished and key[0] != float("inf") else None,
+        }
+
+    def update(self, user_id: int, steps_found: int, completed: bool, duration_seconds: Optional[int],
+               completed_at: Optional[datetime], last_step_at: Optional[datetime]) -> None:
+        """Обновить место пользователя после нового шага (вызывается после commit)"""
+        with self._lock:
+            self._load()
+            self._put(user_id, steps_found, completed, duration_seconds, completed_at, last_step_at)
+
+    def forget(self, user_id: int) -> None:
+        with self._lock:
+            self._remove(user_id)
+
+    def rank(self, user_id: int) -> Optional[dict]:
+        """Место пользователя в рейтинге (None — ещё не нашёл ни одного шага)"""
+        with self._lock:
+            self._load()
+            entry = self._entries.get(user_id)
+            if not entry:
+                return None
+            if entry[0]:
+                rank = bisect.bisect_left(self._finished, entry[1]) + 1
+            else:
+                rank = len(self._finished) + bisect.bisect_left(self._playing, entry[1]) + 1
+            return self._entry(user_id, rank)
+
+    def top(self, limit: int = 10) -> list[dict]:
+        with self._lock:
+            self._load()
+            keys = self._finished[:limit] + self._playing[:max(0, limit - len(self._finished))]
+            return [self._entry(key[2], rank) for rank, key in enumerate(keys, start=1)]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'loaded': self._loaded,
+                'finished': len(self._finished),
+                'playing': len(self._playing),
+            }
+
+
+quest_leaderboard = QuestLeaderboard()
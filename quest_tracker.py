@@ -0,0 +1,155 @@
+from datetime import datetime
+from typing import NamedTuple, Optional
+
+from sqlalchemy import func, update
+
+from app import db, insert_ignore, unit_of_work
+from models import QuestProgress, QuestStep, User
+from quest_leaderboard import quest_leaderboard
+
+
+class ScanResult(NamedTuple):
+    """Итог сканирования QR-кода квеста"""
+    user_id: int
+    is_new: bool
+    found: int
+    just_completed: bool
+    valid_step: bool = True  # False — шага с таким номером нет, ничего не записано
+
+
+def _steps_found(user_id: int) -> int:
+    return db.session.query(QuestProgress.steps_found).filter_by(user_id=user_id).scalar() or 0
+
+
+def _register(user_id: int, step: int, quest_total: int) -> tuple[bool, bool, object]:
+    """Шаг квеста внутри текущей транзакции (commit делает вызывающий код).
+
+    Возвращает (шаг новый, квест завершён этим шагом, строка прогресса для рейтинга).
+    """
+    now = datetime.utcnow()
+    insert_ignore(QuestProgress, ["user_id"], user_id=user_id, started_at=now)
+    if not insert_ignore(QuestStep, ["user_id", "step"], user_id=user_id, step=step, found_at=now):
+        return False, False, _progress(user_id)
+
+    db.session.execute(
+        update(QuestProgress)
+        .where(QuestProgress.user_id == user_id)
+        .values(
+            steps_found=QuestProgress.steps_found + 1,
+            started_at=func.coalesce(QuestProgress.started_at, now),
+            last_step_at=now,
+        )
+    )
+    just_completed = db.session.execute(
+        update(QuestProgress)
+        .where(
+            QuestProgress.user_id == user_id,
+            QuestProgress.completed.isnot(True),
+            QuestProgress.steps_found >= quest_total,
+        )
+        .values(completed=True, completed_at=now)
+    ).rowcount == 1
+
+    progress = _progress(user_id)
+    if just_completed:
+        duration = max(0, int((now - (progress.started_at or now)).total_seconds()))
+        db.session.execute(
+            update(QuestProgress).where(QuestProgress.user_id == user_id).values(duration_seconds=duration)
+        )
+        progress = _progress(user_id)
+    return True, just_completed, progress
+
+
+def _progress(user_id: int):
+    return (
+        db.session.query(
+            QuestProgress.steps_found, QuestProgress.completed, QuestProgress.completed_at,
+            QuestProgress.started_at, QuestProgress.last_step_at, QuestProgress.duration_seconds,
+        )
+        .filter_by(user_id=user_id)
+        .one()
+    )
+
+
+def _update_leaderboard(user_id: int, progress) -> None:
+    quest_leaderboard.update(
+        user_id, progress.steps_found, bool(progress.completed), progress.duration_seconds,
+        progress.completed_at, progress.last_step_at,
+    )
+
+
+def register_step(user_id: int, step: int, quest_total: int) -> tuple[bool, int, bool]:
+    """Отметить найденный шаг одной транзакцией без чтения-изменения-записи.
+
+    Шаг вставляется в quest_steps с игнорированием дубля, счётчик steps_found
+    увеличивается в SQL, а флаг completed ставится условным UPDATE — при
+    одновременных сканированиях квест завершит ровно одно из них.
+    Возвращает (шаг новый, найдено шагов, квест завершён этим шагом).
+    """
+    with unit_of_work():
+        try:
+            is_new, just_completed, progress = _register(user_id, step, quest_total)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+    if is_new:
+        _update_leaderboard(user_id, progress)
+    return is_new, progress.steps_found, just_completed
+
+
+def scan_qr(telegram_id: int, step: int, quest_total: int) -> Optional[ScanResult]:
+    """Быстрый путь QR-кода: пользователь, шаг и прогресс — в одной транзакции.
+
+    None — пользователя нет или он ещё не дал согласие (такой скан идёт
+    обычным /start через онбординг). Номер шага проверяется только для
+    пользователя с согласием.
+    """
+    with unit_of_work():
+        try:
+            user_id = (
+                db.session.query(User.id)
+                .filter(User.telegram_id == str(telegram_id), User.consent_given.is_(True))
+                .scalar()
+            )
+            if user_id is None:
+                return None
+            if not 1 <= step <= quest_total:
+                return ScanResult(user_id, False, _steps_found(user_id), False, valid_step=False)
+            is_new, just_completed, progress = _register(user_id, step, quest_total)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+    if is_new:
+        _update_leaderboard(user_id, progress)
+    return ScanResult(user_id, is_new, progress.steps_found, just_completed)
+
+
+def steps_found(user_id: int) -> int:
+    """Сколько шагов найдено (счётчик в quest_progress, без подсчёта строк)"""
+    with unit_of_work():
+        return _steps_found(user_id)
+
+
+def completed_steps(user_id: int, quest_total: Optional[int] = None) -> list:
+    """Номера найденных шагов по возрастанию"""
+    with unit_of_work():
+        query = db.session.query(QuestStep.step).filter(QuestStep.user_id == user_id)
+        if quest_total is not None:
+            query = query.filter(QuestStep.step.between(1, quest_total))
+        return [step for step, in query.order_by(QuestStep.step)]
+
+
+def reset(user_id: int) -> None:
+    """Удалить прогресс пользователя (без commit — вызывающий код коммитит сам).
+
+    После успешного commit нужно вызвать forget(user_id), чтобы убрать пользователя из рейтинга.
+    """
+    QuestStep.query.filter_by(user_id=user_id).delete()
+    QuestProgress.query.filter_by(user_id=user_id).delete()
+
+
+def forget(user_id: int) -> None:
+    """Убрать пользователя из рейтинга (после commit reset)"""
+    quest_leaderboard.forget(user_id)
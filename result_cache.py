@@ -0,0 +1,142 @@
+import os
+import hashlib
+import logging
+import threading
+
+from typing import Optional
+
+# ═══════════════════════════════════════════════════════════════════════════════
+#                                НАСТРОЙКИ
+# ═══════════════════════════════════════════════════════════════════════════════
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+REPLICATE_CACHE_DIR = os.getenv("REPLICATE_CACHE_DIR", os.path.join(BASE_DIR, "instance", "replicate_cache"))
+REPLICATE_CACHE_MAX_MB = int(os.getenv("REPLICATE_CACHE_MAX_MB", "500"))
+
+
+def content_key(*parts) -> str:
+    """Ключ по содержимому: sha256 от байтов входа и параметров модели"""
+    digest = hashlib.sha256()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = str(part).encode("utf-8")
+        digest.update(len(part).to_bytes(8, "big"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """Дисковый кеш результатов платных моделей, адресуемый по содержимому.
+
+    Файл лежит в <dir>/<ключ[:2]>/<ключ>; запись атомарная (временный файл
+    + os.replace), поэтому оборванная запись не оставит битый результат.
+    Когда общий размер превышает лимит, удаляются файлы, к которым дольше
+    всего не обращались (mtime обновляется при каждом попадании).
+    """
+
+    def __init__(self, directory: str = REPLICATE_CACHE_DIR, max_bytes: int = REPLICATE_CACHE_MAX_MB * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._sizes: Optional[dict[str, int]] = None  # путь -> размер, читается с диска при первом обращении
+        self._total = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def _scan(self) -> None:
+        if self._sizes is not None:
+            return
+        sizes = {}
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                if name.endswith(".tmp"):
+                    # Остаток прерванной записи
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                    continue
+                try:
+                    sizes[path] = os.path.getsize(path)
+                except OSError:
+                    pass
+        self._sizes = sizes
+        self._total = sum(sizes.values())
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with self._lock:
+            self._scan()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.error(f"Error writing result cache entry {key}: {e}")
+            return
+
+        with self._lock:
+            self._total += len(data) - self._sizes.get(path, 0)
+            self._sizes[path] = len(data)
+            if self._total > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        """Удалять самые давно использованные файлы, пока не уложимся в 90% лимита"""
+        target = self.max_bytes * 0.9
+        by_age = []
+        for path in self._sizes:
+            try:
+                by_age.append((os.path.getmtime(path), path))
+            except OSError:
+                by_age.append((0, path))
+        by_age.sort()
+
+        for _, path in by_age:
+            if self._total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self._total -= self._sizes.pop(path)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._scan()
+            requests = self.hits + self.misses
+            return {
+                'files': len(self._sizes),
+                'size_mb': round(self._total / 1024 / 1024, 1),
+                'max_mb': round(self.max_bytes / 1024 / 1024),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / requests, 3) if requests else None,
+                'evictions': self.evictions,
+            }
+
+
+replicate_cache = ResultCache()
@@ -0,0 +1,78 @@
+import os
+import time
+import logging
+
+from telebot.apihelper import ApiTelegramException
+
+from update_dispatcher import ShardedUpdateDispatcher
+
+# ═══════════════════════════════════════════════════════════════════════════════
+#                                НАСТРОЙКИ
+# ═══════════════════════════════════════════════════════════════════════════════
+
+POLLING_WORKERS = int(os.getenv("POLLING_WORKERS", "32"))
+POLLING_QUEUE_SIZE = int(os.getenv("POLLING_QUEUE_SIZE", "100"))  # на один шард, потом polling ждёт
+POLL_TIMEOUT = 20           # long polling getUpdates, секунд
+POLL_LIMIT = 100
+ALLOWED_UPDATES = ["message", "callback_query"]
+
+
+class ShardedPolling:
+    """Режим BOT_MODE=sharded: long polling и пул потоков с порядком внутри чата.
+
+    Один поток получает обновления через getUpdates и раскладывает их
+    по шардам ShardedUpdateDispatcher (как webhook, но со своим числом
+    потоков): обновления одного чата обрабатываются строго по порядку,
+    разных чатов — параллельно. Когда очередь шарда заполнена, polling
+    ждёт, пока она освободится.
+    """
+
+    def __init__(self, workers: int = POLLING_WORKERS, queue_size: int = POLLING_QUEUE_SIZE):
+        self.dispatcher = ShardedUpdateDispatcher(workers, queue_size, name="polling")
+        self.received = 0
+        self.started_at = None
+
+    def run(self, bot) -> None:
+        """Получать обновления и раздавать их шардам (блокирует вызывающий поток)"""
+        self.dispatcher.start(bot)
+        self.started_at = time.time()
+        offset = None
+        error_delay = 1
+        while True:
+            try:
+                updates = bot.get_updates(
+                    offset=offset, limit=POLL_LIMIT, timeout=POLL_TIMEOUT,
+                    allowed_updates=ALLOWED_UPDATES, long_polling_timeout=POLL_TIMEOUT,
+                )
+                error_delay = 1
+            except ApiTelegramException as e:
+                if e.error_code == 409:
+                    logging.error("❌ Конфликт экземпляров бота (409). Ожидание 10 сек...")
+                    time.sleep(10)
+                else:
+                    logging.error(f"getUpdates error: {e}")
+                    time.sleep(error_delay)
+                    error_delay = min(30, error_delay * 2)
+                continue
+            except Exception as e:
+                logging.error(f"getUpdates error: {e}")
+                time.sleep(error_delay)
+                error_delay = min(30, error_delay * 2)
+                continue
+
+            for update in updates:
+                offset = update.update_id + 1
+                self.dispatcher.submit(update, block=True)
+                self.received += 1
+
+    def stats(self) -> dict:
+        """Очереди шардов и счётчики для мониторинга"""
+        return {
+            'running': self.started_at is not None,
+            'received': self.received,
+            'uptime': round(time.time() - self.started_at) if self.started_at else 0,
+            **self.dispatcher.stats(),
+        }
+
+
+sharded_polling = ShardedPolling()
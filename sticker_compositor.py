@@ -0,0 +1,108 @@
+import io
+import os
+import threading
+
+from typing import Iterable, Optional
+
+from PIL import Image
+
+STICKER_SIZE = 512
+STICKER_MAX_BYTES = 512 * 1024  # лимит Telegram для статичного стикера
+PERSON_SIZE = 320
+PERSON_OFFSET_Y = -30   # фигура чуть выше центра, под шильдиком
+
+
+class StickerCompositor:
+    """Сборка стикера из подготовленных слоёв шаблона.
+
+    Фон и шильдик открываются, переводятся в RGBA и масштабируются до
+    512×512 один раз; повторная подготовка — только если файл на диске
+    заменили (по mtime/размеру) или после invalidate() из админки.
+    Слои накладываются через Image.alpha_composite в памяти.
+    """
+
+    def __init__(self, background_path: str, shildik_path: str, size: int = STICKER_SIZE):
+        self.background_path = os.path.abspath(background_path)
+        self.shildik_path = os.path.abspath(shildik_path)
+        self.size = size
+        self._layers: dict[str, tuple] = {}  # path -> ((mtime, size), Image)
+        self._lock = threading.Lock()
+
+    def _layer(self, path: str) -> Image.Image:
+        stat = os.stat(path)
+        version = (stat.st_mtime, stat.st_size)
+        cached = self._layers.get(path)
+        if cached and cached[0] == version:
+            return cached[1]
+
+        with self._lock:
+            cached = self._layers.get(path)
+            if cached and cached[0] == version:
+                return cached[1]
+            with Image.open(path) as img:
+                layer = img.convert("RGBA").resize((self.size, self.size), Image.Resampling.LANCZOS)
+            layer.load()
+            self._layers[path] = (version, layer)
+            return layer
+
+    def available(self) -> bool:
+        return os.path.exists(self.background_path) and os.path.exists(self.shildik_path)
+
+    def invalidate(self, path: Optional[str] = None) -> None:
+        """Сбросить подготовленные слои (все или один файл)"""
+        with self._lock:
+            if path is None:
+                self._layers.clear()
+            else:
+                self._layers.pop(os.path.abspath(path), None)
+
+    def warm_up(self) -> None:
+        """Подготовить слои заранее, чтобы первый стикер не тратил на это время"""
+        if self.available():
+            self._layer(self.background_path)
+            self._layer(self.shildik_path)
+
+    @staticmethod
+    def _prepare_person(person_img: Image.Image) -> Image.Image:
+        if person_img.mode != "RGBA":
+            person_img = person_img.convert("RGBA")
+        if person_img.size != (PERSON_SIZE, PERSON_SIZE):
+            person_img = person_img.resize((PERSON_SIZE, PERSON_SIZE), Image.Resampling.LANCZOS)
+        return person_img
+
+    def _compose(self, background: Image.Image, shildik: Image.Image, person_img: Image.Image) -> Image.Image:
+        person_img = self._prepare_person(person_img)
+        x = (self.size - person_img.width) // 2
+        y = (self.size - person_img.height) // 2 + PERSON_OFFSET_Y
+
+        result = background.copy()
+        result.alpha_composite(person_img, (x, y))
+        result.alpha_composite(shildik)
+        return result
+
+    def compose(self, person_img: Image.Image) -> Image.Image:
+        """Фон + фигура + шильдик → RGBA 512×512"""
+        return self._compose(self._layer(self.background_path), self._layer(self.shildik_path), person_img)
+
+    @staticmethod
+    def encode_sticker(image: Image.Image) -> bytes:
+        """Закодировать стикер один раз: WebP без потерь (быстрый режим), как требует Telegram.
+
+        Если результат не укладывается в лимит 512 КБ, кодируем с потерями.
+        """
+        buf = io.BytesIO()
+        image.save(buf, format="WEBP", lossless=True, method=0)
+        if buf.tell() > STICKER_MAX_BYTES:
+            buf = io.BytesIO()
+            image.save(buf, format="WEBP", quality=90, method=4)
+        return buf.getvalue()
+
+    def compose_sticker(self, person_img: Image.Image) -> bytes:
+        """Готовый файл стикера (WebP 512×512)"""
+        return self.encode_sticker(self.compose(person_img))
+
+    def compose_many(self, person_imgs: Iterable[Image.Image]) -> list[bytes]:
+        """Собрать несколько стикеров за один вызов (слои берутся один раз)"""
+        background = self._layer(self.background_path)
+        shildik = self._layer(self.shildik_path)
+        return [self.encode_sticker(self._compose(background, shildik, person_img)) for person_img in person_imgs]
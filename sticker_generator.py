@@ -1,15 +1,22 @@
 import io
 import logging
 import os
-from typing import Tuple, Optional
+import threading
+import time
+from typing import Callable, Tuple, Optional
 import replicate
-import requests
 from PIL import Image
 from telebot.types import InputSticker
+from telebot.apihelper import ApiTelegramException
 import telebot
-import re
-from app import app, db
+from app import app, db, unit_of_work
+from media_registry import is_stale_file_id_error, media_registry
+from sticker_packs import sticker_packs
+from result_cache import replicate_cache, content_key
+from image_backends import IMAGE_BACKEND, ReplicateBackend, create_backend
+from model_guard import CircuitOpenError, ModelCallGuard
 from models import User, StickerGeneration
+from sticker_compositor import StickerCompositor
 
 # ──────────────────── ЛОГИРОВАНИЕ ────────────────────
 log_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs")
@@ -33,6 +40,9 @@ SHILDIK_PATH = os.path.join(IMG_DIR, "shildik.png")
 UPLOAD_DIR = os.path.join(BASE_DIR, "static", "uploads")
 AVITO_STICKERS_DIR = os.path.join(BASE_DIR, "static", "stickers")
 
+# Слои шаблона стикера готовятся один раз (и заново — только при замене файлов)
+sticker_compositor = StickerCompositor(BACKGROUND_PATH, SHILDIK_PATH)
+
 # Создаем необходимые директории если их нет
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(AVITO_STICKERS_DIR, exist_ok=True)
@@ -41,7 +51,7 @@ os.makedirs(AVITO_STICKERS_DIR, exist_ok=True)
 def get_replicate_token():
     try:
         from models import SystemConfig
-        with app.app_context():
+        with unit_of_work():
             # Сначала проверяем базу данных
             db_token = SystemConfig.get_config('REPLICATE_API_TOKEN')
             if db_token:
@@ -61,105 +71,84 @@ if REPLICATE_API_TOKEN:
 else:
     logging.warning("REPLICATE_API_TOKEN не задан - функция генерации стикеров отключена")
 
+# Бэкенд моделей: Replicate или локальная заглушка (IMAGE_BACKEND=stub)
+image_backend = create_backend(IMAGE_BACKEND, replicate_client)
+
 # ──────────────────── УТИЛИТЫ ─────────────────────────
-def _grab_url(raw) -> Optional[str]:
-    if not raw:
-        return None
-    if isinstance(raw, str) and raw.startswith("http"):
-        return raw
-    if isinstance(raw, (list, tuple)):
-        for item in raw:
-            url = _grab_url(item)
-            if url:
-                return url
-    if isinstance(raw, dict):
-        for key in ("image", "images", "url", "output"):
-            if key in raw:
-                url = _grab_url(raw[key])
-                if url:
-                    return url
-    return None
-
-def assemble_sticker(person_img: Image.Image) -> Optional[io.BytesIO]:
+def assemble_sticker(person_img: Image.Image) -> Optional[bytes]:
+    """Собрать стикер и закодировать его один раз (WebP 512×512)"""
     try:
-        if not os.path.exists(BACKGROUND_PATH) or not os.path.exists(SHILDIK_PATH):
+        if not sticker_compositor.available():
             logging.warning("Нет background.png или shildik.png — пропускаем сборку")
             return None
-
-        background = Image.open(BACKGROUND_PATH).convert("RGBA").resize((512, 512), Image.Resampling.LANCZOS)
-        shildik = Image.open(SHILDIK_PATH).convert("RGBA").resize((512, 512), Image.Resampling.LANCZOS)
-        if person_img.size != (320, 320):
-            person_img = person_img.resize((320, 320), Image.Resampling.LANCZOS)
-
-        x = (512 - person_img.width) // 2
-        y = (512 - person_img.height) // 2 - 30
-
-        result = background.copy()
-        result.paste(person_img, (x, y), person_img)
-        result.paste(shildik, (0, 0), shildik)
-
-        buf = io.BytesIO()
-        result.save(buf, format="PNG")
-        buf.seek(0)
-        return buf
+        return sticker_compositor.compose_sticker(person_img)
     except Exception as err:
         logging.error(f"Ошибка сборки стикера: {err}")
         return None
 
-def create_sticker_pack(bot: telebot.TeleBot, chat_id: int, user_sticker_path: str) -> Optional[str]:
+def shared_sticker_paths() -> list:
+    """Общие стикеры Авито (static/stickers/1.png … 8.png), которые есть на диске"""
+    paths = [os.path.join(AVITO_STICKERS_DIR, f"{i}.png") for i in range(1, 9)]
+    return [path for path in paths if os.path.exists(path)]
+
+def shared_sticker_file_ids(bot: telebot.TeleBot, owner_id: int) -> list:
+    """file_id общих стикеров: каждый загружается в Telegram один раз на все стикерпаки"""
+    return [media_registry.sticker_file_id(bot, owner_id, path) for path in shared_sticker_paths()]
+
+def create_sticker_set(bot: telebot.TeleBot, chat_id: int, name: str, title: str, user_sticker_file_id: str) -> None:
+    """Создать набор из стикера пользователя и общих стикеров (по file_id, без повторной загрузки)"""
+    for attempt in range(2):
+        stickers = [InputSticker(user_sticker_file_id, emoji_list=["😊"])]
+        stickers += [InputSticker(file_id, emoji_list=["😊"]) for file_id in shared_sticker_file_ids(bot, chat_id)]
+        try:
+            bot.create_new_sticker_set(
+                user_id=chat_id,
+                name=name,
+                title=title,
+                stickers=stickers,
+                sticker_format="static"
+            )
+            return
+        except ApiTelegramException as e:
+            if attempt or not is_stale_file_id_error(e):
+                raise
+            # Сохранённые file_id больше не принимаются (сменился бот или токен) — загружаем общие стикеры заново
+            logging.warning(f"[{chat_id}] Shared sticker file_ids rejected, re-uploading: {e}")
+            for path in shared_sticker_paths():
+                media_registry.forget(path, 'sticker')
+
+def create_sticker_pack(bot: telebot.TeleBot, chat_id: int, user_sticker_file_id: str) -> str:
     try:
         logging.info(f"[{chat_id}] Creating sticker pack")
 
-        with app.app_context():
+        with unit_of_work():
             user = User.query.filter_by(telegram_id=str(chat_id)).first()
             if not user:
-                logging.error(f"[{chat_id}] Пользователь не найден")
-                bot.send_message(chat_id, "⚠️ Пользователь не найден. Начните с /start.")
-                return None
-
-        # Создаем уникальное имя для стикерпака
-        bot_username = bot.get_me().username
+                raise StickerGenerationError("user not found", "⚠️ Пользователь не найден. Начните с /start.")
 
-        # Короткое и лаконичное имя: AvitoTeam_ID
-        pack_short_name = f"avitoteam_{chat_id}_by_{bot_username}"
-        pack_short_name = re.sub(r'[^a-z0-9_]', '', pack_short_name.lower())[:64]
+        # Короткое и лаконичное имя: AvitoTeam_ID (имя бота запоминается один раз)
+        pack_short_name = sticker_packs.pack_name(chat_id, bot)
 
         # Лаконичный заголовок
         pack_title = f"AvitoTeam_{chat_id}"
 
         pack_url = f"https://t.me/addstickers/{pack_short_name}"
 
-        # Создаем список стикеров, начиная с пользовательского стикера
-        stickers = [InputSticker(open(user_sticker_path, "rb"), emoji_list=["😊"])]
-
-        # Добавляем стикеры из папки static/stickers
-        stickers_dir = os.path.join(BASE_DIR, "static", "stickers")
-        for i in range(1, 9):  # Предполагаем, что у нас есть стикеры с именами 1.png, 2.png, ..., 8.png
-            sticker_path = os.path.join(stickers_dir, f"{i}.png")
-            if os.path.exists(sticker_path):
-                stickers.append(InputSticker(open(sticker_path, "rb"), emoji_list=["😊"]))
-
-        # Создаем стикерпак
-        bot.create_new_sticker_set(
-            user_id=chat_id,
-            name=pack_short_name,
-            title=pack_title,
-            stickers=stickers,
-            sticker_format="static"
-        )
+        # Стикер пользователя уже загружен в Telegram, общие стикеры — один раз на все наборы
+        create_sticker_set(bot, chat_id, pack_short_name, pack_title, user_sticker_file_id)
         logging.info(f"[{chat_id}] Created sticker pack {pack_short_name}")
 
         pack_url = f"https://t.me/addstickers/{pack_short_name}"
         logging.info(f"[{chat_id}] Sticker pack created: {pack_url}")
 
-        with app.app_context():
+        with unit_of_work():
             user = User.query.filter_by(telegram_id=str(chat_id)).first()
             if user:
                 # Обновляем существующую запись или создаем новую
                 existing_gen = StickerGeneration.query.filter_by(user_id=user.id).first()
                 if existing_gen:
                     existing_gen.template_used = "avito_team"
-                    existing_gen.generated_file_id = f"sticker_{chat_id}.png"
+                    existing_gen.generated_file_id = user_sticker_file_id
                     existing_gen.sticker_set_name = pack_short_name
                     existing_gen.sticker_set_link = pack_url
                     existing_gen.pack_url = pack_url
@@ -169,7 +158,7 @@ def create_sticker_pack(bot: telebot.TeleBot, chat_id: int, user_sticker_path: s
                     sticker_gen = StickerGeneration(
                         user_id=user.id,
                         template_used="avito_team",
-                        generated_file_id=f"sticker_{chat_id}.png",
+                        generated_file_id=user_sticker_file_id,
                         sticker_set_name=pack_short_name,
                         sticker_set_link=pack_url,
                         pack_url=pack_url,
@@ -180,6 +169,7 @@ def create_sticker_pack(bot: telebot.TeleBot, chat_id: int, user_sticker_path: s
                 db.session.commit()
                 logging.info(f"[{chat_id}] Sticker generation record saved successfully")
 
+        sticker_packs.register(chat_id, pack_short_name, pack_url)
         return pack_url
 
     except Exception as err:
@@ -197,7 +187,7 @@ def create_sticker_pack(bot: telebot.TeleBot, chat_id: int, user_sticker_path: s
                     logging.info(f"[{chat_id}] Sticker pack confirmed exists, updating DB")
                     
                     # Обновляем запись в базе данных
-                    with app.app_context():
+                    with unit_of_work():
                         user = User.query.filter_by(telegram_id=str(chat_id)).first()
                         if user:
                             existing_gen = StickerGeneration.query.filter_by(user_id=user.id).first()
@@ -211,7 +201,7 @@ def create_sticker_pack(bot: telebot.TeleBot, chat_id: int, user_sticker_path: s
                                 sticker_gen = StickerGeneration(
                                     user_id=user.id,
                                     template_used="avito_team",
-                                    generated_file_id=f"sticker_{chat_id}.png",
+                                    generated_file_id=user_sticker_file_id,
                                     sticker_set_name=pack_short_name,
                                     sticker_set_link=pack_url,
                                     pack_url=pack_url,
@@ -219,7 +209,8 @@ def create_sticker_pack(bot: telebot.TeleBot, chat_id: int, user_sticker_path: s
                                 )
                                 db.session.add(sticker_gen)
                             db.session.commit()
-                    
+
+                    sticker_packs.register(chat_id, pack_short_name, pack_url)
                     return pack_url
                 else:
                     logging.info(f"[{chat_id}] Sticker pack name occupied but pack is empty/deleted, continuing creation")
@@ -232,11 +223,8 @@ def create_sticker_pack(bot: telebot.TeleBot, chat_id: int, user_sticker_path: s
         # Дополнительная проверка через URL только если API подтвердил существование
         # (убираем эту проверку, так как она может давать ложные срабатывания)
 
-        try:
-            bot.send_message(chat_id, "⚠️ Ошибка при создании стикерпака.")
-        except Exception as send_error:
-            logging.error(f"[{chat_id}] Failed to send error message: {send_error}")
-        return None
+        # Повторять или нет и что написать пользователю, решает очередь заданий
+        raise
 
 def reinitialize_replicate_client():
     """Переинициализация клиента Replicate с новым токеном"""
@@ -246,193 +234,258 @@ def reinitialize_replicate_client():
     
     if REPLICATE_API_TOKEN:
         replicate_client = replicate.Client(api_token=REPLICATE_API_TOKEN)
+        if isinstance(image_backend, ReplicateBackend):
+            image_backend.client = replicate_client
         logging.info("✅ Replicate клиент переинициализирован с новым токеном")
         return True
     else:
         replicate_client = None
+        if isinstance(image_backend, ReplicateBackend):
+            image_backend.client = None
         logging.warning("❌ Не удалось переинициализировать Replicate клиент - токен не найден")
         return False
 
-def generate_sticker_from_user_photo(file_url: str, chat_id: int, bot) -> Tuple[Optional[io.BytesIO], Optional[str], Optional[str], Optional[str]]:
-    """Generate sticker from user photo - limit one successful generation per user"""
+# ──────────────────── ЭТАПЫ ГЕНЕРАЦИИ ─────────────────
+# fetch → stylize → bg_remove → compose → publish. У каждого этапа свой лимит
+# параллельности: пока медленные вызовы модели занимают слоты stylize/bg_remove,
+# сборка и загрузка в Telegram других заданий идут параллельно.
+
+class StickerGenerationError(Exception):
+    """Генерация невозможна и повтор не поможет; user_message уходит пользователю"""
+
+    def __init__(self, reason: str, user_message: str = "⚠️ Не удалось создать стикерпак. Попробуй еще раз с другим фото."):
+        super().__init__(reason)
+        self.user_message = user_message
+
+
+class EmptyResultError(Exception):
+    """Модель или Telegram ответили без изображения — задание можно повторить"""
+
+
+class StageError(Exception):
+    """Этап не выполнился после всех попыток"""
+
+    def __init__(self, stage: str, error: Exception):
+        super().__init__(f"{stage}: {error}")
+        self.stage = stage
+        self.error = error
+
+
+class PipelineStage:
+    """Этап генерации со своим лимитом параллельности и политикой повторов"""
+
+    def __init__(self, name: str, limit: int, attempts: int = 1, backoff: float = 2.0):
+        self.name = name
+        self.limit = limit
+        self.attempts = attempts
+        self.backoff = backoff
+        self._semaphore = threading.BoundedSemaphore(limit)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.retries = 0
+        self.deferred = 0
+        self.total_time = 0.0
+
+    def run(self, chat_id: int, func: Callable, *args):
+        last_error = None
+        for attempt in range(1, self.attempts + 1):
+            with self._semaphore:
+                with self._lock:
+                    self.in_flight += 1
+                started = time.monotonic()
+                try:
+                    result = func(*args)
+                    with self._lock:
+                        self.completed += 1
+                    return result
+                except CircuitOpenError:
+                    # Модель недоступна — повторять здесь бессмысленно, задание вернётся в очередь
+                    with self._lock:
+                        self.deferred += 1
+                    raise
+                except StickerGenerationError:
+                    with self._lock:
+                        self.failed += 1
+                    raise
+                except Exception as e:
+                    last_error = e
+                    logging.warning(f"[{chat_id}] Stage {self.name} failed (attempt {attempt}/{self.attempts}): {e}")
+                finally:
+                    with self._lock:
+                        self.in_flight -= 1
+                        self.total_time += time.monotonic() - started
+            # Пауза перед повтором — вне семафора, чтобы не занимать слот этапа
+            if attempt < self.attempts:
+                with self._lock:
+                    self.retries += 1
+                time.sleep(self.backoff * attempt)
+
+        with self._lock:
+            self.failed += 1
+        raise StageError(self.name, last_error)
+
+    def stats(self) -> dict:
+        with self._lock:
+            runs = self.completed + self.failed
+            return {
+                'limit': self.limit,
+                'in_flight': self.in_flight,
+                'completed': self.completed,
+                'failed': self.failed,
+                'retries': self.retries,
+                'deferred': self.deferred,
+                'avg_seconds': round(self.total_time / runs, 2) if runs else None,
+            }
+
+
+STAGES = {
+    'fetch': PipelineStage('fetch', int(os.getenv("STICKER_FETCH_CONCURRENCY", "8")), attempts=3, backoff=1.0),
+    'stylize': PipelineStage('stylize', int(os.getenv("STICKER_STYLIZE_CONCURRENCY", "4")), attempts=2, backoff=5.0),
+    'bg_remove': PipelineStage('bg_remove', int(os.getenv("STICKER_BG_REMOVE_CONCURRENCY", "4")), attempts=2, backoff=5.0),
+    'compose': PipelineStage('compose', int(os.getenv("STICKER_COMPOSE_CONCURRENCY", "2"))),
+    'publish': PipelineStage('publish', int(os.getenv("STICKER_PUBLISH_CONCURRENCY", "4"))),
+}
+
+
+# Вызовы моделей: лимит подстраивается под задержки и ошибки (не выше лимита этапа),
+# после серии ошибок предохранитель сразу отклоняет вызовы и задания ждут в очереди
+MODEL_GUARDS = {
+    'stylize': ModelCallGuard('stylize', STAGES['stylize'].limit, float(os.getenv("STYLIZE_LATENCY_TARGET", "60"))),
+    'bg_remove': ModelCallGuard('bg_remove', STAGES['bg_remove'].limit, float(os.getenv("BG_REMOVE_LATENCY_TARGET", "30"))),
+}
+
+
+def pipeline_stats() -> dict:
+    """Состояние этапов генерации для мониторинга"""
+    return {name: stage.stats() for name, stage in STAGES.items()}
+
+
+def model_stats() -> dict:
+    """Лимиты, задержки и состояние предохранителей моделей"""
+    return {name: guard.stats() for name, guard in MODEL_GUARDS.items()}
+
+
+def model_retry_after() -> float:
+    """Сколько ждать, прежде чем брать новые задания (0 — модели доступны)"""
+    return max(guard.retry_after() for guard in MODEL_GUARDS.values())
+
+
+def fetch_photo(bot, file_id: str) -> Tuple[str, bytes]:
+    """fetch: ссылка на исходное фото в Telegram и его байты (по ним ищется готовый результат)"""
+    file_info = bot.get_file(file_id)
+    return f"https://api.telegram.org/file/bot{bot.token}/{file_info.file_path}", bot.download_file(file_info.file_path)
+
+
+def stylize_photo(file_url: str, photo_bytes: Optional[bytes] = None) -> bytes:
+    """stylize: мультяшный аватар, возвращает PNG.
+
+    Результат кешируется по хешу исходного фото и параметрам модели, так что
+    повторная отправка того же фото не вызывает модель.
+    """
+    key = content_key("stylize", *image_backend.cache_tag("stylize"), photo_bytes) if photo_bytes else None
+    if key:
+        cached = replicate_cache.get(key)
+        if cached:
+            return cached
+
+    cartoon_png = MODEL_GUARDS['stylize'].call(image_backend.stylize, file_url, photo_bytes)
+    if not cartoon_png:
+        raise EmptyResultError("stylize model did not return an image")
+    if key:
+        replicate_cache.put(key, cartoon_png)
+    return cartoon_png
+
+
+def remove_background(cartoon_png: bytes) -> bytes:
+    """bg_remove: убрать фон, возвращает PNG с прозрачностью (кешируется по хешу входа)"""
+    key = content_key("bg_remove", *image_backend.cache_tag("bg_remove"), cartoon_png)
+    cached = replicate_cache.get(key)
+    if cached:
+        return cached
+
+    person_png = MODEL_GUARDS['bg_remove'].call(image_backend.remove_background, cartoon_png)
+    if not person_png:
+        raise EmptyResultError("background remover did not return an image")
+    replicate_cache.put(key, person_png)
+    return person_png
+
+
+def compose_sticker(chat_id: int, person_png: bytes, save_path: str) -> bytes:
+    """compose: собрать стикер и сохранить на диск те же байты, что уйдут в Telegram"""
+    person_img = Image.open(io.BytesIO(person_png)).convert("RGBA")
+    if person_img.size[0] < 100 or person_img.size[1] < 100:
+        raise StickerGenerationError(f"image too small: {person_img.size}")
+
+    sticker_bytes = assemble_sticker(person_img)
+    if not sticker_bytes:
+        # Без фона и шильдика стикер не публикуется: задание повторится (например, после загрузки шаблона)
+        raise EmptyResultError("sticker template is unavailable or failed to compose")
+
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    with open(save_path, "wb") as f:
+        f.write(sticker_bytes)
+    return sticker_bytes
+
+
+def publish_sticker(bot, chat_id: int, sticker_bytes: bytes):
+    """publish: одна загрузка стикера, его file_id идёт и в превью, и в стикерпак"""
+    upload = io.BytesIO(sticker_bytes)
+    upload.name = "sticker.webp"
+    sent = bot.send_sticker(chat_id, upload)
+    file_id = sent.sticker.file_id if sent and sent.sticker else None
+    if not file_id:
+        raise EmptyResultError("Telegram did not return the sticker file_id")
 
-    # Проверяем существующий стикерпак по имени в Telegram API
-    bot_username = bot.get_me().username
-    pack_short_name = f"avitoteam_{chat_id}_by_{bot_username}"
-    pack_short_name = re.sub(r'[^a-z0-9_]', '', pack_short_name.lower())[:64]
-    pack_url = f"https://t.me/addstickers/{pack_short_name}"
+    pack_url = create_sticker_pack(bot, chat_id, file_id)
+    return io.BytesIO(sticker_bytes), file_id, pack_url, None
 
-    def update_db_and_return_existing():
-        """Обновляет БД и возвращает существующий стикерпак"""
-        with app.app_context():
-            user = User.query.filter_by(telegram_id=str(chat_id)).first()
-            if user:
-                existing_gen = StickerGeneration.query.filter_by(user_id=user.id).first()
-                if existing_gen:
-                    existing_gen.sticker_set_name = pack_short_name
-                    existing_gen.sticker_set_link = pack_url
-                    existing_gen.pack_url = pack_url
-                    existing_gen.status = "ok"
-                    existing_gen.template_used = "avito_team"
-                else:
-                    sticker_gen = StickerGeneration(
-                        user_id=user.id,
-                        template_used="avito_team",
-                        generated_file_id=f"sticker_{chat_id}.png",
-                        sticker_set_name=pack_short_name,
-                        sticker_set_link=pack_url,
-                        pack_url=pack_url,
-                        status="ok"
-                    )
-                    db.session.add(sticker_gen)
-                db.session.commit()
-        return None, None, pack_url, f"У вас уже есть готовый стикерпак!\n\nСсылка: {pack_url}\n\nДобавьте его в Telegram и пользуйтесь!"
 
-    # 1. Проверяем в базе данных
-    try:
-        with app.app_context():
-            user = User.query.filter_by(telegram_id=str(chat_id)).first()
-            if user:
-                existing_gen = StickerGeneration.query.filter_by(
-                    user_id=user.id, 
-                    status='ok'
-                ).filter(
-                    StickerGeneration.pack_url.isnot(None)
-                ).first()
-
-                if existing_gen and existing_gen.pack_url:
-                    logging.info(f"[{chat_id}] Found existing sticker pack in DB: {existing_gen.pack_url}")
-                    return None, None, existing_gen.pack_url, f"У вас уже есть готовый стикерпак!\n\nСсылка: {existing_gen.pack_url}\n\nДобавьте его в Telegram и пользуйтесь!"
-    except Exception as db_error:
-        logging.warning(f"[{chat_id}] DB check error: {db_error}")
-
-    # 2. Проверяем через Telegram API
-    try:
-        sticker_set = bot.get_sticker_set(pack_short_name)
-        if sticker_set and hasattr(sticker_set, 'stickers') and len(sticker_set.stickers) > 0:
-            logging.info(f"[{chat_id}] Found existing sticker pack in Telegram: {pack_url}")
-            return update_db_and_return_existing()
-    except Exception as e:
-        # Если ошибка содержит "not found" - стикерпак точно не существует
-        if "not found" in str(e).lower() or "sticker set not found" in str(e).lower():
-            logging.info(f"[{chat_id}] Sticker pack confirmed not found: {e}")
-        else:
-            logging.info(f"[{chat_id}] Sticker pack check in Telegram failed: {e}")
+def run_sticker_pipeline(bot, chat_id: int, source_file_id: str) -> Tuple[Optional[io.BytesIO], Optional[str], Optional[str], Optional[str]]:
+    """Полный цикл генерации для задания из очереди: fetch, затем остальные этапы"""
+    file_url, photo_bytes = STAGES['fetch'].run(chat_id, fetch_photo, bot, source_file_id)
+    return generate_sticker_from_user_photo(file_url, chat_id, bot, photo_bytes)
 
-    # 3. Проверяем через URL (более строгая проверка)
-    try:
-        import requests
-        response = requests.get(pack_url, timeout=10)
-        if response.status_code == 200:
-            # Проверяем, что страница содержит реальный стикерпак, а не ошибку
-            text_lower = response.text.lower()
-            if ("addstickers" in text_lower or "stickerset" in text_lower) and "not found" not in text_lower and "404" not in text_lower:
-                logging.info(f"[{chat_id}] Sticker pack exists via URL check: {pack_url}")
-                return update_db_and_return_existing()
-            else:
-                logging.info(f"[{chat_id}] URL check shows sticker pack does not exist")
-        else:
-            logging.info(f"[{chat_id}] URL check failed with status: {response.status_code}")
-    except Exception as e:
-        logging.info(f"[{chat_id}] URL check failed: {e}")
+def generate_sticker_from_user_photo(file_url: str, chat_id: int, bot, photo_bytes: Optional[bytes] = None) -> Tuple[Optional[io.BytesIO], Optional[str], Optional[str], Optional[str]]:
+    """Generate sticker from user photo - limit one successful generation per user.
+
+    Ошибки не перехватываются: StickerGenerationError — повтор не поможет,
+    остальные исключения — повод повторить задание. Повторы и сообщения
+    об ошибках — забота очереди (sticker_jobs).
+    """
+
+    # Индекс стикерпаков — единственный источник ответа «уже есть»; сверка с Telegram идёт в фоне
+    pack_url = sticker_packs.get(chat_id)
+    if pack_url:
+        logging.info(f"[{chat_id}] Found existing sticker pack: {pack_url}")
+        return None, None, pack_url, f"У вас уже есть готовый стикерпак!\n\nСсылка: {pack_url}\n\nДобавьте его в Telegram и пользуйтесь!"
 
     # Если дошли до сюда - стикерпак не существует, продолжаем с генерацией
     logging.info(f"[{chat_id}] No existing sticker pack found, proceeding with generation")
 
-    try:
-        if not replicate_client:
-            # Пытаемся переинициализировать клиент на случай, если токен был добавлен через админку
-            logging.info(f"[{chat_id}] Replicate клиент не инициализирован, пытаемся переинициализировать...")
-            if not reinitialize_replicate_client():
-                logging.error(f"[{chat_id}] REPLICATE_API_TOKEN не настроен")
-                bot.send_message(chat_id, "⚠️ Генерация стикеров временно недоступна. Обратитесь к администратору.")
-                return None, None, None, None
-
-        logging.info(f"[{chat_id}] Starting sticker generation, photo_url={file_url}")
-        if not file_url.startswith("https://"):
-            logging.error(f"[{chat_id}] Invalid photo URL: {file_url}")
-            return None, None, None, None
-
-        with app.app_context():
-            # Проверяем лимит генераций для пользователя
-            user = User.query.filter_by(telegram_id=str(chat_id)).first()
-            if not user:
-                logging.error(f"User not found for chat_id: {chat_id}")
-                return None, None, None, None
-
-            # Дополнительная проверка на всякий случай
-            existing_generation = StickerGeneration.query.filter_by(
-                user_id=user.id
-            ).filter(
-                StickerGeneration.status.in_(['ok', 'completed'])
-            ).first()
-            if existing_generation and existing_generation.pack_url:
-                logging.info(f"User {user.id} already has a completed sticker generation")
-                return None, None, existing_generation.pack_url, "У вас уже есть сгенерированный стикерпак"
-
-        flux_raw = replicate_client.run(
-            "black-forest-labs/flux-kontext-pro",
-            input={
-                "seed": 1224737784,
-                "prompt": (
-                    "Make a cute cartoon avatar in simple flat vector style with bold outlines, "
-                    "clean shapes, and no shading. Remove all text, logos, or watermarks. "
-                    "Solid or transparent background."
-                ),
-                "input_image": file_url,
-                "aspect_ratio": "1:1",
-                "output_format": "png",
-                "safety_tolerance": 2,
-            },
-        )
-        cartoon_url = _grab_url(flux_raw)
-        if not cartoon_url:
-            logging.error(f"[{chat_id}] Flux did not return a valid URL")
-            return None, None, None, None
-
-        bg_raw = replicate_client.run(
-            "851-labs/background-remover:a029dff38972b5fda4ec5d75d7d1cd25aeff621d2cf4946a41055d7db66b80bc",
-            input={"image": cartoon_url, "format": "png", "background_type": "rgba"},
-        )
-        clean_url = _grab_url(bg_raw)
-        if not clean_url:
-            logging.error(f"[{chat_id}] Background Remover did not return a valid URL")
-            return None, None, None, None
-
-        resp = requests.get(clean_url, timeout=20)
-        resp.raise_for_status()
-        person_img = Image.open(io.BytesIO(resp.content)).convert("RGBA")
-        if person_img.size[0] < 100 or person_img.size[1] < 100:
-            logging.error(f"[{chat_id}] Image too small: {person_img.size}")
-            return None, None, None, None
-        person_img = person_img.resize((320, 320), Image.Resampling.LANCZOS)
-
-        sticker_buf = assemble_sticker(person_img)
-        if not sticker_buf:
-            fallback_buf = io.BytesIO(resp.content)
-            fallback_buf.seek(0)
-            sent = bot.send_photo(chat_id, fallback_buf, caption="Ваш стикер (без фона и шильдика).")
-            file_id = sent.photo[-1].file_id if sent and sent.photo else None
-            return fallback_buf, file_id, None, None
-
-        save_path = os.path.join(UPLOAD_DIR, f"sticker_{chat_id}.png")
-        os.makedirs(UPLOAD_DIR, exist_ok=True)
-        sticker_buf.seek(0)
-        Image.open(sticker_buf).convert("RGBA").save(save_path, format="PNG")
-
-        pack_url = create_sticker_pack(bot, chat_id, save_path)
-        if not pack_url:
-            return sticker_buf, None, None, None
-
-        sticker_buf.seek(0)
-        sent = bot.send_photo(chat_id, sticker_buf)
-        file_id = sent.photo[-1].file_id if sent and sent.photo else None
-        return sticker_buf, file_id, pack_url, None
+    if not image_backend.available():
+        # Пытаемся переинициализировать клиент на случай, если токен был добавлен через админку
+        logging.info(f"[{chat_id}] Replicate клиент не инициализирован, пытаемся переинициализировать...")
+        if not reinitialize_replicate_client():
+            raise StickerGenerationError(
+                "REPLICATE_API_TOKEN не настроен",
+                "⚠️ Генерация стикеров временно недоступна. Обратитесь к администратору.",
+            )
 
-    except Exception as err:
-        logging.error(f"[{chat_id}] Sticker generation failed: {err}")
-        try:
-            bot.send_message(chat_id, "⚠️ Ошибка при генерации стикера.")
-        except Exception:
-            pass
-        return None, None, None, None
\ No newline at end of file
+    logging.info(f"[{chat_id}] Starting sticker generation, photo_url={file_url}")
+    if not file_url.startswith("https://"):
+        raise StickerGenerationError(f"invalid photo URL: {file_url}")
+
+    with unit_of_work():
+        user = User.query.filter_by(telegram_id=str(chat_id)).first()
+        if not user:
+            raise StickerGenerationError("user not found", "⚠️ Пользователь не найден. Начните с /start.")
+
+    cartoon_png = STAGES['stylize'].run(chat_id, stylize_photo, file_url, photo_bytes)
+    person_png = STAGES['bg_remove'].run(chat_id, remove_background, cartoon_png)
+
+    save_path = os.path.join(UPLOAD_DIR, f"sticker_{chat_id}.webp")
+    sticker_bytes = STAGES['compose'].run(chat_id, compose_sticker, chat_id, person_png, save_path)
+
+    return STAGES['publish'].run(chat_id, publish_sticker, bot, chat_id, sticker_bytes)
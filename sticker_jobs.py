@@ -0,0 +1,320 @@
+import os
+import math
+import time
+import logging
+import threading
+
+from collections import deque
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import func
+from telebot import types
+
+from app import db, unit_of_work
+from models import User, StickerGeneration
+from model_guard import CircuitOpenError
+from sticker_generator import (
+    MODEL_GUARDS, StickerGenerationError, run_sticker_pipeline, pipeline_stats, model_retry_after,
+)
+
+# ═══════════════════════════════════════════════════════════════════════════════
+#                                НАСТРОЙКИ
+# ═══════════════════════════════════════════════════════════════════════════════
+
+# Заданий в работе одновременно; сколько из них идёт через каждый этап,
+# ограничивают лимиты этапов в sticker_generator.STAGES
+STICKER_WORKERS = int(os.getenv("STICKER_WORKERS", "8"))
+MAX_ATTEMPTS = 2
+IDLE_POLL_INTERVAL = 5        # секунд между проверками очереди
+DEFAULT_JOB_SECONDS = 150     # оценка длительности, пока нет статистики
+DURATION_SAMPLES = 20
+
+
+class StickerJobQueue:
+    """Очередь генерации стикеров поверх таблицы sticker_generations.
+
+    Задание — строка StickerGeneration: pending → processing → ok/failed.
+    Фиксированное число потоков забирает задания условным UPDATE, поэтому
+    одно задание не возьмут дважды. После перезапуска прерванные задания
+    (processing) возвращаются в очередь.
+    """
+
+    def __init__(self, workers: int = STICKER_WORKERS):
+        self.workers = workers
+        self.bot = None
+        self._durations: deque = deque(maxlen=DURATION_SAMPLES)
+        self._wakeup = threading.Event()
+        self._started = False
+        self._start_lock = threading.Lock()
+
+    def start(self, bot) -> None:
+        """Восстановить прерванные задания и запустить воркеры (повторный вызов ничего не делает)"""
+        with self._start_lock:
+            if self._started:
+                return
+            self.bot = bot
+            self._recover()
+            self._load_durations()
+            for i in range(self.workers):
+                threading.Thread(target=self._run, daemon=True, name=f"sticker-worker-{i}").start()
+            self._started = True
+            logging.info(f"🎨 Sticker queue started: {self.workers} workers")
+
+    def _recover(self) -> None:
+        """Вернуть в очередь задания, прерванные перезапуском"""
+        with unit_of_work():
+            requeued = StickerGeneration.query.filter(
+                StickerGeneration.status == 'processing',
+                func.coalesce(StickerGeneration.attempts, 0) < MAX_ATTEMPTS,
+            ).update({'status': 'pending', 'started_at': None}, synchronize_session=False)
+
+            exhausted = StickerGeneration.query.filter(
+                StickerGeneration.status == 'processing',
+            ).update({
+                'status': 'failed',
+                'finished_at': datetime.utcnow(),
+                'error': 'interrupted by restart',
+            }, synchronize_session=False)
+
+            # Записи, созданные до появления очереди, обработать нечем — исходного фото нет
+            orphaned = StickerGeneration.query.filter(
+                StickerGeneration.status == 'pending',
+                StickerGeneration.source_file_id.is_(None),
+            ).update({
+                'status': 'failed',
+                'finished_at': datetime.utcnow(),
+                'error': 'no source photo',
+            }, synchronize_session=False)
+            db.session.commit()
+
+        if requeued or exhausted or orphaned:
+            logging.info(f"🎨 Sticker queue recovery: requeued={requeued}, failed={exhausted}, orphaned={orphaned}")
+
+    def _load_durations(self) -> None:
+        with unit_of_work():
+            recent = StickerGeneration.query.filter(
+                StickerGeneration.status == 'ok',
+                StickerGeneration.started_at.isnot(None),
+                StickerGeneration.finished_at.isnot(None),
+            ).order_by(StickerGeneration.finished_at.desc()).limit(DURATION_SAMPLES).all()
+            for job in reversed(recent):
+                self._durations.append((job.finished_at - job.started_at).total_seconds())
+
+    # ─────────────── Постановка в очередь ───────────────
+
+    def submit(self, user_id: int, source_file_id: str) -> int:
+        """Поставить фото пользователя в очередь и вернуть id задания"""
+        with unit_of_work():
+            job = StickerGeneration.query.filter_by(user_id=user_id).order_by(StickerGeneration.id).first()
+            if job is None:
+                job = StickerGeneration(user_id=user_id)
+                db.session.add(job)
+            job.status = 'pending'
+            job.source_file_id = source_file_id
+            job.attempts = 0
+            job.error = None
+            job.started_at = None
+            job.finished_at = None
+            job.created_at = datetime.utcnow()
+            db.session.commit()
+            job_id = job.id
+
+        self._wakeup.set()
+        return job_id
+
+    def average_duration(self) -> float:
+        if not self._durations:
+            return DEFAULT_JOB_SECONDS
+        return sum(self._durations) / len(self._durations)
+
+    def position(self, job_id: int) -> tuple[int, int]:
+        """Место в очереди (0 — уже генерируется) и примерное ожидание в минутах"""
+        with unit_of_work():
+            job = db.session.get(StickerGeneration, job_id)
+            if job is None or job.status != 'pending':
+                return 0, math.ceil(self.average_duration() / 60)
+
+            ahead = StickerGeneration.query.filter(
+                StickerGeneration.status == 'pending',
+                db.or_(
+                    StickerGeneration.created_at < job.created_at,
+                    db.and_(StickerGeneration.created_at == job.created_at, StickerGeneration.id < job.id),
+                ),
+            ).count()
+
+        position = ahead + 1
+        # Узкое место — вызовы модели: одновременно их идёт не больше текущего адаптивного лимита stylize
+        concurrency = max(1, min(self.workers, MODEL_GUARDS['stylize'].limiter.limit))
+        rounds = math.ceil(position / concurrency)
+        return position, math.ceil(rounds * self.average_duration() / 60)
+
+    def queue_stats(self) -> dict:
+        """Состояние очереди для мониторинга"""
+        with unit_of_work():
+            counts = dict(
+                db.session.query(StickerGeneration.status, func.count(StickerGeneration.id))
+                .group_by(StickerGeneration.status).all()
+            )
+        return {
+            'workers': self.workers,
+            'pending': counts.get('pending', 0),
+            'processing': counts.get('processing', 0),
+            'failed': counts.get('failed', 0),
+            'ok': counts.get('ok', 0),
+            'avg_job_seconds': round(self.average_duration(), 1),
+            'stages': pipeline_stats(),
+        }
+
+    # ─────────────── Воркеры ───────────────
+
+    def _claim(self) -> Optional[int]:
+        """Забрать самое старое задание; условный UPDATE не даст взять его двум воркерам"""
+        with unit_of_work():
+            while True:
+                job = StickerGeneration.query.filter_by(status='pending').order_by(
+                    StickerGeneration.created_at, StickerGeneration.id
+                ).first()
+                if job is None:
+                    return None
+
+                claimed = StickerGeneration.query.filter_by(id=job.id, status='pending').update({
+                    'status': 'processing',
+                    'started_at': datetime.utcnow(),
+                    'attempts': func.coalesce(StickerGeneration.attempts, 0) + 1,
+                }, synchronize_session=False)
+                db.session.commit()
+                if claimed:
+                    return job.id
+
+    def _run(self) -> None:
+        while True:
+            try:
+                # Предохранитель модели разомкнут — задания ждут в очереди, а не падают одно за другим
+                retry_after = model_retry_after()
+                if retry_after > 0:
+                    time.sleep(min(retry_after, IDLE_POLL_INTERVAL))
+                    continue
+
+                job_id = self._claim()
+                if job_id is None:
+                    self._wakeup.wait(IDLE_POLL_INTERVAL)
+                    self._wakeup.clear()
+                    continue
+                self._process(job_id)
+            except Exception as e:
+                logging.error(f"Error in sticker worker: {e}")
+                time.sleep(IDLE_POLL_INTERVAL)
+
+    def _process(self, job_id: int) -> None:
+        with unit_of_work():
+            job = db.session.get(StickerGeneration, job_id)
+            user = db.session.get(User, job.user_id)
+            chat_id = int(user.telegram_id)
+            source_file_id = job.source_file_id
+            attempts = job.attempts or 1
+
+        try:
+            sticker_buf, file_id, pack_url, error_msg = run_sticker_pipeline(self.bot, chat_id, source_file_id)
+        except CircuitOpenError as e:
+            logging.info(f"[{chat_id}] Sticker job {job_id} deferred: {e}")
+            if self._defer(job_id, str(e)):
+                self._notify_deferred(chat_id)
+            return
+        except StickerGenerationError as e:
+            # Повтор не поможет (нет токена, фото не подходит) — сразу сообщаем пользователю
+            logging.error(f"[{chat_id}] Sticker job {job_id} failed: {e}")
+            self._finish(job_id, 'failed', str(e))
+            self._notify_failure(chat_id, e.user_message)
+            return
+        except Exception as e:
+            logging.error(f"[{chat_id}] Sticker job {job_id} failed (attempt {attempts}): {e}")
+            if attempts < MAX_ATTEMPTS:
+                self._finish(job_id, 'pending', str(e))
+                self._wakeup.set()
+            else:
+                self._finish(job_id, 'failed', str(e))
+                self._notify_failure(chat_id)
+            return
+
+        if pack_url:
+            self._finish(job_id, 'ok')
+        else:
+            self._finish(job_id, 'failed', error_msg or 'generation returned no sticker pack')
+        self._notify_result(chat_id, pack_url, error_msg)
+
+    def _defer(self, job_id: int, reason: str) -> bool:
+        """Вернуть задание в очередь без траты попытки. True — если откладываем впервые"""
+        with unit_of_work():
+            job = db.session.get(StickerGeneration, job_id)
+            if job is None:
+                return False
+            first = not (job.error or '').startswith('deferred')
+            job.status = 'pending'
+            job.started_at = None
+            job.attempts = max(0, (job.attempts or 1) - 1)
+            job.error = f"deferred: {reason}"
+            db.session.commit()
+            return first
+
+    def _finish(self, job_id: int, status: str, error: Optional[str] = None) -> None:
+        with unit_of_work():
+            job = db.session.get(StickerGeneration, job_id)
+            if job is None:
+                return
+            job.status = status
+            job.error = error
+            if status == 'pending':
+                job.started_at = None
+            else:
+                job.finished_at = datetime.utcnow()
+                if status == 'ok' and job.started_at:
+                    self._durations.append((job.finished_at - job.started_at).total_seconds())
+            db.session.commit()
+
+    # ─────────────── Сообщения пользователю ───────────────
+
+    def _notify_result(self, chat_id: int, pack_url: Optional[str], error_msg: Optional[str]) -> None:
+        try:
+            if error_msg:
+                kb = types.InlineKeyboardMarkup()
+                if pack_url:
+                    kb.add(types.InlineKeyboardButton("📦 Открыть стикерпак", url=pack_url))
+                kb.add(types.InlineKeyboardButton("⬅️ Главное меню", callback_data="main"))
+                self.bot.send_message(chat_id, error_msg, reply_markup=kb)
+            elif pack_url:
+                kb = types.InlineKeyboardMarkup(row_width=1)
+                kb.add(
+                    types.InlineKeyboardButton("📦 Открыть стикерпак", url=pack_url),
+                    types.InlineKeyboardButton("⬅️ Главное меню", callback_data="main")
+                )
+                self.bot.send_message(
+                    chat_id,
+                    f"🎉 Твой стикерпак готов!\n\n"
+                    f"Ссылка: {pack_url}\n\n"
+                    f"Добавь его в Telegram и пользуйся!",
+                    reply_markup=kb
+                )
+            else:
+                self.bot.send_message(chat_id, "⚠️ Не удалось создать стикерпак. Попробуй еще раз с другим фото.")
+        except Exception as e:
+            logging.error(f"[{chat_id}] Failed to notify about sticker result: {e}")
+
+    def _notify_deferred(self, chat_id: int) -> None:
+        try:
+            self.bot.send_message(
+                chat_id,
+                "⏳ Сервис генерации сейчас перегружен. Твоё фото осталось в очереди — "
+                "пришлю стикерпак, как только он будет готов."
+            )
+        except Exception as e:
+            logging.error(f"[{chat_id}] Failed to notify about deferred sticker: {e}")
+
+    def _notify_failure(self, chat_id: int, text: str = "⚠️ Произошла ошибка при генерации стикера.") -> None:
+        try:
+            self.bot.send_message(chat_id, text)
+        except Exception as e:
+            logging.error(f"[{chat_id}] Failed to notify about sticker error: {e}")
+
+
+sticker_jobs = StickerJobQueue()
@@ -0,0 +1,235 @@
+import os
+import re
+import time
+import queue
+import logging
+import threading
+
+from datetime import datetime
+from typing import Optional
+
+from app import db, unit_of_work
+from models import User, StickerGeneration
+
+# ═══════════════════════════════════════════════════════════════════════════════
+#                                НАСТРОЙКИ
+# ═══════════════════════════════════════════════════════════════════════════════
+
+# Полный проход сверки индекса с Telegram, секунд
+PACK_RECONCILE_INTERVAL = int(os.getenv("PACK_RECONCILE_INTERVAL", "3600"))
+PACK_CHECK_DELAY = 0.5      # пауза между запросами get_sticker_set, чтобы не упираться в лимиты
+
+
+class StickerPackRegistry:
+    """Индекс готовых стикерпаков: chat_id → ссылка и имя набора → chat_id.
+
+    Индекс строится из sticker_generations при старте и обновляется при
+    создании набора, поэтому ответ «у тебя уже есть стикерпак» не требует
+    ни запросов к БД, ни обращений к Telegram. Имя бота запоминается один
+    раз. Существование наборов сверяется с Telegram в фоновом потоке:
+    удалённые наборы убираются из индекса, а наборы, которые есть в
+    Telegram, но не в БД, проверяются по запросу check().
+    """
+
+    def __init__(self, reconcile_interval: int = PACK_RECONCILE_INTERVAL):
+        self.reconcile_interval = reconcile_interval
+        self.bot = None
+        self._bot_username: Optional[str] = None
+        self._by_chat: dict[int, str] = {}   # chat_id -> pack_url
+        self._by_name: dict[str, int] = {}   # имя набора -> chat_id
+        self._checks: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._started = False
+        self._start_lock = threading.Lock()
+        self.removed = 0
+        self.discovered = 0
+        self.last_reconcile = None
+
+    def start(self, bot) -> None:
+        """Построить индекс, запомнить имя бота и запустить сверку (повторный вызов ничего не делает)"""
+        with self._start_lock:
+            if self._started:
+                return
+            self.bot = bot
+            self.load()
+            try:
+                self.bot_username(bot)
+            except Exception as e:
+                logging.error(f"Could not fetch bot username: {e}")
+            threading.Thread(target=self._run, daemon=True, name="sticker-pack-reconcile").start()
+            self._started = True
+            logging.info(f"📦 Sticker pack registry: {len(self._by_chat)} packs indexed")
+
+    def load(self) -> None:
+        """Заполнить индекс из БД"""
+        with unit_of_work():
+            rows = db.session.query(
+                User.telegram_id, StickerGeneration.sticker_set_name, StickerGeneration.pack_url
+            ).join(StickerGeneration, StickerGeneration.user_id == User.id).filter(
+                StickerGeneration.status.in_(('ok', 'completed')),
+                db.or_(StickerGeneration.pack_url.isnot(None), StickerGeneration.sticker_set_name.isnot(None)),
+            ).all()
+
+        by_chat, by_name = {}, {}
+        for telegram_id, name, pack_url in rows:
+            try:
+                chat_id = int(telegram_id)
+            except (TypeError, ValueError):
+                continue
+            name = name or self._name_from_url(pack_url)
+            by_chat[chat_id] = pack_url or self.pack_url(name)
+            if name:
+                by_name[name] = chat_id
+
+        with self._lock:
+            self._by_chat = by_chat
+            self._by_name = by_name
+
+    # ─────────────── Имена наборов ───────────────
+
+    def bot_username(self, bot=None) -> str:
+        """Имя бота (get_me вызывается один раз за процесс)"""
+        if self._bot_username is None:
+            self._bot_username = (bot or self.bot).get_me().username
+        return self._bot_username
+
+    def pack_name(self, chat_id: int, bot=None) -> str:
+        name = f"avitoteam_{chat_id}_by_{self.bot_username(bot)}"
+        return re.sub(r'[^a-z0-9_]', '', name.lower())[:64]
+
+    @staticmethod
+    def pack_url(name: str) -> str:
+        return f"https://t.me/addstickers/{name}"
+
+    @staticmethod
+    def _name_from_url(pack_url: Optional[str]) -> Optional[str]:
+        if pack_url and '/addstickers/' in pack_url:
+            return pack_url.rsplit('/', 1)[-1]
+        return None
+
+    # ─────────────── Индекс ───────────────
+
+    def get(self, chat_id: int) -> Optional[str]:
+        """Ссылка на готовый стикерпак пользователя или None"""
+        return self._by_chat.get(int(chat_id))
+
+    def register(self, chat_id: int, name: str, pack_url: Optional[str] = None) -> str:
+        pack_url = pack_url or self.pack_url(name)
+        with self._lock:
+            self._by_chat[int(chat_id)] = pack_url
+            self._by_name[name] = int(chat_id)
+        return pack_url
+
+    def forget(self, chat_id: int) -> None:
+        with self._lock:
+            pack_url = self._by_chat.pop(int(chat_id), None)
+            name = self._name_from_url(pack_url)
+            if name and self._by_name.get(name) == int(chat_id):
+                del self._by_name[name]
+
+    def check(self, chat_id: int) -> None:
+        """Поставить в очередь проверку: нет ли у пользователя набора в Telegram, о котором не знает БД"""
+        if self.get(chat_id) is None:
+            self._checks.put(int(chat_id))
+
+    # ─────────────── Сверка с Telegram ───────────────
+
+    def _sticker_set_exists(self, name: str) -> Optional[bool]:
+        """True/False — ответ Telegram, None — проверить не удалось"""
+        try:
+            sticker_set = self.bot.get_sticker_set(name)
+            return bool(sticker_set and sticker_set.stickers)
+        except Exception as e:
+            error = str(e).lower()
+            if "not found" in error or "stickerset_invalid" in error:
+                return False
+            logging.warning(f"Could not verify sticker pack {name}: {e}")
+            return None
+
+    def _save(self, chat_id: int, name: str, pack_url: str) -> None:
+        with unit_of_work():
+            user = User.query.filter_by(telegram_id=str(chat_id)).first()
+            if not user:
+                return
+            gen = StickerGeneration.query.filter_by(user_id=user.id).order_by(StickerGeneration.id).first()
+            if gen is None:
+                gen = StickerGeneration(user_id=user.id)
+                db.session.add(gen)
+            elif gen.is_queued:
+                # Задание ещё в очереди — воркер увидит набор в индексе и не будет генерировать заново
+                gen.finished_at = datetime.utcnow()
+            gen.template_used = "avito_team"
+            gen.sticker_set_name = name
+            gen.sticker_set_link = pack_url
+            gen.pack_url = pack_url
+            gen.status = "ok"
+            db.session.commit()
+
+    def _discover(self, chat_id: int) -> None:
+        if self.get(chat_id) is not None:
+            return
+        name = self.pack_name(chat_id)
+        if self._sticker_set_exists(name):
+            pack_url = self.register(chat_id, name)
+            self._save(chat_id, name, pack_url)
+            self.discovered += 1
+            logging.info(f"[{chat_id}] Found sticker pack in Telegram missing from DB: {pack_url}")
+
+    def _verify(self, chat_id: int, name: str) -> None:
+        if self._sticker_set_exists(name) is not False:
+            return
+        self.forget(chat_id)
+        with unit_of_work():
+            user = User.query.filter_by(telegram_id=str(chat_id)).first()
+            if user:
+                StickerGeneration.query.filter(
+                    StickerGeneration.user_id == user.id,
+                    StickerGeneration.status.in_(('ok', 'completed')),
+                    db.or_(StickerGeneration.sticker_set_name == name, StickerGeneration.pack_url == self.pack_url(name)),
+                ).update({
+                    'status': 'failed',
+                    'error': 'sticker set not found',
+                    'pack_url': None,
+                    'sticker_set_link': None,
+                }, synchronize_session=False)
+                db.session.commit()
+        self.removed += 1
+        logging.info(f"[{chat_id}] Sticker pack {name} no longer exists, removed from index")
+
+    def _run(self) -> None:
+        next_reconcile = time.time() + self.reconcile_interval
+        pending: list = []
+        while True:
+            try:
+                # Проверки по запросу важнее плановой сверки
+                try:
+                    chat_id = self._checks.get(timeout=PACK_CHECK_DELAY if pending else 5)
+                    self._discover(chat_id)
+                    time.sleep(PACK_CHECK_DELAY)
+                    continue
+                except queue.Empty:
+                    pass
+
+                if pending:
+                    name, chat_id = pending.pop()
+                    self._verify(chat_id, name)
+                elif time.time() >= next_reconcile:
+                    with self._lock:
+                        pending = list(self._by_name.items())
+                    self.last_reconcile = datetime.utcnow()
+                    next_reconcile = time.time() + self.reconcile_interval
+            except Exception as e:
+                logging.error(f"Error in sticker pack reconciliation: {e}")
+                time.sleep(5)
+
+    def stats(self) -> dict:
+        return {
+            'indexed': len(self._by_chat),
+            'pending_checks': self._checks.qsize(),
+            'discovered': self.discovered,
+            'removed': self.removed,
+            'last_reconcile': self.last_reconcile.isoformat() if self.last_reconcile else None,
+        }
+
+
+sticker_packs = StickerPackRegistry()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""Стресс-тест записи на танцы: сотни одновременных записей и отмен.
+
+Фаза 1 — все участники одновременно записываются на случайные слоты
+(при нехватке мест — в лист ожидания). Фаза 2 — часть записанных
+одновременно отменяет запись, пока другие продолжают записываться.
+После каждой фазы проверяются инварианты:
+  - в слоте не больше max_participants записей;
+  - счётчик dance_slots.taken совпадает с числом записей;
+  - никто не стоит в очереди на слот, где уже записан;
+  - если в слоте есть свободные места, его лист ожидания пуст;
+  - кеш свободных мест (dance_booking.availability) совпадает с базой.
+При нарушении скрипт завершается с кодом 1.
+База — во временной папке, рабочая БД не трогается.
+
+Использование:
+  python stress_dance_booking.py [--users 300] [--slots 3] [--capacity 20] [--threads 32] [--cancel-share 0.3]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--users", type=int, default=300, help="участников")
+parser.add_argument("--slots", type=int, default=3, help="слотов")
+parser.add_argument("--capacity", type=int, default=20, help="мест в слоте")
+parser.add_argument("--threads", type=int, default=32, help="одновременных обработчиков")
+parser.add_argument("--cancel-share", type=float, default=0.3, help="доля записанных, отменяющих запись")
+args = parser.parse_args()
+
+# База задаётся до импорта модулей бота: app читает DATABASE_URL при импорте
+workdir = tempfile.mkdtemp(prefix="dance_stress_")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'stress.db')}"
+
+import logging
+
+from app import app, db
+from models import User, DanceSlot, DanceWaitlist, Registration
+import dance_booking
+
+logging.getLogger().setLevel(logging.ERROR)
+
+
+def run_concurrently(tasks: list) -> tuple[float, list, int]:
+    """Выполнить задачи в args.threads потоков, стартуя одновременно; (секунды, результаты, ошибок)"""
+    position = iter(tasks)
+    lock = threading.Lock()
+    barrier = threading.Barrier(args.threads)
+    results, errors = [], [0]
+
+    def worker():
+        barrier.wait()
+        while True:
+            with lock:
+                task = next(position, None)
+            if task is None:
+                return
+            try:
+                result = task()
+                with lock:
+                    results.append(result)
+            except Exception as e:
+                with lock:
+                    errors[0] += 1
+                logging.error(f"Task failed: {e}")
+
+    threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started, results, errors[0]
+
+
+def check_invariants(stage: str) -> bool:
+    ok = True
+    cached = {(slot.day, slot.time_slot): slot for slot in dance_booking.availability()}
+    with app.app_context():
+        for slot in DanceSlot.query.order_by(DanceSlot.id):
+            registered = Registration.query.filter_by(activity_type='dance', day=slot.day, time_slot=slot.time_slot).count()
+            waiting = DanceWaitlist.query.filter_by(slot_id=slot.id).count()
+            print(f"  {slot.day} {slot.time_slot}: записано {registered}/{slot.max_participants}, "
+                  f"taken={slot.taken}, в очереди {waiting}")
+            if registered > slot.max_participants:
+                print(f"  ❌ переполнение слота на {registered - slot.max_participants}")
+                ok = False
+            if slot.taken != registered:
+                print(f"  ❌ счётчик taken={slot.taken} не совпадает с записями ({registered})")
+                ok = False
+            view = cached.get((slot.day, slot.time_slot))
+            if not view or (view.taken, view.waiting) != (slot.taken, waiting):
+                print(f"  ❌ кеш свободных мест устарел: {view}")
+                ok = False
+            if waiting and registered < slot.max_participants:
+                print(f"  ❌ есть свободные места, а очередь не пуста")
+                ok = False
+            both = (
+                db.session.query(DanceWaitlist.user_id)
+                .join(Registration, db.and_(
+                    Registration.user_id == DanceWaitlist.user_id,
+                    Registration.activity_type == 'dance',
+                    Registration.day == slot.day,
+                    Registration.time_slot == slot.time_slot,
+                ))
+                .filter(DanceWaitlist.slot_id == slot.id)
+                .count()
+            )
+            if both:
+                print(f"  ❌ {both} участников одновременно записаны и в очереди")
+                ok = False
+    print(f"{'✅' if ok else '❌'} {stage}: инварианты {'соблюдены' if ok else 'нарушены'}")
+    return ok
+
+
+def main():
+    with app.app_context():
+        db.session.add_all([User(telegram_id=str(700000000 + i), consent_given=True) for i in range(args.users)])
+        slots = [DanceSlot(day="Суббота", time_slot=f"{12 + i}:00", max_participants=args.capacity) for i in range(args.slots)]
+        db.session.add_all(slots)
+        db.session.commit()
+        user_ids = [u.id for u in User.query.order_by(User.id)]
+        slot_keys = [(slot.day, slot.time_slot) for slot in slots]
+
+    rng = random.Random(7)
+    print(f"Участников: {args.users}, слотов: {args.slots} по {args.capacity} мест, потоков: {args.threads}")
+
+    # Фаза 1: все записываются одновременно, повторные нажатия тоже летят параллельно
+    choices = {user_id: rng.choice(slot_keys) for user_id in user_ids}
+    tasks = [
+        (lambda u=user_id, k=key: (u, k, dance_booking.book(u, *k, waitlist=True)))
+        for user_id, key in choices.items() for _ in range(2)
+    ]
+    rng.shuffle(tasks)
+    elapsed, results, errors = run_concurrently(tasks)
+    statuses = {}
+    for _, _, result in results:
+        statuses[result.status] = statuses.get(result.status, 0) + 1
+    print(f"\nФаза 1: {len(tasks)} запросов за {elapsed:.2f} с ({len(tasks) / elapsed:.0f}/с), ошибок {errors}: {statuses}")
+    ok = check_invariants("фаза 1") and errors == 0
+
+    # Фаза 2: часть записанных отменяет, остальные снова жмут «записаться»
+    booked = [(u, k) for u, k, result in results if result.status == 'booked']
+    cancelling = rng.sample(booked, int(len(booked) * args.cancel_share))
+    promoted = []
+    tasks = [(lambda u=u, k=k: ('cancel', dance_booking.cancel(u, *k))) for u, k in cancelling]
+    tasks += [(lambda u=u, k=k: ('book', dance_booking.book(u, *k, waitlist=True))) for u, k in choices.items()]
+    rng.shuffle(tasks)
+    elapsed, results, errors = run_concurrently(tasks)
+    for kind, result in results:
+        if kind == 'cancel':
+            promoted += result[1]
+    print(f"\nФаза 2: {len(cancelling)} отмен и {len(choices)} повторных записей за {elapsed:.2f} с, "
+          f"ошибок {errors}, переведено из очереди: {len(promoted)}")
+    ok = check_invariants("фаза 2") and errors == 0 and ok
+
+    print(f"Временные файлы: {workdir}")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
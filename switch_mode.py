@@ -18,8 +18,11 @@ def switch_mode(mode, webhook_url=None):
         elif mode == 'polling':
             SystemConfig.set_config('BOT_MODE', 'polling', 'text', 'Режим работы бота')
             print("✅ Переключено на polling режим")
+        elif mode == 'sharded':
+            SystemConfig.set_config('BOT_MODE', 'sharded', 'text', 'Режим работы бота')
+            print("✅ Переключено на sharded режим")
         else:
-            print("❌ Неверный режим. Используйте: webhook или polling")
+            print("❌ Неверный режим. Используйте: webhook, polling или sharded")
             return
         
         print("🔄 Перезапустите бота для применения изменений")
@@ -29,6 +32,7 @@ if __name__ == "__main__":
         print("Использование:")
         print("  python switch_mode.py polling")
         print("  python switch_mode.py webhook [URL]")
+        print("  python switch_mode.py sharded")
         print("Примеры:")
         print("  python switch_mode.py webhook https://mybot.example.com")
         print("  python switch_mode.py polling")
@@ -146,4 +146,5 @@ QUEST_PATH = os.path.join(IMG_DIR, "quest.jpeg")
 DANCE_PATH = os.path.join(IMG_DIR, "dance.jpeg")
 FOREST_PATH = os.path.join(IMG_DIR, "forest.jpeg")
 BACKGROUND_PATH = os.path.join(IMG_DIR, "background.png")
-SHILDIK_PATH = os.path.join(IMG_DIR, "shildik.png")
\ No newline at end of file
+SHILDIK_PATH = os.path.join(IMG_DIR, "shildik.png")
+WELCOME_VIDEO_PATH = "circle.mp4"
\ No newline at end of file
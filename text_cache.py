@@ -1,55 +1,113 @@
 import threading
 import time
 import json
-from typing import Dict, Any, Optional
+from types import MappingProxyType
+from typing import Dict, Any, Mapping, Optional, NamedTuple
+
+
+class _Snapshot(NamedTuple):
+    """Неизменяемый снимок настроек; заменяется целиком одной операцией присваивания"""
+    data: Mapping[str, Any]
+    version: int
+    loaded_at: float
+
 
 class TextCache:
+    """Все настройки SystemConfig в памяти процесса.
+
+    Читатели берут текущий неизменяемый снимок без блокировок. Устаревший
+    снимок (сменилась версия или истёк TTL) продолжает отдаваться, пока
+    фоновый поток загружает новый (stale-while-revalidate). Синхронная
+    загрузка происходит только при самом первом обращении и в force_update().
+    """
+
     def __init__(self):
-        self._cache: Dict[str, Any] = {}
-        self._last_update = 0
-        self._cache_ttl = 300  # 5 минут
-        self._lock = threading.RLock()
-        self._initialized = False
+        self._snapshot: Optional[_Snapshot] = None
+        self._version = 0
+        self._cache_ttl = 300  # 5 минут, страховка от изменений из другого процесса
+        self._lock = threading.Lock()          # защищает счётчик версии
+        self._refresh_lock = threading.Lock()  # одна загрузка из БД за раз
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def invalidate(self):
+        """Отметить кеш устаревшим и запустить фоновую перезагрузку"""
+        with self._lock:
+            self._version += 1
+        self._schedule_refresh()
 
     def get_text(self, key: str, default: Any = None) -> Any:
-        """Получить текст из кеша"""
-        with self._lock:
-            if not self._initialized or self._should_update():
+        """Получить текст из кеша (без блокировок)"""
+        snapshot = self._snapshot
+        if snapshot is None:
+            snapshot = self._load_initial()
+        elif self._is_stale(snapshot):
+            self._schedule_refresh()
+        return snapshot.data.get(key, default)
+
+    def _is_stale(self, snapshot: _Snapshot) -> bool:
+        """Проверить, нужно ли обновить кеш"""
+        return (snapshot.version != self._version
+                or time.time() - snapshot.loaded_at > self._cache_ttl)
+
+    def _load_initial(self) -> _Snapshot:
+        """Первая загрузка: читателям пока нечего отдать, поэтому ждём"""
+        with self._refresh_lock:
+            if self._snapshot is None:
                 self._update_cache()
-            return self._cache.get(key, default)
+            return self._snapshot
 
-    def _should_update(self) -> bool:
-        """Проверить, нужно ли обновить кеш"""
-        return time.time() - self._last_update > self._cache_ttl
+    def _schedule_refresh(self):
+        """Запустить фоновую перезагрузку, если она ещё не идёт"""
+        if not self._refresh_lock.acquire(blocking=False):
+            return
+        try:
+            threading.Thread(target=self._refresh_worker, daemon=True, name="text-cache-refresh").start()
+        except Exception:
+            self._refresh_lock.release()
+            raise
+
+    def _refresh_worker(self):
+        """Перезагружать, пока за время загрузки успевает смениться версия"""
+        try:
+            while True:
+                self._update_cache()
+                snapshot = self._snapshot
+                if snapshot is None or snapshot.version == self._version:
+                    break
+        finally:
+            self._refresh_lock.release()
 
     def _update_cache(self):
-        """Обновить кеш из базы данных"""
+        """Загрузить настройки из БД одним запросом и опубликовать новый снимок"""
+        version = self._version
         try:
-            from app import app
+            from app import unit_of_work
             from models import SystemConfig
 
-            with app.app_context():
-                # Получаем все настройки из базы
+            with unit_of_work():
                 configs = SystemConfig.query.all()
+                cache = {config.config_key: config.get_value() for config in configs}
 
-                # Обновляем кеш
-                for config in configs:
-                    self._cache[config.config_key] = config.get_value()
-
-                # Добавляем fallback значения из text.py
-                self._add_fallback_values()
-
-                self._last_update = time.time()
-                self._initialized = True
+            # Добавляем fallback значения из text.py
+            self._add_fallback_values(cache)
 
         except Exception as e:
             print(f"Error updating text cache: {e}")
-            # Если ошибка, используем fallback из text.py
-            if not self._initialized:
-                self._add_fallback_values()
-                self._initialized = True
-
-    def _add_fallback_values(self):
+            if self._snapshot is not None:
+                # Оставляем прежние значения, повторим после следующего TTL
+                self._snapshot = self._snapshot._replace(version=version, loaded_at=time.time())
+                return
+            # Если ошибка при первой загрузке, используем fallback из text.py
+            cache = {}
+            self._add_fallback_values(cache)
+
+        self._snapshot = _Snapshot(MappingProxyType(cache), version, time.time())
+
+    @staticmethod
+    def _add_fallback_values(cache: Dict[str, Any]):
         """Добавить fallback значения из text.py"""
         try:
             import text
@@ -65,29 +123,30 @@ class TextCache:
             ]
 
             for const_name in text_constants:
-                if const_name not in self._cache:
+                if const_name not in cache:
                     value = getattr(text, const_name, None)
                     if value is not None:
-                        self._cache[const_name] = value
+                        cache[const_name] = value
 
             # Добавляем шаги квеста
             if hasattr(text, 'QUEST_STEPS'):
                 for i, step in enumerate(text.QUEST_STEPS):
                     key = f'QUEST_STEP_{i}_HINT'
-                    if key not in self._cache:
-                        self._cache[key] = step.get('hint', '')
+                    if key not in cache:
+                        cache[key] = step.get('hint', '')
 
             # Добавляем слоты танцев
             if hasattr(text, 'DANCE_SLOTS'):
-                self._cache['DANCE_SLOTS'] = text.DANCE_SLOTS
+                cache['DANCE_SLOTS'] = text.DANCE_SLOTS
 
         except Exception as e:
             print(f"Error adding fallback values: {e}")
 
     def force_update(self):
-        """Принудительное обновление всех кешей"""
+        """Принудительное обновление всех кешей (синхронно, для админки)"""
         with self._lock:
-            self._last_update = 0
+            self._version += 1
+        with self._refresh_lock:
             self._update_cache()
 
     def get_survey_question(self, index: int) -> str:
@@ -143,40 +202,6 @@ class TextCache:
         
         return 9  # По умолчанию
 
-    def get_dance_slots(self) -> list:
-        """Получить слоты танцев из базы данных"""
-        cache_key = 'dance_slots_from_db'
-
-        def compute_dance_slots():
-            try:
-                from app import app
-                from models import DanceSlot
-
-                with app.app_context():
-                    slots = DanceSlot.query.filter_by(is_active=True).order_by(DanceSlot.day, DanceSlot.time_slot).all()
-                    return [
-                        {
-                            "day": slot.day,
-                            "time_slot": slot.time_slot,
-                            "activity_type": "dance",
-                            "max_participants": slot.max_participants
-                        }
-                        for slot in slots
-                    ]
-            except Exception as e:
-                print(f"Error loading dance slots from DB: {e}")
-                return []
-
-        # Кешируем на 5 минут для слотов танцев
-        if cache_key in self._cache:
-            value, timestamp = self._cache[cache_key]
-            if time.time() - timestamp < 300:  # 5 минут
-                return value
-
-        slots = compute_dance_slots()
-        self._cache[cache_key] = (slots, time.time())
-        return slots
-
 # Глобальный экземпляр кеша
 text_cache = TextCache()
 
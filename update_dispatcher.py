@@ -0,0 +1,139 @@
+import os
+import queue
+import logging
+import threading
+
+from typing import Optional
+
+from telebot.types import Update
+
+# ═══════════════════════════════════════════════════════════════════════════════
+#                                НАСТРОЙКИ
+# ═══════════════════════════════════════════════════════════════════════════════
+
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "8"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "100"))  # на один шард
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+
+def update_chat_id(update: Update) -> Optional[int]:
+    """Чат, к которому относится обновление (ключ шардирования)"""
+    for message in (update.message, update.edited_message, update.channel_post, update.edited_channel_post):
+        if message is not None:
+            return message.chat.id
+    if update.callback_query is not None:
+        call = update.callback_query
+        if call.message is not None:
+            return call.message.chat.id
+        return call.from_user.id
+    for event in (update.inline_query, update.chosen_inline_result, update.my_chat_member, update.chat_member):
+        if event is not None:
+            user = getattr(event, 'from_user', None)
+            if user is not None:
+                return user.id
+    return None
+
+
+class ShardedUpdateDispatcher:
+    """Параллельная обработка обновлений с сохранением порядка внутри чата.
+
+    Используется в webhook (синглтон update_dispatcher) и в режиме
+    BOT_MODE=sharded (свой экземпляр в sharded_polling.ShardedPolling).
+    Обновления раскладываются по шардам по chat_id; у каждого шарда своя
+    очередь и один поток, поэтому сообщения одного чата обрабатываются строго
+    по порядку, а разные чаты — параллельно. Если очередь шарда заполнена,
+    submit() возвращает False и webhook отвечает 503: Telegram повторит
+    доставку позже; polling вызывает submit(block=True) и ждёт места.
+    """
+
+    def __init__(self, workers: int = WEBHOOK_WORKERS, queue_size: int = WEBHOOK_QUEUE_SIZE, name: str = "webhook"):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.name = name
+        self.bot = None
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._busy = [False] * workers
+        self._started = False
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.errors = 0
+        self.max_depth = 0
+
+    def start(self, bot) -> None:
+        """Запустить потоки шардов (повторный вызов ничего не делает)"""
+        with self._start_lock:
+            if self._started:
+                return
+            self.bot = bot
+            # Обработчики выполняются прямо в потоке шарда, иначе telebot
+            # отдаст их в свой пул и порядок внутри чата потеряется
+            bot.threaded = False
+            for shard in range(self.workers):
+                threading.Thread(target=self._run, args=(shard,), daemon=True,
+                                 name=f"{self.name}-shard-{shard}").start()
+            self._started = True
+            logging.info(f"📨 {self.name.capitalize()} dispatcher started: {self.workers} shards, queue {self.queue_size} per shard")
+
+    def _shard(self, update: Update) -> int:
+        chat_id = update_chat_id(update)
+        key = chat_id if chat_id is not None else update.update_id
+        return key % self.workers
+
+    def submit(self, update: Update, block: bool = False) -> bool:
+        """Поставить обновление в очередь. False — шард перегружен.
+
+        block=True — ждать места в очереди шарда (polling может подождать, webhook — нет).
+        """
+        shard = self._shard(update)
+        try:
+            self._queues[shard].put(update, block=block)
+        except queue.Full:
+            with self._stats_lock:
+                self.rejected += 1
+            logging.warning(f"{self.name.capitalize()} shard {shard} is full, update {update.update_id} rejected")
+            return False
+
+        with self._stats_lock:
+            self.accepted += 1
+            self.max_depth = max(self.max_depth, self._queues[shard].qsize())
+        return True
+
+    def _run(self, shard: int) -> None:
+        updates = self._queues[shard]
+        while True:
+            update = updates.get()
+            self._busy[shard] = True
+            try:
+                self.bot.process_new_updates([update])
+                with self._stats_lock:
+                    self.processed += 1
+            except Exception as e:
+                with self._stats_lock:
+                    self.errors += 1
+                logging.error(f"Error processing update {update.update_id} in {self.name} shard {shard}: {e}")
+            finally:
+                self._busy[shard] = False
+                updates.task_done()
+
+    def stats(self) -> dict:
+        """Глубина очередей и счётчики для мониторинга"""
+        depths = [q.qsize() for q in self._queues]
+        with self._stats_lock:
+            return {
+                'workers': self.workers,
+                'queue_size_per_shard': self.queue_size,
+                'queue_depth': sum(depths),
+                'shard_depths': depths,
+                'busy_workers': sum(self._busy),
+                'max_depth_seen': self.max_depth,
+                'accepted': self.accepted,
+                'rejected': self.rejected,
+                'processed': self.processed,
+                'errors': self.errors,
+            }
+
+
+update_dispatcher = ShardedUpdateDispatcher()
@@ -7,6 +7,7 @@ from telebot.types import Update
 
 from app import app, db
 from bot import bot, BOT_TOKEN
+from update_dispatcher import update_dispatcher, WEBHOOK_MAX_CONNECTIONS
 
 # Настройка логирования
 handlers = [logging.StreamHandler()]
@@ -83,7 +84,7 @@ def setup_webhook():
         
         success = bot.set_webhook(
             url=webhook_url,
-            max_connections=10,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
             allowed_updates=["message", "callback_query"]
         )
         
@@ -100,19 +101,26 @@ def setup_webhook():
 
 
 
+def enqueue_update():
+    """Разобрать обновление и отдать его пулу обработчиков, не дожидаясь обработки"""
+    json_string = request.get_data().decode('utf-8')
+    update = telebot.types.Update.de_json(json_string)
+    update_dispatcher.start(bot)
+    # 503 при переполнении: Telegram повторит доставку позже
+    return update_dispatcher.submit(update)
+
 @app.route('/webhook', methods=['POST'])
 def webhook_telegram():
     """Основной endpoint для Telegram webhook"""
     if request.headers.get('content-type') == 'application/json':
-        json_string = request.get_data().decode('utf-8')
-        update = telebot.types.Update.de_json(json_string)
-        bot.process_new_updates([update])
+        if not enqueue_update():
+            return 'Busy', 503
         return 'OK'
     else:
         abort(403)
 
 @app.route('/webhook-status', methods=['GET'])
-def webhook_status():
+def webhook_public_status():
     """Проверка статуса webhook"""
     try:
         from models import SystemConfig
@@ -134,7 +142,8 @@ def webhook_status():
             'pending_updates': webhook_info.pending_update_count,
             'last_error': webhook_info.last_error_message,
             'is_webhook_set': bool(webhook_info.url),
-            'webhook_matches': webhook_info.url == webhook_url
+            'webhook_matches': webhook_info.url == webhook_url,
+            'dispatcher': update_dispatcher.stats()
         }
         
         return status, 200
@@ -145,9 +154,8 @@ def webhook_status():
 @app.route(WEBHOOK_URL_PATH, methods=['POST'])
 def webhook_handler():
     if request.headers.get('content-type') == 'application/json':
-        json_string = request.get_data().decode('utf-8')
-        update = telebot.types.Update.de_json(json_string)
-        bot.process_new_updates([update])
+        if not enqueue_update():
+            return 'Busy', 503
         return ''
     else:
         abort(403)
@@ -182,7 +190,7 @@ def set_webhook():
         bot.remove_webhook()
         
         # Устанавливаем новый webhook
-        success = bot.set_webhook(url=webhook_url)
+        success = bot.set_webhook(url=webhook_url, max_connections=WEBHOOK_MAX_CONNECTIONS)
         
         if success:
             logging.info("✅ Webhook установлен успешно")